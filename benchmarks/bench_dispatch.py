@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compares the feedback dispatch table of FeedbackWatcher against the former
+# chain of check_* methods which compared every known prefix with slices.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_dispatch.py [iterations]
+
+import sys
+import timeit
+
+from sonyavindicator.indicator import *
+
+from helpers import Sink
+
+
+def legacy_check_volume(sink, data):
+    if FEEDBACK_VOLUME == data[:-1]:
+        sink.update_volume(data[-1])
+        return True
+    return False
+
+def legacy_check_source(sink, data):
+    source_switched = False
+    for source, source_feedback in FEEDBACK_SOURCE_MAP.items():
+        if source_feedback == data[:-2]:
+            sink.update_source(source)
+            source_switched = True
+    return source_switched
+
+def legacy_check_sound_field(sink, data):
+    sound_field_switched = False
+    for sound_field, sound_field_feedback in FEEDBACK_SOUND_FIELD_MAP.items():
+        if sound_field_feedback == data:
+            sink.update_sound_field(sound_field)
+            sound_field_switched = True
+    return sound_field_switched
+
+def legacy_check_pure_direct(sink, data):
+    if FEEDBACK_PURE_DIRECT_ON == data or FEEDBACK_PURE_DIRECT_OFF == data:
+        sink.update_pure_direct(data[-1])
+        return True
+    return False
+
+def legacy_check_sound_optimizer(sink, data):
+    if FEEDBACK_SOUND_OPTIMIZER_PREFIX == data[:-1]:
+        sink.update_sound_optimizer(data[-1])
+        return True
+    return False
+
+def legacy_check_timer(sink, data):
+    if FEEDBACK_TIMER_PREFIX == data[:-3]:
+        sink.update_timer(data[-3], data[-2], data[-1])
+        return True
+    return False
+
+def legacy_check_fmtuner(sink, data):
+    if FEEDBACK_FMTUNER_PREFIX == data[0:5]:
+        sink.update_fmtuner(data[5], data[6], data[7], data[8])
+        return True
+    return False
+
+def legacy_check_auto_standby(sink, data):
+    if FEEDBACK_AUTO_STANDBY_OFF == data or FEEDBACK_AUTO_STANDBY_ON == data:
+        sink.update_auto_standby(data[-1])
+        return True
+    return False
+
+def legacy_check_auto_phase_matching(sink, data):
+    if FEEDBACK_AUTO_PHASE_MATCHING_OFF == data or FEEDBACK_AUTO_PHASE_MATCHING_AUTO == data:
+        sink.update_auto_phase_matching(data[-1])
+        return True
+    return False
+
+def legacy_process_frame(sink, data):
+    return legacy_check_timer(sink, data) or \
+           legacy_check_source(sink, data) or \
+           legacy_check_sound_field(sink, data) or \
+           legacy_check_pure_direct(sink, data) or \
+           legacy_check_sound_optimizer(sink, data) or \
+           legacy_check_fmtuner(sink, data) or \
+           legacy_check_volume(sink, data) or \
+           legacy_check_auto_standby(sink, data) or \
+           legacy_check_auto_phase_matching(sink, data)
+
+
+FRAMES = [
+    FEEDBACK_VOLUME + bytearray([20]),
+    FEEDBACK_SOURCE_MAP["homeNetwork"] + FEEDBACK_MUTE_OFF + bytearray([0x00]),
+    FEEDBACK_SOUND_FIELD_MAP["portableAudio"],
+    FEEDBACK_PURE_DIRECT_OFF,
+    FEEDBACK_SOUND_OPTIMIZER_PREFIX + FEEDBACK_SOUND_OPTIMIZER_NORMAL,
+    FEEDBACK_TIMER_PREFIX + bytearray([0x01, 0x1E, 0x3B]),
+    FEEDBACK_FMTUNER_PREFIX + bytearray([0x02, 0x00, 0x26, 0xC6]),
+    FEEDBACK_AUTO_STANDBY_ON,
+    FEEDBACK_AUTO_PHASE_MATCHING_AUTO,
+]
+
+
+def main(iterations = 100000):
+    sink = Sink()
+    sink.echo_tracker = EchoTracker()
+    sink.volume_controller = sink
+    watcher = FeedbackWatcher(sink, sink, sink, sink, TCP_PORT_1)
+    watcher.debug_data = sink.ignore
+    frames = [memoryview(bytes(frame)) for frame in FRAMES]
+
+    def run_legacy():
+        for frame in frames:
+            legacy_process_frame(sink, frame)
+
+    def run_dispatch():
+        for frame in frames:
+            watcher.process_frame(frame)
+
+    total = iterations * len(frames)
+    for name, function in (("check chain", run_legacy), ("dispatch table", run_dispatch)):
+        elapsed = min(timeit.repeat(function, number = iterations, repeat = 3))
+        print("%-16s %8.3f us/frame %12.0f frames/s" %(name, elapsed * 1e6 / total, total / elapsed))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
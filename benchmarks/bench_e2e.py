@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# End-to-end benchmarks against the receiver simulator on localhost. Prints
+# the results as JSON, so they can be compared between releases:
+#
+#   PYTHONPATH=. python3 benchmarks/bench_e2e.py [--output results.json]
+#
+# - latency: from a CommandService call until the feedback of the simulator
+#   changed the state in StateService (p50/p99 in ms)
+# - throughput: feedback frames per second FeedbackWatcher decodes and applies
+#   while the simulator writes them as fast as it can
+# - discovery: DeviceService.find_device sweeping 127.0.0.0/24 with the
+#   simulator on the last host
+# - idle: CPU time and wakeups (context switches) per second with both
+#   watchers connected and nothing happening
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+
+from sonyavindicator.indicator import *
+from sonyavindicator.simulator import ReceiverSimulator
+
+from helpers import Sink
+
+
+class RecordingStateService(StateService):
+
+    # Signals every state change made by feedback, which is processed on the
+    # event loop thread (the commands update the state optimistically on the
+    # calling thread)
+
+    changed = None
+    event_loop = None
+
+    def record(self):
+        if threading.current_thread() is self.event_loop:
+            self.changed.set()
+
+    def update_volume(self, vol):
+        StateService.update_volume(self, vol)
+        self.record()
+
+    def update_fmtuner(self, fmtuner, stereo, freq):
+        StateService.update_fmtuner(self, fmtuner, stereo, freq)
+        self.record()
+
+
+class Stack():
+
+    # The indicator without its GUI, connected to a simulator
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.event_loop = EventLoop()
+        self.event_loop.start()
+        self.device_service = DeviceService(self.event_loop)
+        self.device_service.ip = simulator.host
+        self.device_service.port, self.device_service.port_2 = simulator.ports
+        self.indicator = Sink()
+        self.state_service = RecordingStateService(self.indicator)
+        self.state_service.changed = threading.Event()
+        self.state_service.event_loop = self.event_loop
+        self.command_service = CommandService(self.device_service, self.state_service)
+        self.indicator.update_source = self.state_service.update_source
+        self.indicator.update_sound_field = self.state_service.update_sound_field
+        self.watchers = [FeedbackWatcher(self.indicator, self.device_service, self.state_service, self.command_service, port) for port in simulator.ports]
+        self.state_service.initialized = True
+        self.command_service.initialized = True
+        for watcher in self.watchers:
+            watcher.start()
+        self.wait_connected()
+
+    def wait_connected(self, timeout = 5.0):
+        deadline = time.monotonic() + timeout
+        while len(self.simulator.writers) < len(self.watchers) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        for watcher in self.watchers:
+            watcher.kill()
+            watcher.join(2)
+        self.command_service.close()
+        self.event_loop.kill()
+        self.event_loop.join(2)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def bench_latency(rounds):
+    simulator = ReceiverSimulator((0, 0)).start_thread()
+    stack = Stack(simulator)
+    commands = [
+        lambda i: stack.command_service.set_volume(None, LOW_VOLUME + i // 2 % 2 + 1),
+        lambda i: stack.command_service.fmtuner_preset_up(None),
+    ]
+    latencies = []
+    lost = 0
+    try:
+        for i in range(rounds):
+            changed = stack.state_service.changed
+            changed.clear()
+            # The volume controller and the scheduler pace their frames,
+            # commands closer together would measure the pacing
+            time.sleep(max(1.0 / stack.command_service.volume_controller.max_rate, stack.command_service.scheduler.frame_interval))
+            started = time.perf_counter()
+            commands[i % len(commands)](i)
+            if changed.wait(2.0):
+                latencies.append(time.perf_counter() - started)
+            else:
+                lost += 1
+    finally:
+        stack.close()
+        simulator.stop_thread()
+    return {
+        "rounds": rounds,
+        "lost": lost,
+        "p50_ms": round(percentile(latencies, 0.5) * 1e3, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1e3, 3) if latencies else None,
+        "max_ms": round(max(latencies) * 1e3, 3) if latencies else None,
+    }
+
+
+def bench_throughput(frames, chunk):
+    simulator = ReceiverSimulator((0, 0)).start_thread()
+    stack = Stack(simulator)
+    watcher = stack.watchers[0]
+    processed = [0]
+    done = threading.Event()
+    process_frame = watcher.process_frame
+
+    def counting_process_frame(data):
+        process_frame(data)
+        processed[0] += 1
+        if processed[0] == frames:
+            done.set()
+
+    watcher.process_frame = counting_process_frame
+    # Volume, source and sound field reports, written chunk frames per segment
+    sample = [simulator.volume_frame(), simulator.source_frame(), simulator.sound_field_frame()]
+    data = b"".join(bytes(sample[i % len(sample)]) for i in range(chunk))
+    writer = simulator.writers[0] if simulator.writers[0].get_extra_info("sockname")[1] == watcher.port else simulator.writers[1]
+
+    async def blast():
+        for i in range(frames // chunk):
+            writer.write(data)
+            await writer.drain()
+
+    try:
+        started = time.perf_counter()
+        simulator.call(lambda: simulator.event_loop.create_task(blast()))
+        completed = done.wait(60.0)
+        duration = time.perf_counter() - started
+    finally:
+        stack.close()
+        simulator.stop_thread()
+    return {
+        "frames": frames,
+        "frames_per_segment": chunk,
+        "processed": processed[0],
+        "seconds": round(duration, 3),
+        "frames_per_second": round(processed[0] / duration) if completed else None,
+    }
+
+
+def bench_discovery():
+    simulator = ReceiverSimulator((0,), "127.0.0.254").start_thread()
+    event_loop = EventLoop()
+    event_loop.start()
+    device_service = DeviceService(event_loop)
+    device_service.networks = [ipaddress.IPv4Interface("127.0.0.1/24")]
+    device_service.candidate_ordering = SweepOrdering()
+    device_service.port = simulator.ports[0]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        device_service.cache_path = os.path.join(cache_dir, "device.json")
+        try:
+            started = time.perf_counter()
+            ip = device_service.find_device()
+            duration = time.perf_counter() - started
+        finally:
+            event_loop.kill()
+            event_loop.join(2)
+            simulator.stop_thread()
+    return {
+        "network": "127.0.0.0/24",
+        "found": ip == simulator.host,
+        "seconds": round(duration, 3),
+        "hosts_per_second": round(device_service.scan_rate),
+    }
+
+
+def bench_idle(seconds):
+    simulator = ReceiverSimulator((0, 0)).start_thread()
+    stack = Stack(simulator)
+    try:
+        time.sleep(0.5)
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        time.sleep(seconds)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        stack.close()
+        simulator.stop_thread()
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    switches = (after.ru_nvcsw - before.ru_nvcsw) + (after.ru_nivcsw - before.ru_nivcsw)
+    return {
+        "seconds": seconds,
+        "cpu_percent": round(cpu * 100.0 / seconds, 3),
+        "wakeups_per_second": round(switches / seconds, 1),
+    }
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "End-to-end benchmarks against the receiver simulator")
+    parser.add_argument("--rounds", type = int, default = 200, help = "commands for the latency benchmark")
+    parser.add_argument("--frames", type = int, default = 200000, help = "feedback frames for the throughput benchmark")
+    parser.add_argument("--chunk", type = int, default = 64, help = "feedback frames per segment")
+    parser.add_argument("--idle", type = float, default = 10.0, help = "seconds to measure while idle")
+    parser.add_argument("--output", help = "write the results to this file as well")
+    options = parser.parse_args(args)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "latency": bench_latency(options.rounds),
+        "throughput": bench_throughput(options.frames - options.frames % options.chunk, options.chunk),
+        "discovery": bench_discovery(),
+        "idle": bench_idle(options.idle),
+    }
+    output = json.dumps(results, indent = 2)
+    print(output)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Floods the feedback watcher with frames while another thread keeps issuing
+# user mute, source and volume commands through the default scheduler. The
+# last user command of every kind has to reach the wire, even when it
+# restates what the receiver reported, while the sends triggered by the
+# feedback itself (like the source menu reacting to a source report) have to
+# be recognised as echoes and stay off the wire.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_echo.py [commands] [frames]
+
+import sys
+import threading
+import time
+
+from sonyavindicator.indicator import *
+
+from helpers import Sink, Device, Wire
+
+
+FEEDBACK = [
+    FEEDBACK_SOURCE_MAP["tv"] + FEEDBACK_MUTE_OFF + bytearray([0x00]),
+    FEEDBACK_VOLUME + bytearray([20]),
+    FEEDBACK_SOUND_FIELD_MAP["afd"],
+    FEEDBACK_SOURCE_MAP["game"] + FEEDBACK_MUTE_OFF + bytearray([0x00]),
+    FEEDBACK_VOLUME + bytearray([22]),
+    FEEDBACK_SOUND_FIELD_MAP["multiStereo"],
+]
+
+# The user commands share their kinds with the feedback, but not their values
+USER_SOURCES = ["bdDvd", "satCaTV"]
+USER_VOLUMES = [30, 31, 32, 33]
+
+
+def main(commands = 1000, frames = 100000):
+    event_loop = EventLoop()
+    event_loop.start()
+    device_service = Device(event_loop)
+    indicator = Sink()
+    state_service = StateService(indicator)
+    state_service.initialized = True
+    command_service = CommandService(device_service, state_service)
+    command_service.initialized = True
+    scheduler = command_service.scheduler
+    wire = Wire()
+    scheduler.get_connection = lambda port: wire
+    watcher = FeedbackWatcher(indicator, device_service, state_service, command_service, TCP_PORT_1)
+    watcher.debug_data = indicator.ignore
+    # Like the radio menu items, which select whatever the feedback reports
+    indicator.update_source = command_service.select_source
+    indicator.update_sound_field = command_service.select_sound_field
+    for name in ("state", "cmd", "send", "sched", "feed"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    def receive(frame):
+        watcher.last_received = event_loop.loop.time()
+        watcher.process_frame(frame)
+
+    done = threading.Event()
+    flooded = 0
+
+    def flood():
+        # Keeps going until the last user command, which restates a report
+        nonlocal flooded
+        while flooded < frames or not done.is_set():
+            event_loop.call(receive, memoryview(bytes(FEEDBACK[flooded % len(FEEDBACK)])))
+            flooded += 1
+            if flooded % 100 == 0:
+                time.sleep(0.001)
+
+    # The state each kind has to end up with on the wire
+    expected = {}
+    started = time.monotonic()
+    flooder = threading.Thread(target = flood)
+    flooder.start()
+    for i in range(commands):
+        step = i % 5
+        if step < 2:
+            command_service.select_source(USER_SOURCES[step])
+            expected["source"] = USER_SOURCES[step]
+        elif step == 2:
+            command_service.set_volume(None, USER_VOLUMES[i // 5 % len(USER_VOLUMES)])
+            expected["volume"] = USER_VOLUMES[i // 5 % len(USER_VOLUMES)]
+        elif step == 3:
+            command_service.mute(None)
+            expected["muted"] = True
+        else:
+            command_service.unmute(None)
+            expected["muted"] = False
+        time.sleep(0.001)
+    done.set()
+    flooder.join()
+    event_loop.run_until_complete(asyncio.sleep(0.5))
+    while scheduler.task != None or command_service.volume_controller.pending != None:
+        time.sleep(0.01)
+    duration = time.monotonic() - started
+    event_loop.kill()
+    event_loop.join(2)
+
+    states = [command_state(frame) for frame in wire.frames]
+    sent = {}
+    echo_frames = 0
+    for kind, value in states:
+        if kind not in expected or (kind == "source" and value not in USER_SOURCES) or (kind == "volume" and value not in USER_VOLUMES):
+            echo_frames += 1
+        else:
+            sent[kind] = value
+    print("%d feedback frames, %d user commands in %.2f s" %(flooded, commands, duration))
+    print("frames sent: %d (superseded while queued: %d)" %(len(states), commands - len(states)))
+    print("echoes recognised: %d, suppressed: %d, sent: %d" %(command_service.echo_tracker.echoes, command_service.echo_tracker.suppressed, echo_frames))
+    print("final state sent: %s, expected: %s" %(sent, expected))
+    assert not METRIC_COMMANDS_DROPPED.values, "commands were dropped from the full send queue"
+    assert echo_frames == 0, "%d echoes of the feedback were sent" %(echo_frames)
+    assert sent == expected, "the last user command of a kind did not reach the wire"
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
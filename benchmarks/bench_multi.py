@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Many simulated receivers handled by one ReceiverRegistry: every simulator
+# pushes unsolicited feedback, commands are routed by device ID. Reports the
+# threads the registry added, the CPU time of the event loop thread (which
+# does all the I/O) and the command latency per receiver.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_multi.py [receivers] [rate] [seconds]
+
+import asyncio
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+from sonyavindicator.indicator import *
+from sonyavindicator.simulator import ReceiverSimulator
+
+
+def start_simulators(count, rate):
+    # All simulators on one event loop of their own, so they do not count
+    # against the registry
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target = loop.run_forever, daemon = True)
+    thread.start()
+    simulators = [ReceiverSimulator((0, 0), rate = rate) for i in range(count)]
+    for simulator in simulators:
+        asyncio.run_coroutine_threadsafe(simulator.start(), loop).result()
+    return loop, thread, simulators
+
+
+def stop_simulators(loop, thread, simulators):
+    for simulator in simulators:
+        asyncio.run_coroutine_threadsafe(simulator.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(2)
+
+
+async def thread_cpu():
+    # CPU seconds of the event loop thread
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main(count = 16, rate = 50.0, seconds = 5.0):
+    logging.getLogger().setLevel(logging.WARNING)
+    loop, thread, simulators = start_simulators(count, rate)
+    event_loop = EventLoop()
+    event_loop.start()
+    registry = ReceiverRegistry(event_loop, DeviceService(event_loop, []))
+    threads = threading.active_count()
+    fds = len(os.listdir("/proc/self/fd"))
+    try:
+        for simulator in simulators:
+            registry.add(simulator.host, *simulator.ports)
+        time.sleep(1.0)
+        threads = threading.active_count() - threads
+        fds = len(os.listdir("/proc/self/fd")) - fds
+
+        frames = sum(simulator.frames_sent for simulator in simulators)
+        cpu = event_loop.run_until_complete(thread_cpu())
+        started = time.perf_counter()
+        time.sleep(seconds)
+        cpu = event_loop.run_until_complete(thread_cpu()) - cpu
+        duration = time.perf_counter() - started
+        frames = sum(simulator.frames_sent for simulator in simulators) - frames
+
+        changed = threading.Event()
+        latencies = []
+        lost = 0
+        for device_id in registry.device_ids():
+            registry.get(device_id).state_service.add_listener(lambda key: key == "volume" and changed.set())
+        for i in range(count * 4):
+            device_id = registry.device_ids()[i % count]
+            changed.clear()
+            started = time.perf_counter()
+            registry.send(device_id, CMD_VOLUME[LOW_VOLUME + i // count % 2 + 1])
+            if changed.wait(2.0):
+                latencies.append(time.perf_counter() - started)
+            else:
+                lost += 1
+    finally:
+        registry.close()
+        event_loop.kill()
+        event_loop.join(2)
+        stop_simulators(loop, thread, simulators)
+
+    latencies.sort()
+    print("%d receivers, %.0f feedback frames/s each" %(count, rate))
+    print("threads added: %d, file descriptors of both ends: %d (%.1f per receiver)" %(threads, fds, fds / count))
+    print("feedback: %.0f frames/s, event loop thread CPU: %.1f %%" %(frames / duration, cpu * 100.0 / duration))
+    if latencies:
+        print("routed commands: %d, lost: %d, p50 %.3f ms, max %.3f ms" %(len(latencies), lost, latencies[len(latencies) // 2] * 1e3, latencies[-1] * 1e3))
+    else:
+        print("routed commands: all %d lost" %(lost))
+
+
+if __name__ == "__main__":
+    main(*[parse(arg) for parse, arg in zip((int, float, float), sys.argv[1:])])
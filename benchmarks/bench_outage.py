@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Supervision of a FeedbackWatcher against the receiver simulator:
+#
+# - idle: connections the simulator accepted and liveness probes it answered
+#   while nothing happens. The link is checked by TCP keepalive on the
+#   established connection and by probes restating the reported mute state.
+# - hung: the simulator keeps the connection but stops answering, like a
+#   receiver whose network stack outlived its firmware. Reports the time
+#   until an unanswered probe made the watcher reconnect.
+# - restart: the simulator closes the connection and stops listening for a
+#   while, like a receiver which restarts. Reports the time until the
+#   watcher noticed, its connect attempts during the outage and the time
+#   until it is up again. Network searches are made to take an hour, they
+#   must neither block the reconnects nor run more than once per outage.
+# - blackhole (as root): the loopback interface goes down and swallows every
+#   packet, like a receiver which lost power. Reports the time until
+#   the first keepalive probe or liveness probe went unanswered and until
+#   the watcher gave up.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_outage.py [outage seconds] [--blackhole]
+
+import asyncio
+import logging
+import subprocess
+import sys
+import time
+
+from sonyavindicator.indicator import *
+from sonyavindicator.simulator import ReceiverSimulator
+
+from helpers import Sink
+
+
+def wait_for_state(watcher, states, timeout):
+    started = time.perf_counter()
+    while watcher.state not in states:
+        if time.perf_counter() - started > timeout:
+            return None
+        time.sleep(0.01)
+    return time.perf_counter() - started
+
+
+def wait_for_timeout(watcher, timeouts, timeout):
+    # The reconnect to a hung receiver is too fast to catch its state
+    started = time.perf_counter()
+    while METRIC_FEEDBACK_TIMEOUTS.values.get(watcher.port, 0) <= timeouts:
+        if time.perf_counter() - started > timeout:
+            return None
+        time.sleep(0.01)
+    return time.perf_counter() - started
+
+
+def format_time(seconds, timeout):
+    return "%.2f s" %(seconds) if seconds != None else "more than %.0f s" %(timeout)
+
+
+def main(outage = 20.0, blackhole = False):
+    logging.getLogger().setLevel(logging.ERROR)
+    simulator = ReceiverSimulator((0, 0), rate = 0)
+    accepted = 0
+    serve = simulator.serve
+
+    async def counting_serve(reader, writer):
+        nonlocal accepted
+        accepted += 1
+        await serve(reader, writer)
+
+    simulator.serve = counting_serve
+    simulator.start_thread()
+    event_loop = EventLoop()
+    event_loop.start()
+    device_service = DeviceService(event_loop, [])
+    device_service.ip = simulator.host
+    device_service.port, device_service.port_2 = simulator.ports
+    searches = 0
+
+    async def discover(ordering = None):
+        # A sweep of a large network
+        nonlocal searches
+        searches += 1
+        await asyncio.sleep(3600)
+        return device_service.ip
+
+    device_service.discover = discover
+    state_service = StateService(Sink())
+    command_service = CommandService(device_service, state_service)
+    for service in (device_service, state_service, command_service):
+        service.initialized = True
+    watcher = FeedbackWatcher(Sink(), device_service, state_service, command_service, simulator.ports[0])
+    watcher.start()
+    try:
+        if wait_for_state(watcher, (CONNECTION_UP,), 5.0) == None:
+            print("not connected")
+            return
+
+        # Makes the receiver report its power and mute state, like at startup
+        watcher.probe_input()
+        time.sleep(1.0)
+        accepted = 0
+        commands = simulator.commands_received
+        muted = simulator.muted
+        time.sleep(12.0)
+        print("idle: %d connections accepted, %d probes answered in 12 s, mute state %s, state %s" %(accepted, simulator.commands_received - commands, "kept" if simulator.muted == muted else "changed", CONNECTION_STATES[watcher.state]))
+
+        timeouts = METRIC_FEEDBACK_TIMEOUTS.values.get(watcher.port, 0)
+        simulator.handle = lambda cmd: None
+        try:
+            detection = wait_for_timeout(watcher, timeouts, 60.0)
+        finally:
+            del simulator.handle
+        recovery = wait_for_state(watcher, (CONNECTION_UP,), 60.0)
+        print("hung: probe unanswered after %s, up again after %s" %(format_time(detection, 60.0), format_time(recovery, 60.0)))
+
+        asyncio.run_coroutine_threadsafe(simulator.stop(), simulator.event_loop).result()
+        detection = wait_for_state(watcher, (CONNECTION_CONNECTING, CONNECTION_DOWN), 60.0)
+        failures = METRIC_FEEDBACK_CONNECT_FAILURES.values.get(watcher.port, 0)
+        time.sleep(outage)
+        attempts = METRIC_FEEDBACK_CONNECT_FAILURES.values.get(watcher.port, 0) - failures
+        asyncio.run_coroutine_threadsafe(simulator.start(), simulator.event_loop).result()
+        recovery = wait_for_state(watcher, (CONNECTION_UP,), 60.0)
+        print("restart: noticed after %s, %d connect attempts in %.0f s (%.1f/s), %d network search, up again after %s" %(format_time(detection, 60.0), attempts, outage, attempts / outage, searches, format_time(recovery, 60.0)))
+
+        if blackhole:
+            timeouts = METRIC_FEEDBACK_TIMEOUTS.values.get(watcher.port, 0)
+            subprocess.check_call(["ip", "link", "set", "lo", "down"])
+            try:
+                # Keepalive or an unanswered probe, whichever is first
+                degraded = wait_for_state(watcher, (CONNECTION_DEGRADED, CONNECTION_CONNECTING, CONNECTION_DOWN), 60.0)
+                state = watcher.state
+                detection = wait_for_timeout(watcher, timeouts, 60.0)
+            finally:
+                subprocess.check_call(["ip", "link", "set", "lo", "up"])
+            recovery = wait_for_state(watcher, (CONNECTION_UP,), 60.0)
+            print("blackhole: %s after %s, given up after %s, up again after %s" %(CONNECTION_STATES[state], format_time(degraded, 60.0), format_time(detection, 60.0), format_time(recovery, 60.0)))
+    finally:
+        watcher.kill()
+        watcher.join(2)
+        command_service.close()
+        event_loop.kill()
+        event_loop.join(2)
+        simulator.stop_thread()
+
+
+if __name__ == "__main__":
+    main(*[float(arg) for arg in sys.argv[1:] if not arg.startswith("--")], blackhole = "--blackhole" in sys.argv)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Replays a feedback capture through both feedback watchers as fast as
+# possible, which profiles the frame decoder, the dispatch and the state
+# updates together. Without a capture file a synthetic one is written:
+# the feedback of the simulator cut at random positions, like TCP does.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_replay.py [capture] [--speed N]
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+
+from sonyavindicator.indicator import *
+from sonyavindicator.capture import CaptureWriter, CaptureReplay, read_capture
+from sonyavindicator.simulator import ReceiverSimulator
+
+
+def write_synthetic(path, chunks):
+    # One stream per port, each one cut on its own like TCP does. Returns
+    # the number of whole frames written.
+    simulator = ReceiverSimulator()
+    generator = random.Random(0)
+    writer = CaptureWriter(path)
+    timestamp = 0.0
+    streams = {TCP_PORT_1: b"", TCP_PORT_2: b""}
+    frames = 0
+    for i in range(chunks):
+        port = TCP_PORT_1 + i % 2
+        simulator.volume = generator.randint(MIN_VOLUME, MAX_VOLUME)
+        simulator.muted = generator.random() < 0.1
+        state_frames = simulator.state_frames()
+        frames += len(state_frames)
+        stream = streams[port] + b"".join(bytes(frame) for frame in state_frames)
+        cut = generator.randint(1, len(stream))
+        timestamp += 0.01
+        writer.record(port, stream[:cut], timestamp)
+        streams[port] = stream[cut:]
+    # The frames still held back were never written
+    for port, stream in streams.items():
+        writer.record(port, stream, timestamp)
+    writer.close()
+    return frames
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Replays a feedback capture through the feedback watchers")
+    parser.add_argument("path", nargs = "?", help = "capture file, a synthetic one if not given")
+    parser.add_argument("--chunks", type = int, default = 100000, help = "records of the synthetic capture")
+    parser.add_argument("--speed", type = float, default = 0.0, help = "0 for as fast as possible")
+    options = parser.parse_args(args)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as capture_dir:
+        path = options.path
+        written = None
+        if path == None:
+            path = os.path.join(capture_dir, "synthetic.cap")
+            written = write_synthetic(path, options.chunks)
+        event_loop = EventLoop()
+        event_loop.start()
+        registry = ReceiverRegistry(event_loop, DeviceService(event_loop, []))
+        receiver = Receiver(registry, "capture", TCP_PORT_1, TCP_PORT_2)
+        receiver.command_service.close()
+        for service in (receiver.device_service, receiver.state_service, receiver.command_service):
+            service.initialized = True
+        frames = [0]
+        for watcher in receiver.feedback_watchers:
+            process_frame = watcher.process_frame
+
+            def counting_process_frame(data, process_frame = process_frame):
+                frames[0] += 1
+                process_frame(data)
+
+            watcher.process_frame = counting_process_frame
+        replay = CaptureReplay(dict((watcher.port, watcher) for watcher in receiver.feedback_watchers), options.speed)
+        try:
+            event_loop.run_until_complete(replay.replay(read_capture(path)))
+        finally:
+            event_loop.kill()
+            event_loop.join(2)
+
+    print("%d records, %d bytes, %d frames in %.3f s" %(replay.records, replay.bytes_fed, frames[0], replay.duration))
+    if written != None:
+        print("synthetic capture: %d frames written, %d unknown" %(written, METRIC_FEEDBACK_UNKNOWN.values.get(None, 0)))
+    print("%.0f records/s, %.0f frames/s, state version %d" %(replay.records / replay.duration, frames[0] / replay.duration, receiver.state_service.snapshot().version))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures the cold start of both modes in fresh interpreters: loading the
+# module for the headless daemon, plus the GUI libraries for the indicator.
+# Connecting to the receiver is not part of it, see DeviceService.locate.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_startup.py [runs]
+
+import os
+import subprocess
+import sys
+
+MODES = [
+    ("headless", "import sonyavindicator.indicator"),
+    ("indicator", "import sonyavindicator.indicator as indicator; indicator.import_gui()"),
+]
+
+PROBE = """
+import time
+started = time.perf_counter()
+%s
+print(time.perf_counter() - started)
+"""
+
+
+def measure(code):
+    result = subprocess.run([sys.executable, "-c", PROBE %(code)], stdout = subprocess.PIPE, stderr = subprocess.PIPE, env = os.environ)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.decode("utf-8").split()[-1])
+
+
+def main(runs = 10):
+    for name, code in MODES:
+        timings = [measure(code) for run in range(runs)]
+        if None in timings:
+            print("%-10s unavailable" %(name))
+        else:
+            print("%-10s %8.1f ms (best of %d) %8.1f ms (median)" %(name, min(timings) * 1e3, runs, sorted(timings)[len(timings) // 2] * 1e3))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
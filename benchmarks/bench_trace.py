@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-frame cost of tracing the frames: the hexlified DEBUG logging the
+# module used to force on, the same code with DEBUG switched off (which
+# still formatted every frame), the remaining guarded debug logging and the
+# trace ring buffer which is always on.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_trace.py [frames]
+
+import binascii
+import logging
+import os
+import sys
+import time
+
+from sonyavindicator.codec import *
+from sonyavindicator.capture import TraceBuffer, TRACE_IN, TRACE_OUT
+
+
+def measure(name, function, frames):
+    started = time.perf_counter()
+    for frame in frames:
+        function(frame)
+    duration = time.perf_counter() - started
+    print("%-28s %8.3f us/frame" %(name, duration * 1e6 / len(frames)))
+
+
+def main(count = 200000):
+    received = memoryview(b"".join([FEEDBACK_VOLUME + bytes([20]), FEEDBACK_SOURCE_MAP["tv"] + bytes([0x11, 0x00]), FEEDBACK_SOUND_FIELD_MAP["afd"]]))
+    inbound = [received[0:8], received[8:17], received[17:23]] * (count // 3)
+    outbound = [CMD_VOLUME[20], CMD_MUTE, CMD_SOURCE_MAP["tv"]] * (count // 3)
+
+    with open(os.devnull, "w") as devnull:
+        handler = logging.StreamHandler(devnull)
+        handler.setFormatter(logging.Formatter("%(asctime)-15s [%(name)-5s] [%(levelname)-5s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+        recv_logger = logging.getLogger("bench.recv")
+        send_logger = logging.getLogger("bench.send")
+        for logger in (recv_logger, send_logger):
+            logger.addHandler(handler)
+            logger.propagate = False
+
+        # The logging as it was written before the trace: formatted eagerly
+        # on every frame, whether DEBUG is enabled or not
+        def log_received(data):
+            recv_logger.debug("%s%s" %("", binascii.hexlify(data)))
+
+        def log_sent(cmd):
+            send_logger.debug("%s", ", ".join([hex(byte) for byte in cmd]))
+
+        # The remaining debug logging, only formatted with DEBUG enabled
+        def log_received_guarded(data):
+            if recv_logger.isEnabledFor(logging.DEBUG):
+                recv_logger.debug("%s%s" %("", binascii.hexlify(data)))
+
+        for level, name in ((logging.DEBUG, "DEBUG on"), (logging.INFO, "DEBUG off")):
+            recv_logger.setLevel(level)
+            send_logger.setLevel(level)
+            measure("log received, %s" %(name), log_received, inbound)
+            measure("log sent, %s" %(name), log_sent, outbound)
+        measure("guarded log, DEBUG off", log_received_guarded, inbound)
+
+    trace = TraceBuffer()
+    measure("trace received", lambda data: trace.record(TRACE_IN, TCP_PORT_1, bytes(data)), inbound)
+    measure("trace sent", lambda cmd: trace.record(TRACE_OUT, TCP_PORT_1, cmd), outbound)
+    started = time.perf_counter()
+    dump = trace.dump()
+    print("dump of %d frames            %8.3f ms" %(len(dump.split("\n")), (time.perf_counter() - started) * 1e3))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Spins the volume wheel in bursts and counts the volume frames the
+# VolumeController actually sends to the receiver. Without coalescing every
+# scroll tick would be one frame.
+#
+#   PYTHONPATH=. python3 benchmarks/bench_volume.py [ticks] [ticks/s]
+
+import sys
+import time
+
+from sonyavindicator.indicator import *
+
+from helpers import Sink, Device
+
+
+class Receiver():
+
+    frames = 0
+
+    def send_command(self, cmd):
+        self.frames += 1
+
+
+def main(ticks = 100, tick_rate = 200.0):
+    event_loop = EventLoop()
+    event_loop.start()
+    device_service = Device(event_loop)
+    receiver = Receiver()
+    command_service = CommandService(device_service, Sink())
+    command_service.send_command = receiver.send_command
+    controller = command_service.volume_controller
+
+    started = time.monotonic()
+    volume = MIN_VOLUME
+    for tick in range(ticks):
+        volume = volume + 1 if volume < LIMIT_VOLUME else MIN_VOLUME
+        controller.set_target(volume)
+        time.sleep(1.0 / tick_rate)
+    duration = time.monotonic() - started
+    # Give the last pending frame the time to go out
+    time.sleep(2.0 / controller.max_rate)
+    event_loop.kill()
+    event_loop.join(2)
+
+    bound = int(duration * controller.max_rate) + 2
+    print("%d ticks in %.2f s: %d frames sent (at most %d at %.0f frames/s)" %(ticks, duration, receiver.frames, bound, controller.max_rate))
+    if receiver.frames > bound or controller.sent != volume:
+        print("FAILED")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(main(*[cast(arg) for cast, arg in zip((int, float), args)]))
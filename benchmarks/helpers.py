@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# Stand-ins for the parts of the indicator the benchmarks and tests do not
+# exercise. The scripts in this directory import them with
+#
+#   from helpers import Sink, Device, Wire
+
+from sonyavindicator.codec import TCP_PORT_1, TCP_PORT_2
+
+
+class Sink():
+
+    # Accepts and ignores any call, like an indicator without a user interface
+
+    def __getattr__(self, key):
+        return self.ignore
+
+    def ignore(self, *args):
+        pass
+
+
+class Device():
+
+    # A DeviceService which knows its receiver without discovery
+
+    ip = "127.0.0.1"
+    port = TCP_PORT_1
+    port_2 = TCP_PORT_2
+
+    def __init__(self, event_loop):
+        self.event_loop = event_loop
+
+
+class Wire():
+
+    # A CommandConnection recording the frames instead of sending them
+
+    def __init__(self):
+        self.frames = []
+
+    async def write(self, cmd):
+        self.frames.append(bytes(cmd))
+        return True
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks that FrameDecoder finds the frames in a stream split at any point
+# and resynchronises after garbage, like a length byte no frame can have.
+#
+#   PYTHONPATH=. python3 benchmarks/test_decoder.py
+#   PYTHONPATH=. python3 -m pytest benchmarks/test_decoder.py
+
+from sonyavindicator.codec import *
+
+
+FRAMES = [
+    FEEDBACK_SOURCE_MAP["tv"] + FEEDBACK_MUTE_OFF + bytes([0x00]),
+    FEEDBACK_VOLUME + bytes([20]),
+    FEEDBACK_SOUND_FIELD_MAP["afd"],
+    FEEDBACK_FMTUNER_PREFIX + bytes([1, 0x00, 0x24, 0x2e]),
+    FEEDBACK_PURE_DIRECT_ON,
+]
+
+
+def decode(chunks):
+    decoder = FrameDecoder()
+    frames = []
+    for chunk in chunks:
+        frames.extend(bytes(frame) for frame in decoder.feed(chunk))
+    return frames, len(decoder.buffer)
+
+
+def test_frames():
+    assert decode([b"".join(FRAMES)]) == (FRAMES, 0)
+
+
+def test_split_frames():
+    data = b"".join(FRAMES)
+    for size in range(1, 10):
+        assert decode([data[i:i + size] for i in range(0, len(data), size)]) == (FRAMES, 0)
+
+
+def test_garbage_between_frames():
+    assert decode([b"\x55\xaa" + FRAMES[0] + b"\x00" + FRAMES[1]]) == (FRAMES[:2], 0)
+
+
+def test_length_too_large():
+    # Would otherwise wait for 255 more bytes and hold back the frames
+    assert decode([b"\x02\xff" + b"".join(FRAMES)]) == (FRAMES, 0)
+    assert decode([b"\x02\xff", b"".join(FRAMES)]) == (FRAMES, 0)
+    assert decode([b"\x02", b"\xff"] + FRAMES) == (FRAMES, 0)
+
+
+def test_incomplete_frame():
+    assert decode([FRAMES[0] + FRAMES[1][:3]]) == (FRAMES[:1], 3)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s: ok" %(name))
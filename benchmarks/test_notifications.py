@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks which bubbles the NotificationDispatcher shows for a burst of
+# notifications: related ones collapse into the last of them, unrelated ones
+# keep their own bubble.
+#
+#   PYTHONPATH=. python3 benchmarks/test_notifications.py
+#   PYTHONPATH=. python3 -m pytest benchmarks/test_notifications.py
+
+import time
+
+from sonyavindicator.indicator import *
+
+
+def dispatch(notifications):
+    shown = []
+    dispatcher = NotificationDispatcher(lambda title, text, icon, group: shown.append((group, title, text)))
+    dispatcher.start()
+    for category, title, text in notifications:
+        dispatcher.post(category, title, text, None)
+    time.sleep(dispatcher.max_delay + 0.5)
+    dispatcher.kill()
+    dispatcher.join(2)
+    assert dispatcher.depth == 0
+    return sorted(shown)
+
+
+def test_related_collapse():
+    shown = dispatch([
+        ("muted", "Muted", ""),
+        ("muted", "Unmuted", ""),
+        ("power", "Power ON", ""),
+        ("source", "Source", "TV"),
+    ])
+    assert shown == [("muted", "Unmuted", ""), ("power", "Source", "TV")]
+
+
+def test_unrelated_keep_their_bubble():
+    shown = dispatch([
+        ("timer", "Timer SET", "1:30"),
+        ("sound_field", "Sound Field", "AFD"),
+        ("fmtuner", "FM Tuner", "88.60 MHz"),
+    ])
+    assert shown == [("fmtuner", "FM Tuner", "88.60 MHz"), ("sound_field", "Sound Field", "AFD"), ("timer", "Timer SET", "1:30")]
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s: ok" %(name))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks the order in which the CommandScheduler puts commands on the wire.
+# Power and mute overtake the other queued commands, but a power off must not
+# overtake the commands which switch the receiver on again. Commands restating
+# a report are echoes only when sent by the handlers of that report.
+#
+#   PYTHONPATH=. python3 benchmarks/test_scheduler.py
+#   PYTHONPATH=. python3 -m pytest benchmarks/test_scheduler.py
+
+import time
+
+from sonyavindicator.indicator import *
+
+from helpers import Device, Wire
+
+
+def run_scheduler(enqueue):
+    # Queues the commands in one go on the event loop, so none of them is
+    # sent before the others are queued, and returns the frames sent
+    event_loop = EventLoop()
+    event_loop.start()
+    try:
+        scheduler = CommandScheduler(Device(event_loop), EchoTracker())
+        wire = Wire()
+        scheduler.get_connection = lambda port: wire
+        event_loop.call(enqueue, scheduler)
+        time.sleep(0.1)
+        while scheduler.task != None:
+            time.sleep(0.01)
+        return wire.frames
+    finally:
+        event_loop.kill()
+        event_loop.join(2)
+
+
+def test_power_off_after_source():
+    def enqueue(scheduler):
+        scheduler.enqueue(bytes(CMD_SOURCE_MAP["game"]), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_POWER_OFF), TCP_PORT_1)
+    assert run_scheduler(enqueue) == [bytes(CMD_POWER_OFF)]
+
+
+def test_power_off_discards_powering_commands():
+    def enqueue(scheduler):
+        scheduler.enqueue(bytes(CMD_VOLUME[20]), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_SOUND_FIELD_MAP["afd"]), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_HDMIOUT_ON), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_SOURCE_MAP["tv"]), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_POWER_OFF), TCP_PORT_1)
+    frames = run_scheduler(enqueue)
+    assert frames == [bytes(CMD_POWER_OFF), bytes(CMD_VOLUME[20])]
+
+
+def test_power_off_keeps_other_zones_and_ports():
+    def enqueue(scheduler):
+        scheduler.enqueue(bytes(with_zone(CMD_SOURCE_MAP["tv"], ZONE_2)), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_SOURCE_MAP["game"]), TCP_PORT_2)
+        scheduler.enqueue(bytes(CMD_POWER_OFF), TCP_PORT_1)
+    frames = run_scheduler(enqueue)
+    assert frames == [bytes(CMD_POWER_OFF), bytes(with_zone(CMD_SOURCE_MAP["tv"], ZONE_2)), bytes(CMD_SOURCE_MAP["game"])]
+
+
+def test_source_after_power_off():
+    # Switches the receiver on again, so it stays queued behind the power off
+    def enqueue(scheduler):
+        scheduler.enqueue(bytes(CMD_POWER_OFF), TCP_PORT_1)
+        scheduler.enqueue(bytes(CMD_SOURCE_MAP["game"]), TCP_PORT_1)
+    assert run_scheduler(enqueue) == [bytes(CMD_POWER_OFF), bytes(CMD_SOURCE_MAP["game"])]
+
+
+def test_user_command_restating_report():
+    # Like the user unmuting right after the receiver reported unmuted
+    def enqueue(scheduler):
+        scheduler.echo_tracker.received(SourceEvent("tv", True, False), scheduler.event_loop.loop.time())
+        scheduler.submit(CMD_UNMUTE, TCP_PORT_1)
+    assert run_scheduler(enqueue) == [bytes(CMD_UNMUTE)]
+
+
+def test_echo_of_report():
+    # Like the mute menu item following the report it is dispatched
+    def enqueue(scheduler):
+        scheduler.echo_tracker.received(SourceEvent("tv", True, False), scheduler.event_loop.loop.time())
+        scheduler.echo_tracker.dispatching = True
+        scheduler.submit(CMD_UNMUTE, TCP_PORT_1)
+        scheduler.echo_tracker.dispatching = False
+    assert run_scheduler(enqueue) == []
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s: ok" %(name))
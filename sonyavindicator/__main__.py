@@ -2,12 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import argparse
 import logging
-import requests
 try:
-    from indicator import SonyAvIndicator
+    from indicator import SonyAvIndicator, SonyAvDaemon
 except:
-    from sonyavindicator.indicator import SonyAvIndicator
+    from sonyavindicator.indicator import SonyAvIndicator, SonyAvDaemon
 
 logging.basicConfig(level = logging.INFO, format = "%(asctime)-15s [%(name)-5s] [%(levelname)-5s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 logging.getLogger('requests').setLevel(logging.CRITICAL)
@@ -17,11 +17,23 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    sony_av_indicator = SonyAvIndicator()
-    sony_av_indicator.main()
+    parser = argparse.ArgumentParser(prog = "sonyavindicator", description = "Controls a Sony AV receiver on the local network")
+    parser.add_argument("--headless", action = "store_true", help = "run without the indicator, notifications are logged")
+    parser.add_argument("--no-mpris", dest = "mpris", action = "store_false", help = "do not register the MPRIS interface (headless only)")
+    parser.add_argument("--all-receivers", action = "store_true", help = "also follow every other receiver in the network (headless only)")
+    parser.add_argument("--capture", metavar = "FILE", help = "append the feedback as received to FILE, see sonyavindicator.capture")
+    parser.add_argument("--metrics-port", metavar = "PORT", type = int, help = "serve metrics in the Prometheus text format on 127.0.0.1:PORT")
+    parser.add_argument("--debug", action = "store_true", help = "log debug messages, SIGUSR1 logs the last frames sent and received")
+    options = parser.parse_args(args)
+
+    if options.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
 
-    # Do argument parsing here (eg. with argparse) and anything else
-    # you want your project to do.
+    if options.headless:
+        sony_av_indicator = SonyAvDaemon(options.mpris, options.all_receivers, options.capture, options.metrics_port)
+    else:
+        sony_av_indicator = SonyAvIndicator(options.capture, options.metrics_port)
+    sony_av_indicator.main()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Captures the feedback of the receiver exactly as it arrives on ports
+# 33335 and 33336 and replays it into the feedback watchers, at the
+# original speed, faster or as fast as possible:
+#
+#   python3 -m sonyavindicator --headless --capture session.cap
+#   python3 -m sonyavindicator.capture session.cap --speed 0
+#
+# The file starts with CAPTURE_MAGIC, followed by one record per received
+# chunk: timestamp (float64 seconds), port (uint16), length (uint16) and the
+# data. A chunk may hold a part of a frame or several frames.
+#
+# Independent of that, TRACE keeps the last frames sent and received in
+# memory, to be dumped on demand (SIGUSR1 or D-Bus).
+
+import argparse
+import asyncio
+import logging
+import struct
+import time
+
+CAPTURE_MAGIC = b"SAVCAP1\n"
+CAPTURE_RECORD = struct.Struct("<dHH")
+CAPTURE_BUFFER_SIZE = 65536
+
+TRACE_IN = 0
+TRACE_OUT = 1
+TRACE_DIRECTIONS = ("in", "out")
+
+
+class CaptureWriter():
+
+    path = None
+    capture_file = None
+    loop = None
+    timer = None
+    records = 0
+    last_flush = 0.0
+
+    # The buffer is written at most this long after a record, a killed
+    # process only loses the last seconds
+    flush_interval = 2.0
+
+    logger = logging.getLogger("cap")
+
+    def __init__(self, path, loop = None):
+        # Appends to an existing capture. Given the asyncio loop the records
+        # are written on, a flush is scheduled on it after a record, else the
+        # next record after flush_interval flushes.
+        self.path = path
+        self.loop = loop
+        self.capture_file = open(path, "ab", CAPTURE_BUFFER_SIZE)
+        if self.capture_file.tell() == 0:
+            self.capture_file.write(CAPTURE_MAGIC)
+
+    def record(self, port, data, timestamp = None):
+        # Called on the event loop thread, the buffered file only writes
+        # when CAPTURE_BUFFER_SIZE bytes were collected or on a flush
+        if self.capture_file == None:
+            return
+        if timestamp == None:
+            timestamp = time.time()
+        self.capture_file.write(CAPTURE_RECORD.pack(timestamp, port, len(data)))
+        self.capture_file.write(data)
+        self.records += 1
+        if self.loop != None:
+            if self.timer == None:
+                self.timer = self.loop.call_later(self.flush_interval, self.flush)
+        elif timestamp - self.last_flush >= self.flush_interval:
+            self.last_flush = timestamp
+            self.capture_file.flush()
+
+    def flush(self):
+        self.timer = None
+        if self.capture_file != None:
+            self.capture_file.flush()
+
+    def close(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        if self.capture_file != None:
+            self.capture_file.close()
+            self.capture_file = None
+            self.logger.info("Captured %d records to %s" %(self.records, self.path))
+
+
+class TraceBuffer():
+
+    # Ring buffer of the last size frames as (timestamp, direction, port,
+    # frame). Recording stores the frame bytes as they are, they are only
+    # formatted when dumped.
+
+    entries = None
+    next = 0
+    mask = 0
+
+    def __init__(self, size = 4096):
+        # Rounded up to a power of two, so the index wraps with a mask
+        size = 1 << max(size - 1, 1).bit_length()
+        self.entries = [None] * size
+        self.mask = size - 1
+
+    def record(self, direction, port, frame):
+        # Called on the event loop thread, frame must be bytes
+        self.entries[self.next] = (time.time(), direction, port, frame)
+        self.next = (self.next + 1) & self.mask
+
+    def snapshot(self):
+        # The entries from the oldest to the newest
+        entries = list(self.entries)
+        start = self.next
+        return [entry for entry in entries[start:] + entries[:start] if entry != None]
+
+    def dump(self):
+        lines = []
+        for timestamp, direction, port, frame in self.snapshot():
+            lines.append("%s.%03d %-3s %5d %s" %(time.strftime("%H:%M:%S", time.localtime(timestamp)), int(timestamp * 1000) % 1000, TRACE_DIRECTIONS[direction], port, frame.hex()))
+        return "\n".join(lines)
+
+
+# The frames of the process
+TRACE = TraceBuffer()
+
+
+def read_capture(path):
+    # Yields (timestamp, port, data) for every record of the capture
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("Not a capture file: %s" %(path))
+        while True:
+            header = capture_file.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            timestamp, port, size = CAPTURE_RECORD.unpack(header)
+            data = capture_file.read(size)
+            if len(data) < size:
+                # Cut off while capturing
+                return
+            yield timestamp, port, data
+
+
+class CaptureReplay():
+
+    # Feeds the records of a capture to the watcher of their port. speed 1
+    # keeps the original timing, 10 is ten times as fast and 0 does not wait
+    # at all.
+
+    watchers = None
+    speed = 1.0
+    records = 0
+    bytes_fed = 0
+    skipped = 0
+    duration = None
+
+    logger = logging.getLogger("cap")
+
+    def __init__(self, watchers, speed = None):
+        # watchers: port -> object with feed(data), e.g. FeedbackWatcher
+        self.watchers = watchers
+        if speed != None:
+            self.speed = speed
+
+    async def replay(self, records):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        first = None
+        for timestamp, port, data in records:
+            if self.speed > 0:
+                if first == None:
+                    first = timestamp
+                delay = started + (timestamp - first) / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            watcher = self.watchers.get(port)
+            if watcher == None:
+                self.skipped += 1
+                continue
+            watcher.feed(data)
+            self.records += 1
+            self.bytes_fed += len(data)
+        self.duration = loop.time() - started
+        return self.records
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(prog = "sonyavindicator.capture", description = "Replays a feedback capture without a receiver")
+    parser.add_argument("path", help = "capture file written with --capture")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "1 for the original timing, N for N times as fast, 0 for as fast as possible")
+    options = parser.parse_args(args)
+
+    try:
+        from indicator import EventLoop, ReceiverRegistry, Receiver, DeviceService, TCP_PORT_1, TCP_PORT_2
+    except ImportError:
+        from sonyavindicator.indicator import EventLoop, ReceiverRegistry, Receiver, DeviceService, TCP_PORT_1, TCP_PORT_2
+
+    event_loop = EventLoop()
+    event_loop.start()
+    registry = ReceiverRegistry(event_loop, DeviceService(event_loop, []))
+    receiver = Receiver(registry, "capture", TCP_PORT_1, TCP_PORT_2)
+    # No receiver to send commands to
+    receiver.command_service.close()
+    for service in (receiver.device_service, receiver.state_service, receiver.command_service):
+        service.initialized = True
+    replay = CaptureReplay(dict((watcher.port, watcher) for watcher in receiver.feedback_watchers), options.speed)
+    try:
+        event_loop.run_until_complete(replay.replay(read_capture(options.path)))
+    finally:
+        event_loop.kill()
+        event_loop.join(2)
+    print("%d records, %d bytes in %.3f s (%.0f records/s), %d skipped" %(replay.records, replay.bytes_fed, replay.duration, replay.records / replay.duration if replay.duration > 0 else 0.0, replay.skipped))
+    print(receiver.state_service.snapshot())
+
+
+if __name__ == "__main__":
+    main()
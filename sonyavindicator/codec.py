@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The protocol of the Sony AV receivers on ports 33335 and 33336. Commands
+# are precomputed immutable frames built by encode_command(), feedback frames
+# are decoded by decode_feedback() into small event objects.
+
+import binascii
+import logging
+import struct
+
+# 80, 5000, 8008, 8009, 10000, 22222, 33335, 33336, 35275, 41824, 50001, 50002, 52323, 54400
+TCP_PORT_1 = 33335
+TCP_PORT_2 = 33336
+
+# Every frame starts with 0x02 followed by the number of bytes after the header
+FRAME_START = 0x02
+FRAME_HEADER_SIZE = 2
+# The longest known frame has 9 bytes, a longer length is a 0x02 in garbage
+MAX_FRAME_SIZE = 16
+
+# Command classes and opcodes (bytes 2 and 3 of a command)
+CMD_CLASS_MAIN            = 0xA0
+CMD_CLASS_TUNER           = 0xA1
+CMD_CLASS_AUDIO           = 0xA3
+
+OP_SOURCE                 = 0x42
+OP_MUTE                   = 0x53
+OP_POWER                  = 0x60
+OP_HDMIOUT                = 0x45
+OP_SOUND_FIELD            = 0x42
+OP_FMTUNER                = 0x42
+OP_FMTUNER_PRESET_UP      = 0x0B
+OP_FMTUNER_PRESET_DOWN    = 0x0C
+OP_VOLUME                 = 0x52
+OP_VOLUME_UP              = 0x55
+OP_VOLUME_DOWN            = 0x56
+
+# Byte 5 (0x00) seems to be the zone (not STR-DN-860, but maybe STR-DN-1060).
+# The numbers of zone 2 and 3 follow the main zone, they are not confirmed.
+ZONE_MAIN = 0x00
+ZONE_2 = 0x01
+ZONE_3 = 0x02
+ZONES = (ZONE_MAIN, ZONE_2, ZONE_3)
+
+VOLUME_STEPS = 75
+
+
+def checksum(data):
+    # The bytes after the start byte, including the checksum, add up to zero
+    return -sum(data) & 0xFF
+
+
+def encode_command(command_class, opcode, payload = b"", zone = None, with_checksum = False):
+    # Builds a command frame. The length counts the class, opcode, zone and
+    # payload. The last byte is the checksum, but the receiver accepts zero
+    # as well, which is what the official app sends for most commands.
+    body = bytes([command_class, opcode]) + (bytes([zone]) if zone != None else b"") + bytes(payload)
+    frame = bytes([FRAME_START, len(body)]) + body
+    return frame + bytes([checksum(frame[1:]) if with_checksum else 0x00])
+
+
+CMD_SOURCE_BYTES = {
+    "bdDvd":                0x1B,
+    "game":                 0x1C,
+    "satCaTV":              0x16,
+    "video":                0x10,
+    "tv":                   0x1A,
+    "saCd":                 0x02,
+    # "hdmi1":              0x21,
+    # "hdmi2":              0x22,
+    # "hdmi3":              0x23,
+    # "hdmi4":              0x24,
+    # "hdmi5":              0x25,
+    # "hdmi6":              0x26,
+    "fmTuner":              0x2E,
+    "amTuner":              0x2F,
+    # "shoutcast":          0x32,
+    "bluetooth":            0x33,
+    "usb":                  0x34,
+    "homeNetwork":          0x3D,
+    "internetServices":     0x3E,
+    "screenMirroring":      0x40,
+    "googleCast":           0xFF,
+}
+
+CMD_SOURCE_MAP = dict((source, encode_command(CMD_CLASS_MAIN, OP_SOURCE, [source_byte], ZONE_MAIN)) for source, source_byte in CMD_SOURCE_BYTES.items())
+
+CMD_MUTE                  = encode_command(CMD_CLASS_MAIN, OP_MUTE, [0x01], ZONE_MAIN)
+CMD_UNMUTE                = encode_command(CMD_CLASS_MAIN, OP_MUTE, [0x00], ZONE_MAIN)
+
+CMD_POWER_ON              = encode_command(CMD_CLASS_MAIN, OP_POWER, [0x01], ZONE_MAIN)
+CMD_POWER_OFF             = encode_command(CMD_CLASS_MAIN, OP_POWER, [0x00], ZONE_MAIN)
+
+CMD_HDMIOUT_ON            = encode_command(CMD_CLASS_MAIN, OP_HDMIOUT, [0x00])
+CMD_HDMIOUT_OFF           = encode_command(CMD_CLASS_MAIN, OP_HDMIOUT, [0x03])
+
+CMD_SOUND_FIELD_BYTES = {
+    "twoChannelStereo":     0x00,
+    "analogDirect":         0x02,
+    "multiStereo":          0x27,
+    "afd":                  0x21,
+    "pl2Movie":             0x23,
+    "neo6Cinema":           0x25,
+    "hdDcs":                0x33,
+    "pl2Music":             0x24,
+    "neo6Music":            0x26,
+    "concertHallA":         0x1E,
+    "concertHallB":         0x1F,
+    "concertHallC":         0x38,
+    "jazzClub":             0x16,
+    "liveConcert":          0x19,
+    "stadium":              0x1B,
+    "sports":               0x20,
+    "portableAudio":        0x30,
+}
+
+CMD_SOUND_FIELD_MAP = dict((sound_field, encode_command(CMD_CLASS_AUDIO, OP_SOUND_FIELD, [sound_field_byte])) for sound_field, sound_field_byte in CMD_SOUND_FIELD_BYTES.items())
+
+# not working ? only preset up and down are working currently
+CMD_FMTUNER = tuple(encode_command(CMD_CLASS_TUNER, OP_FMTUNER, [0x01, preset], with_checksum = True) for preset in range(1, 4))
+
+# The official app sends a zero byte after these
+CMD_FMTUNER_PRESET_DOWN   = encode_command(CMD_CLASS_TUNER, OP_FMTUNER_PRESET_DOWN, with_checksum = True) + b"\x00"
+CMD_FMTUNER_PRESET_UP     = encode_command(CMD_CLASS_TUNER, OP_FMTUNER_PRESET_UP, with_checksum = True) + b"\x00"
+
+# CMD_VOLUME[vol] sets the volume to vol
+CMD_VOLUME                = tuple(encode_command(CMD_CLASS_MAIN, OP_VOLUME, [0x03, 0x00, vol], ZONE_MAIN) for vol in range(VOLUME_STEPS))
+CMD_VOLUME_MIN            = CMD_VOLUME[0]
+CMD_VOLUME_MAX            = CMD_VOLUME[-1]
+CMD_VOLUME_UP             = encode_command(CMD_CLASS_MAIN, OP_VOLUME_UP, zone = ZONE_MAIN)
+CMD_VOLUME_DOWN           = encode_command(CMD_CLASS_MAIN, OP_VOLUME_DOWN, zone = ZONE_MAIN)
+
+# three bytes follows:
+# - hours
+# - minutes
+# - seconds
+# if hours, minutes and seconds are 0xFF, the timer was set to OFF
+FEEDBACK_TIMER_PREFIX     = bytes([0x02, 0x05, 0xA8, 0x90])
+FEEDBACK_TIMER_SET        = bytes([0x00])
+FEEDBACK_TIMER_UPDATE     = bytes([0x3B])
+FEEDBACK_TIMER_OFF        = bytes([0xFF])
+
+# "video" == Google Cast + Bluetooth
+# two bytes follows:
+# - power off / unmuted / muted
+# - zero byte
+# byte 5 normally 0x00, but seldom 0x03
+FEEDBACK_SOURCE_MAP = {
+    "bdDvd":                bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x1B, 0x00]),
+    "game":                 bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x1C, 0x00]),
+    "satCaTV":              bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x16, 0x00]),
+    "video":                bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0xFF, 0x00]),
+    "tv":                   bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x1A, 0x00]),
+    "saCd":                 bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x02, 0x00]),
+    "fmTuner":              bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x2E, 0x00]),
+    "amTuner":              bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x2F, 0x00]),
+    "bluetooth":            bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x33, 0x00]),
+    "usb":                  bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x34, 0x00]),
+    "homeNetwork":          bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x3D, 0x00]),
+    "internetServices":     bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x3E, 0x00]),
+    "screenMirroring":      bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0x40, 0x00]),
+    "googleCast":           bytes([0x02, 0x07, 0xA8, 0x82, 0x00, 0xFF, 0x00]),
+}
+FEEDBACK_POWER_OFF        = bytes([0x10])
+FEEDBACK_MUTE_OFF         = bytes([0x11])
+FEEDBACK_MUTE_ON          = bytes([0x13])
+
+FEEDBACK_SOUND_FIELD_MAP = {
+    "twoChannelStereo":     bytes([0x02, 0x04, 0xAB, 0x82, 0x00, 0x00]),
+    "analogDirect":         bytes([0x02, 0x04, 0xAB, 0x82, 0x02, 0x00]),
+    "multiStereo":          bytes([0x02, 0x04, 0xAB, 0x82, 0x27, 0x00]),
+    "afd":                  bytes([0x02, 0x04, 0xAB, 0x82, 0x21, 0x00]),
+    "pl2Movie":             bytes([0x02, 0x04, 0xAB, 0x82, 0x23, 0x00]),
+    "neo6Cinema":           bytes([0x02, 0x04, 0xAB, 0x82, 0x25, 0x00]),
+    "hdDcs":                bytes([0x02, 0x04, 0xAB, 0x82, 0x33, 0x00]),
+    "pl2Music":             bytes([0x02, 0x04, 0xAB, 0x82, 0x24, 0x00]),
+    "neo6Music":            bytes([0x02, 0x04, 0xAB, 0x82, 0x26, 0x00]),
+    "concertHallA":         bytes([0x02, 0x04, 0xAB, 0x82, 0x1E, 0x00]),
+    "concertHallB":         bytes([0x02, 0x04, 0xAB, 0x82, 0x1F, 0x00]),
+    "concertHallC":         bytes([0x02, 0x04, 0xAB, 0x82, 0x38, 0x00]),
+    "jazzClub":             bytes([0x02, 0x04, 0xAB, 0x82, 0x16, 0x00]),
+    "liveConcert":          bytes([0x02, 0x04, 0xAB, 0x82, 0x19, 0x00]),
+    "stadium":              bytes([0x02, 0x04, 0xAB, 0x82, 0x1B, 0x00]),
+    "sports":               bytes([0x02, 0x04, 0xAB, 0x82, 0x20, 0x00]),
+    "portableAudio":        bytes([0x02, 0x04, 0xAB, 0x82, 0x30, 0x00]),
+}
+
+FEEDBACK_PURE_DIRECT_ON   = bytes([0x02, 0x03, 0xAB, 0x98, 0x01])
+FEEDBACK_PURE_DIRECT_OFF  = bytes([0x02, 0x03, 0xAB, 0x98, 0x00])
+
+# one byte follows
+FEEDBACK_SOUND_OPTIMIZER_PREFIX = bytes([0x02, 0x04, 0xAB, 0x92, 0x48])
+FEEDBACK_SOUND_OPTIMIZER_OFF    = bytes([0x00])
+FEEDBACK_SOUND_OPTIMIZER_NORMAL = bytes([0x01])
+FEEDBACK_SOUND_OPTIMIZER_LOW    = bytes([0x02])
+
+FEEDBACK_FMTUNER_PREFIX   = bytes([0x02, 0x07, 0xA9, 0x82, 0x80])
+FEEDBACK_FMTUNER_STEREO   = bytes([0x00])
+FEEDBACK_FMTUNER_MONO     = bytes([0x80])
+
+FEEDBACK_VOLUME           = bytes([0x02, 0x06, 0xA8, 0x8b, 0x00, 0x03, 0x00])
+
+FEEDBACK_AUTO_STANDBY_ON  = bytes([0x02, 0x03, 0xA8, 0xA4, 0xCC])
+FEEDBACK_AUTO_STANDBY_OFF = bytes([0x02, 0x03, 0xA8, 0xA4, 0x4C])
+
+FEEDBACK_AUTO_PHASE_MATCHING_AUTO = bytes([0x2, 0x4, 0xab, 0x97, 0x48, 0x2])
+FEEDBACK_AUTO_PHASE_MATCHING_OFF  = bytes([0x2, 0x4, 0xab, 0x97, 0x48, 0x0])
+
+# Feedback frames are identified by the command class and opcode (bytes 2 and 3)
+def feedback_key(frame):
+    return frame[2] << 8 | frame[3]
+
+# Commands are identified by the command class and opcode as well
+def command_key(cmd):
+    return cmd[2] << 8 | cmd[3]
+
+# Commands carrying the zone in byte 5
+ZONED_COMMANDS = frozenset([
+    command_key(CMD_SOURCE_MAP["bdDvd"]),
+    command_key(CMD_MUTE),
+    command_key(CMD_POWER_ON),
+    command_key(CMD_VOLUME_MIN),
+    command_key(CMD_VOLUME_UP),
+    command_key(CMD_VOLUME_DOWN),
+])
+
+def command_zone(cmd):
+    # Returns the zone a command addresses, None if it has no zone
+    if command_key(cmd) in ZONED_COMMANDS:
+        return cmd[4]
+    return None
+
+def with_zone(cmd, zone):
+    # Returns the command for another zone. The zoned commands are sent
+    # without checksum, so only the zone byte changes.
+    if command_key(cmd) not in ZONED_COMMANDS:
+        raise ValueError("Command has no zone: %s" %(binascii.hexlify(cmd)))
+    if cmd[4] == zone:
+        return cmd
+    return cmd[:4] + bytes([zone]) + cmd[5:]
+
+def feedback_zone(frame):
+    # Source and volume feedback report the zone in byte 5 as well. Other
+    # values show up there now and then, those are the main zone.
+    zone = frame[4]
+    return zone if zone in ZONES else ZONE_MAIN
+
+CMD_SOURCE_NAMES = dict((source_byte, source) for source, source_byte in CMD_SOURCE_BYTES.items())
+CMD_SOUND_FIELD_NAMES = dict((sound_field_byte, sound_field) for sound_field, sound_field_byte in CMD_SOUND_FIELD_BYTES.items())
+FEEDBACK_SOURCE_BYTES = dict((source_feedback[5], source) for source, source_feedback in FEEDBACK_SOURCE_MAP.items())
+FEEDBACK_SOUND_FIELD_BYTES = dict((sound_field_feedback[4], sound_field) for sound_field, sound_field_feedback in FEEDBACK_SOUND_FIELD_MAP.items())
+FEEDBACK_SOUND_OPTIMIZER_BYTES = {
+    FEEDBACK_SOUND_OPTIMIZER_OFF[0]: "off",
+    FEEDBACK_SOUND_OPTIMIZER_NORMAL[0]: "normal",
+    FEEDBACK_SOUND_OPTIMIZER_LOW[0]: "low",
+}
+
+
+class FeedbackEvent():
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "%s(%s)" %(type(self).__name__, ", ".join(["%s=%r" %(name, getattr(self, name)) for name in self.__slots__]))
+
+
+class VolumeEvent(FeedbackEvent):
+
+    __slots__ = ("volume", "zone")
+
+    def __init__(self, volume, zone = ZONE_MAIN):
+        self.volume = volume
+        self.zone = zone
+
+
+class SourceEvent(FeedbackEvent):
+
+    # power and muted are None if the state byte is unknown
+    __slots__ = ("source", "power", "muted", "zone")
+
+    def __init__(self, source, power, muted, zone = ZONE_MAIN):
+        self.source = source
+        self.power = power
+        self.muted = muted
+        self.zone = zone
+
+
+class SoundFieldEvent(FeedbackEvent):
+
+    __slots__ = ("sound_field",)
+
+    def __init__(self, sound_field):
+        self.sound_field = sound_field
+
+
+class PureDirectEvent(FeedbackEvent):
+
+    __slots__ = ("pure_direct",)
+
+    def __init__(self, pure_direct):
+        self.pure_direct = pure_direct
+
+
+class SoundOptimizerEvent(FeedbackEvent):
+
+    # sound_optimizer is None for unknown modes
+    __slots__ = ("sound_optimizer",)
+
+    def __init__(self, sound_optimizer):
+        self.sound_optimizer = sound_optimizer
+
+
+class TimerEvent(FeedbackEvent):
+
+    __slots__ = ("hours", "minutes", "seconds")
+
+    def __init__(self, hours, minutes, seconds):
+        self.hours = hours
+        self.minutes = minutes
+        self.seconds = seconds
+
+
+class FmTunerEvent(FeedbackEvent):
+
+    __slots__ = ("preset", "stereo", "freq")
+
+    def __init__(self, preset, stereo, freq):
+        self.preset = preset
+        self.stereo = stereo
+        self.freq = freq
+
+
+class AutoStandbyEvent(FeedbackEvent):
+
+    __slots__ = ("auto_standby",)
+
+    def __init__(self, auto_standby):
+        self.auto_standby = auto_standby
+
+
+class AutoPhaseMatchingEvent(FeedbackEvent):
+
+    __slots__ = ("auto_phase_matching",)
+
+    def __init__(self, auto_phase_matching):
+        self.auto_phase_matching = auto_phase_matching
+
+
+# The decode_* functions are only called for frames whose feedback key
+# matches, so they just validate the length and decode the payload. They
+# return None for frames they do not understand.
+
+SOURCE_STRUCT = struct.Struct("BxB")
+TIMER_STRUCT = struct.Struct("BBB")
+FMTUNER_STRUCT = struct.Struct("BBBB")
+
+def decode_volume(frame):
+    if len(frame) == len(FEEDBACK_VOLUME) + 1:
+        return VolumeEvent(frame[7], feedback_zone(frame))
+    return None
+
+def decode_source(frame):
+    if len(frame) == len(FEEDBACK_SOURCE_MAP["bdDvd"]) + 2:
+        source_byte, state = SOURCE_STRUCT.unpack_from(frame, 5)
+        source = FEEDBACK_SOURCE_BYTES.get(source_byte)
+        if source == None:
+            return None
+        # The frame also contains the power and muted states
+        zone = feedback_zone(frame)
+        if state == FEEDBACK_POWER_OFF[0]:
+            return SourceEvent(source, False, None, zone)
+        elif state == FEEDBACK_MUTE_OFF[0]:
+            return SourceEvent(source, True, False, zone)
+        elif state == FEEDBACK_MUTE_ON[0]:
+            return SourceEvent(source, True, True, zone)
+        return SourceEvent(source, None, None, zone)
+    return None
+
+def decode_sound_field(frame):
+    if len(frame) == len(FEEDBACK_SOUND_FIELD_MAP["twoChannelStereo"]):
+        sound_field = FEEDBACK_SOUND_FIELD_BYTES.get(frame[4])
+        if sound_field != None:
+            return SoundFieldEvent(sound_field)
+    return None
+
+def decode_pure_direct(frame):
+    if len(frame) == len(FEEDBACK_PURE_DIRECT_ON):
+        if frame[4] == FEEDBACK_PURE_DIRECT_ON[4]:
+            return PureDirectEvent(True)
+        elif frame[4] == FEEDBACK_PURE_DIRECT_OFF[4]:
+            return PureDirectEvent(False)
+    return None
+
+def decode_sound_optimizer(frame):
+    if len(frame) == len(FEEDBACK_SOUND_OPTIMIZER_PREFIX) + 1:
+        return SoundOptimizerEvent(FEEDBACK_SOUND_OPTIMIZER_BYTES.get(frame[5]))
+    return None
+
+def decode_timer(frame):
+    if len(frame) == len(FEEDBACK_TIMER_PREFIX) + 3:
+        return TimerEvent(*TIMER_STRUCT.unpack_from(frame, 4))
+    return None
+
+def decode_fmtuner(frame):
+    if len(frame) >= len(FEEDBACK_FMTUNER_PREFIX) + 4 and frame[4] == FEEDBACK_FMTUNER_PREFIX[4]:
+        preset, stereo, freq_high, freq_low = FMTUNER_STRUCT.unpack_from(frame, 5)
+        return FmTunerEvent(preset, stereo != FEEDBACK_FMTUNER_MONO[0], round(((freq_high * 255 + freq_low) / 99.5) - 0.1, 1))
+    return None
+
+def decode_auto_standby(frame):
+    if len(frame) == len(FEEDBACK_AUTO_STANDBY_ON):
+        if frame[4] == FEEDBACK_AUTO_STANDBY_OFF[4]:
+            return AutoStandbyEvent(False)
+        elif frame[4] == FEEDBACK_AUTO_STANDBY_ON[4]:
+            return AutoStandbyEvent(True)
+    return None
+
+def decode_auto_phase_matching(frame):
+    if len(frame) == len(FEEDBACK_AUTO_PHASE_MATCHING_AUTO):
+        if frame[5] == FEEDBACK_AUTO_PHASE_MATCHING_OFF[5]:
+            return AutoPhaseMatchingEvent(False)
+        elif frame[5] == FEEDBACK_AUTO_PHASE_MATCHING_AUTO[5]:
+            return AutoPhaseMatchingEvent(True)
+    return None
+
+# Maps the feedback key to the function decoding the frame
+FEEDBACK_DECODERS = {
+    feedback_key(FEEDBACK_TIMER_PREFIX): decode_timer,
+    feedback_key(FEEDBACK_SOURCE_MAP["bdDvd"]): decode_source,
+    feedback_key(FEEDBACK_SOUND_FIELD_MAP["twoChannelStereo"]): decode_sound_field,
+    feedback_key(FEEDBACK_PURE_DIRECT_ON): decode_pure_direct,
+    feedback_key(FEEDBACK_SOUND_OPTIMIZER_PREFIX): decode_sound_optimizer,
+    feedback_key(FEEDBACK_FMTUNER_PREFIX): decode_fmtuner,
+    feedback_key(FEEDBACK_VOLUME): decode_volume,
+    feedback_key(FEEDBACK_AUTO_STANDBY_ON): decode_auto_standby,
+    feedback_key(FEEDBACK_AUTO_PHASE_MATCHING_AUTO): decode_auto_phase_matching,
+}
+
+def decode_feedback(frame):
+    # Returns the event of a feedback frame or None if it is unknown
+    if len(frame) > 3:
+        decoder = FEEDBACK_DECODERS.get(frame[2] << 8 | frame[3])
+        if decoder != None:
+            return decoder(frame)
+    return None
+
+
+class FrameDecoder():
+
+    buffer = None
+    logger = logging.getLogger("frame")
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def reset(self):
+        del self.buffer[:]
+
+    def feed(self, data):
+        # Yields every complete frame as a memoryview into the internal buffer.
+        # A frame is only valid until the next frame is requested; incomplete
+        # frames stay in the buffer until the rest arrives with the next read.
+        self.buffer += data
+        start = 0
+        end = len(self.buffer)
+        with memoryview(self.buffer) as view:
+            while start < end:
+                if self.buffer[start] != FRAME_START:
+                    next_start = self.buffer.find(FRAME_START, start)
+                    if next_start == -1:
+                        next_start = end
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("[unknown data packet]\n%s" %(binascii.hexlify(view[start:next_start])))
+                    start = next_start
+                    continue
+                if end - start < FRAME_HEADER_SIZE:
+                    break
+                frame_end = start + FRAME_HEADER_SIZE + self.buffer[start + 1]
+                if frame_end - start > MAX_FRAME_SIZE:
+                    # Waiting for the rest would stall every later frame, the
+                    # next 0x02 may start one
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug("[frame too long]\n%s" %(binascii.hexlify(view[start:start + FRAME_HEADER_SIZE])))
+                    start += 1
+                    continue
+                if frame_end > end:
+                    break
+                frame = view[start:frame_end]
+                yield frame
+                frame.release()
+                start = frame_end
+        del self.buffer[:start]
@@ -9,49 +9,105 @@ __author__ = "michaelkapuscik"
 import socket
 import time
 import signal
-import gi
 import os
 import threading
+import asyncio
+import collections
 import logging
 import traceback
 import webbrowser
 import time
-import dbus
-import dbus.service
 import binascii
+import json
+import struct
+import fcntl
+import ipaddress
+import itertools
+import random
+import urllib.request
+
+try:
+    from codec import *
+    from capture import CaptureWriter, TRACE, TRACE_IN, TRACE_OUT
+    from metrics import METRICS, MetricsServer, DURATION_BUCKETS
+except ImportError:
+    from sonyavindicator.codec import *
+    from sonyavindicator.capture import CaptureWriter, TRACE, TRACE_IN, TRACE_OUT
+    from sonyavindicator.metrics import METRICS, MetricsServer, DURATION_BUCKETS
+
+# The GUI libraries are loaded by import_gui() when the indicator is shown
+gtk = None
+gdk = None
+glib = None
+appindicator = None
+notify = None
+
+
+def import_gui():
+    global gtk, gdk, glib, appindicator, notify
+    if gtk == None:
+        import gi
+        gi.require_version("Gtk", "3.0")
+        gi.require_version("AppIndicator3", "0.1")
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Gtk, Gdk, GLib, AppIndicator3, Notify
+        gtk, gdk, glib, appindicator, notify = Gtk, Gdk, GLib, AppIndicator3, Notify
+
+
+def import_mpris():
+    # dbus-python is only needed for the MPRIS server
+    try:
+        import mpris
+    except ImportError:
+        from sonyavindicator import mpris
+    return mpris
 
-gi.require_version("Gtk", "3.0")
-gi.require_version("AppIndicator3", "0.1")
-gi.require_version('Notify', '0.7')
-
-from gi.repository import Gtk as gtk
-from gi.repository import Gdk as gdk
-from gi.repository import AppIndicator3 as appindicator
-from gi.repository import Notify as notify
-from gi.repository import GObject
-
-from dbus.mainloop.glib import DBusGMainLoop
-
-
-logging.basicConfig(level = logging.DEBUG, format = "%(asctime)-15s [%(name)-5s] [%(levelname)-5s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
 APPINDICATOR_ID = "sonyavindicator"
 
-IDENTITY = 'sonyavindicator'
-
-DESKTOP = 'sonyavindicator'
+# ioctl requests and interface flags from <linux/sockios.h> and <net/if.h>
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_POINTOPOINT = 0x10
+IFF_RUNNING = 0x40
+
+# Kernel routing table, the interfaces of the default route come first
+ROUTE_TABLE_PATH = "/proc/net/route"
+
+# Networks larger than SWEEP_PREFIXLEN are swept around the own address first
+SWEEP_PREFIXLEN = 24
+
+# Kernel neighbor table, entries with ATF_COM are resolved and thus alive
+ARP_TABLE_PATH = "/proc/net/arp"
+ATF_COM = 0x2
+
+# MAC address prefixes registered to Sony (not exhaustive, only used to
+# probe likely receivers first)
+SONY_OUIS = frozenset([
+    "00:01:4a", "00:13:a9", "00:1a:80", "00:24:be", "00:eb:2d", "04:5d:4b",
+    "10:4f:a8", "28:3f:69", "30:17:c8", "3c:07:71", "54:42:49", "58:48:22",
+    "78:84:3c", "ac:9b:0a", "bc:60:a7", "d8:d4:3c", "f0:bf:97", "fc:f1:52",
+])
+
+# Audio Control API of newer receivers, only used to look up the model name
+SONY_API_PORT = 10000
+BUFFER_SIZE = 1024
 
-BUS_NAME = 'org.mpris.MediaPlayer2.' + IDENTITY
-OBJECT_PATH = '/org/mpris/MediaPlayer2'
-ROOT_INTERFACE = 'org.mpris.MediaPlayer2'
-PLAYER_INTERFACE = 'org.mpris.MediaPlayer2.Player'
-PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
-PLAYLISTS_IFACE = 'org.mpris.MediaPlayer2.Playlists'
+# TCP keepalive: an idle connection to a receiver which vanished without
+# closing it is dropped by the kernel after idle + interval * count seconds
+KEEPALIVE_IDLE = 3
+KEEPALIVE_INTERVAL = 1
+KEEPALIVE_COUNT = 3
 
-# 80, 5000, 8008, 8009, 10000, 22222, 33335, 33336, 35275, 41824, 50001, 50002, 52323, 54400
-TCP_PORT_1 = 33335
-TCP_PORT_2 = 33336
-BUFFER_SIZE = 1024
+# States of a feedback connection, the values of the state gauge
+CONNECTION_CONNECTING = 0
+CONNECTION_UP = 1
+CONNECTION_DEGRADED = 2
+CONNECTION_DOWN = 3
+CONNECTION_STATES = ("connecting", "up", "degraded", "down")
 
 MIN_VOLUME = 0
 LOW_VOLUME = 15
@@ -61,156 +117,150 @@ LIMIT_VOLUME = MAX_VOLUME
 
 ICON_PATH = "/usr/share/icons/ubuntu-mono-dark/status/24"
 
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), APPINDICATOR_ID, "device.json")
+
 SOURCE_NAMES = [ "bdDvd", "game", "satCaTV", "video", "tv", "saCd", "fmTuner", "bluetooth", "usb", "homeNetwork", "internetServices", "screenMirroring", "googleCast" ]
 SOUND_FIELD_NAMES = [ [ "twoChannelStereo", "analogDirect", "multiStereo", "afd" ], [ "pl2Movie", "neo6Cinema", "hdDcs" ], [ "pl2Music", "neo6Music", "concertHallA", "concertHallB", "concertHallC", "jazzClub", "liveConcert", "stadium", "sports", "portableAudio" ] ]
 
-# Byte 5 (0x00) seems to be the zone (not STR-DN-860, but maybe STR-DN-1060)
-CMD_SOURCE_MAP = {
-    "bdDvd":                bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x1B, 0x00]),
-    "game":                 bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x1C, 0x00]),
-    "satCaTV":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x16, 0x00]),
-    "video":                bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x10, 0x00]),
-    "tv":                   bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x1A, 0x00]),
-    "saCd":                 bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x02, 0x00]),
-    # "hdmi1":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x21, 0x00]),
-    # "hdmi2":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x22, 0x00]),
-    # "hdmi3":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x23, 0x00]),
-    # "hdmi4":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x24, 0x00]),
-    # "hdmi5":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x25, 0x00]),
-    # "hdmi6":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x26, 0x00]),
-    "fmTuner":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x2E, 0x00]),
-    "amTuner":              bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x2F, 0x00]),
-    # "shoutcast":          bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x32, 0x00]),
-    "bluetooth":            bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x33, 0x00]),
-    "usb":                  bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x34, 0x00]),
-    "homeNetwork":          bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x3D, 0x00]),
-    "internetServices":     bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x3E, 0x00]),
-    "screenMirroring":      bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0x40, 0x00]),
-    "googleCast":           bytearray([0x02, 0x04, 0xA0, 0x42, 0x00, 0xFF, 0x00]),
+# Queued commands are sent by priority: power and mute first, volume last
+COMMAND_PRIORITY_HIGH = 0
+COMMAND_PRIORITY_NORMAL = 1
+COMMAND_PRIORITY_LOW = 2
+
+COMMAND_PRIORITIES = {
+    command_key(CMD_POWER_ON): COMMAND_PRIORITY_HIGH,
+    command_key(CMD_MUTE): COMMAND_PRIORITY_HIGH,
+    command_key(CMD_SOURCE_MAP["bdDvd"]): COMMAND_PRIORITY_NORMAL,
+    command_key(CMD_SOUND_FIELD_MAP["twoChannelStereo"]): COMMAND_PRIORITY_NORMAL,
+    command_key(CMD_HDMIOUT_ON): COMMAND_PRIORITY_NORMAL,
+    command_key(CMD_VOLUME_MIN): COMMAND_PRIORITY_LOW,
+    command_key(CMD_VOLUME_UP): COMMAND_PRIORITY_LOW,
+    command_key(CMD_VOLUME_DOWN): COMMAND_PRIORITY_LOW,
 }
 
-# Byte 5 (0x00) seems to be the zone (not STR-DN-860, but maybe STR-DN-1060)
-CMD_MUTE                  = bytearray([0x02, 0x04, 0xA0, 0x53, 0x00, 0x01, 0x00])
-CMD_UNMUTE                = bytearray([0x02, 0x04, 0xA0, 0x53, 0x00, 0x00, 0x00])
-
-# Byte 5 (0x00) seems to be the zone (not STR-DN-860, but maybe STR-DN-1060)
-CMD_POWER_ON              = bytearray([0x02, 0x04, 0xA0, 0x60, 0x00, 0x01, 0x00])
-CMD_POWER_OFF             = bytearray([0x02, 0x04, 0xA0, 0x60, 0x00, 0x00, 0x00])
-
-CMD_HDMIOUT_ON            = bytearray([0x02, 0x03, 0xA0, 0x45, 0x00, 0x00])
-CMD_HDMIOUT_OFF           = bytearray([0x02, 0x03, 0xA0, 0x45, 0x03, 0x00])
-
-# Last byte seems to be zero (but was a checksum)
-CMD_SOUND_FIELD_MAP = {
-    "twoChannelStereo":     bytearray([0x02, 0x03, 0xA3, 0x42, 0x00, 0x00]),
-    "analogDirect":         bytearray([0x02, 0x03, 0xA3, 0x42, 0x02, 0x00]),
-    "multiStereo":          bytearray([0x02, 0x03, 0xA3, 0x42, 0x27, 0x00]),
-    "afd":                  bytearray([0x02, 0x03, 0xA3, 0x42, 0x21, 0x00]),
-    "pl2Movie":             bytearray([0x02, 0x03, 0xA3, 0x42, 0x23, 0x00]),
-    "neo6Cinema":           bytearray([0x02, 0x03, 0xA3, 0x42, 0x25, 0x00]),
-    "hdDcs":                bytearray([0x02, 0x03, 0xA3, 0x42, 0x33, 0x00]),
-    "pl2Music":             bytearray([0x02, 0x03, 0xA3, 0x42, 0x24, 0x00]),
-    "neo6Music":            bytearray([0x02, 0x03, 0xA3, 0x42, 0x26, 0x00]),
-    "concertHallA":         bytearray([0x02, 0x03, 0xA3, 0x42, 0x1E, 0x00]),
-    "concertHallB":         bytearray([0x02, 0x03, 0xA3, 0x42, 0x1F, 0x00]),
-    "concertHallC":         bytearray([0x02, 0x03, 0xA3, 0x42, 0x38, 0x00]),
-    "jazzClub":             bytearray([0x02, 0x03, 0xA3, 0x42, 0x16, 0x00]),
-    "liveConcert":          bytearray([0x02, 0x03, 0xA3, 0x42, 0x19, 0x00]),
-    "stadium":              bytearray([0x02, 0x03, 0xA3, 0x42, 0x1B, 0x00]),
-    "sports":               bytearray([0x02, 0x03, 0xA3, 0x42, 0x20, 0x00]),
-    "portableAudio":        bytearray([0x02, 0x03, 0xA3, 0x42, 0x30, 0x00]),
+# These commands set an absolute state, so a queued one is superseded by the
+# next one of the same kind. Relative commands like preset up are not.
+COMMAND_SUPERSEDING = frozenset([
+    command_key(CMD_POWER_ON),
+    command_key(CMD_MUTE),
+    command_key(CMD_SOURCE_MAP["bdDvd"]),
+    command_key(CMD_SOUND_FIELD_MAP["twoChannelStereo"]),
+    command_key(CMD_HDMIOUT_ON),
+    command_key(CMD_VOLUME_MIN),
+])
+
+# These commands switch the receiver on, so a power off overtaking them in
+# the queue would leave it on. A power off discards them instead.
+COMMAND_POWERING = frozenset([
+    command_key(CMD_SOURCE_MAP["bdDvd"]),
+    command_key(CMD_SOUND_FIELD_MAP["twoChannelStereo"]),
+    command_key(CMD_HDMIOUT_ON),
+])
+
+ZONE_NAMES = {
+    ZONE_MAIN: "main",
+    ZONE_2: "zone2",
+    ZONE_3: "zone3",
 }
 
-# not working ? only preset up and down are working currently
-CMD_FMTUNER = [
-                            bytearray([0x02, 0x04, 0xA1, 0x42, 0x01, 0x01, 0x17]),
-                            bytearray([0x02, 0x04, 0xA1, 0x42, 0x01, 0x02, 0x16]),
-                            bytearray([0x02, 0x04, 0xA1, 0x42, 0x01, 0x03, 0x15]),
-]
-
-CMD_FMTUNER_PRESET_DOWN   = bytearray([0x02, 0x02, 0xA1, 0x0C, 0x51, 0x00])
-CMD_FMTUNER_PRESET_UP     = bytearray([0x02, 0x02, 0xA1, 0x0B, 0x52, 0x00])
-
-CMD_VOLUME_MIN            = bytearray([0x02, 0x06, 0xA0, 0x52, 0x00, 0x03, 0x00, 0x00, 0x00])
-CMD_VOLUME_MAX            = bytearray([0x02, 0x06, 0xA0, 0x52, 0x00, 0x03, 0x00, 0x4A, 0x00])
-CMD_VOLUME_UP             = bytearray([0x02, 0x03, 0xA0, 0x55, 0x00, 0x00])
-CMD_VOLUME_DOWN           = bytearray([0x02, 0x03, 0xA0, 0x56, 0x00, 0x00])
-
-# three bytes follows:
-# - hours
-# - minutes
-# - seconds
-# if hours, minutes and seconds are 0xFF, the timer was set to OFF
-FEEDBACK_TIMER_PREFIX     = bytearray([0x02, 0x05, 0xA8, 0x90])
-FEEDBACK_TIMER_SET        = bytearray([0x00])
-FEEDBACK_TIMER_UPDATE     = bytearray([0x3B])
-FEEDBACK_TIMER_OFF        = bytearray([0xFF])
-
-# "video" == Google Cast + Bluetooth
-# two bytes follows:
-# - power off / unmuted / muted
-# - zero byte
-# byte 5 normally 0x00, but seldom 0x03
-FEEDBACK_SOURCE_MAP = {
-    "bdDvd":                bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x1B, 0x00]),
-    "game":                 bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x1C, 0x00]),
-    "satCaTV":              bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x16, 0x00]),
-    "video":                bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0xFF, 0x00]),
-    "tv":                   bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x1A, 0x00]),
-    "saCd":                 bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x02, 0x00]),
-    "fmTuner":              bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x2E, 0x00]),
-    "amTuner":              bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x2F, 0x00]),
-    "bluetooth":            bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x33, 0x00]),
-    "usb":                  bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x34, 0x00]),
-    "homeNetwork":          bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x3D, 0x00]),
-    "internetServices":     bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x3E, 0x00]),
-    "screenMirroring":      bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0x40, 0x00]),
-    "googleCast":           bytearray([0x02, 0x07, 0xA8, 0x82, 0x00, 0xFF, 0x00]),
-}
-FEEDBACK_POWER_OFF        = bytearray([0x10])
-FEEDBACK_MUTE_OFF         = bytearray([0x11])
-FEEDBACK_MUTE_ON          = bytearray([0x13])
-
-FEEDBACK_SOUND_FIELD_MAP = {
-    "twoChannelStereo":     bytearray([0x02, 0x04, 0xAB, 0x82, 0x00, 0x00]),
-    "analogDirect":         bytearray([0x02, 0x04, 0xAB, 0x82, 0x02, 0x00]),
-    "multiStereo":          bytearray([0x02, 0x04, 0xAB, 0x82, 0x27, 0x00]),
-    "afd":                  bytearray([0x02, 0x04, 0xAB, 0x82, 0x21, 0x00]),
-    "pl2Movie":             bytearray([0x02, 0x04, 0xAB, 0x82, 0x23, 0x00]),
-    "neo6Cinema":           bytearray([0x02, 0x04, 0xAB, 0x82, 0x25, 0x00]),
-    "hdDcs":                bytearray([0x02, 0x04, 0xAB, 0x82, 0x33, 0x00]),
-    "pl2Music":             bytearray([0x02, 0x04, 0xAB, 0x82, 0x24, 0x00]),
-    "neo6Music":            bytearray([0x02, 0x04, 0xAB, 0x82, 0x26, 0x00]),
-    "concertHallA":         bytearray([0x02, 0x04, 0xAB, 0x82, 0x1E, 0x00]),
-    "concertHallB":         bytearray([0x02, 0x04, 0xAB, 0x82, 0x1F, 0x00]),
-    "concertHallC":         bytearray([0x02, 0x04, 0xAB, 0x82, 0x38, 0x00]),
-    "jazzClub":             bytearray([0x02, 0x04, 0xAB, 0x82, 0x16, 0x00]),
-    "liveConcert":          bytearray([0x02, 0x04, 0xAB, 0x82, 0x19, 0x00]),
-    "stadium":              bytearray([0x02, 0x04, 0xAB, 0x82, 0x1B, 0x00]),
-    "sports":               bytearray([0x02, 0x04, 0xAB, 0x82, 0x20, 0x00]),
-    "portableAudio":        bytearray([0x02, 0x04, 0xAB, 0x82, 0x30, 0x00]),
+# The state the receiver keeps per zone
+ZONE_STATE_KEYS = ("power", "volume", "muted", "source")
+
+def zone_key(key, zone = ZONE_MAIN):
+    # The main zone uses the plain state keys, e.g. "muted" and "zone2_muted"
+    if zone == ZONE_MAIN:
+        return key
+    return "%s_%s" %(ZONE_NAMES[zone], key)
+
+def command_state(cmd):
+    # Returns the state a command sets as (kind, value) in the terms of the
+    # feedback reporting it, or None if no feedback reports it
+    key = command_key(cmd)
+    if key == command_key(CMD_POWER_ON):
+        return (zone_key("power", cmd[4]), cmd[5] == CMD_POWER_ON[5])
+    elif key == command_key(CMD_MUTE):
+        return (zone_key("muted", cmd[4]), cmd[5] == CMD_MUTE[5])
+    elif key == command_key(CMD_SOURCE_MAP["bdDvd"]):
+        return (zone_key("source", cmd[4]), CMD_SOURCE_NAMES.get(cmd[5]))
+    elif key == command_key(CMD_SOUND_FIELD_MAP["twoChannelStereo"]):
+        return ("sound_field", CMD_SOUND_FIELD_NAMES.get(cmd[4]))
+    elif key == command_key(CMD_VOLUME_MIN):
+        return (zone_key("volume", cmd[4]), cmd[7])
+    return None
+
+def device_id(ip, port = TCP_PORT_1):
+    # Identifies a receiver across the process, several receivers may share
+    # an address behind port forwarding or in the simulator
+    return "%s:%d" %(ip, port)
+
+def set_keepalive(_socket, idle = KEEPALIVE_IDLE, interval = KEEPALIVE_INTERVAL, count = KEEPALIVE_COUNT):
+    _socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The timing options are Linux specific
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            _socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+def feedback_states(event):
+    # Returns the states reported by a feedback event as (kind, value)
+    if isinstance(event, SourceEvent):
+        states = [(zone_key("source", event.zone), event.source)]
+        if event.power != None:
+            states.append((zone_key("power", event.zone), event.power))
+        if event.muted != None:
+            states.append((zone_key("muted", event.zone), event.muted))
+        return states
+    elif isinstance(event, SoundFieldEvent):
+        return [("sound_field", event.sound_field)]
+    elif isinstance(event, VolumeEvent):
+        return [(zone_key("volume", event.zone), event.volume)]
+    return []
+
+# Maps the feedback event to the FeedbackWatcher method handling it
+FEEDBACK_HANDLERS = {
+    TimerEvent: "on_timer",
+    SourceEvent: "on_source",
+    SoundFieldEvent: "on_sound_field",
+    PureDirectEvent: "on_pure_direct",
+    SoundOptimizerEvent: "on_sound_optimizer",
+    FmTunerEvent: "on_fmtuner",
+    VolumeEvent: "on_volume",
+    AutoStandbyEvent: "on_auto_standby",
+    AutoPhaseMatchingEvent: "on_auto_phase_matching",
 }
 
-FEEDBACK_PURE_DIRECT_ON   = bytearray([0x02, 0x03, 0xAB, 0x98, 0x01])
-FEEDBACK_PURE_DIRECT_OFF  = bytearray([0x02, 0x03, 0xAB, 0x98, 0x00])
-
-# one byte follows
-FEEDBACK_SOUND_OPTIMIZER_PREFIX = bytearray([0x02, 0x04, 0xAB, 0x92, 0x48])
-FEEDBACK_SOUND_OPTIMIZER_OFF    = bytearray([0x00])
-FEEDBACK_SOUND_OPTIMIZER_NORMAL = bytearray([0x01])
-FEEDBACK_SOUND_OPTIMIZER_LOW    = bytearray([0x02])
-
-FEEDBACK_FMTUNER_PREFIX   = bytearray([0x02, 0x07, 0xA9, 0x82, 0x80]);
-FEEDBACK_FMTUNER_STEREO   = bytearray([0x00])
-FEEDBACK_FMTUNER_MONO     = bytearray([0x80])
-
-FEEDBACK_VOLUME           = bytearray([0x02, 0x06, 0xA8, 0x8b, 0x00, 0x03, 0x00])
-
-FEEDBACK_AUTO_STANDBY_ON  = bytearray([0x02, 0x03, 0xA8, 0xA4, 0xCC])
-FEEDBACK_AUTO_STANDBY_OFF = bytearray([0x02, 0x03, 0xA8, 0xA4, 0x4C])
+# Names of the command keys in the metrics
+COMMAND_NAMES = {
+    command_key(CMD_POWER_ON): "power",
+    command_key(CMD_MUTE): "mute",
+    command_key(CMD_SOURCE_MAP["bdDvd"]): "source",
+    command_key(CMD_SOUND_FIELD_MAP["twoChannelStereo"]): "sound_field",
+    command_key(CMD_HDMIOUT_ON): "hdmiout",
+    command_key(CMD_VOLUME_MIN): "volume",
+    command_key(CMD_VOLUME_UP): "volume_up",
+    command_key(CMD_VOLUME_DOWN): "volume_down",
+    command_key(CMD_FMTUNER[0]): "fmtuner",
+    command_key(CMD_FMTUNER_PRESET_UP): "fmtuner_preset_up",
+    command_key(CMD_FMTUNER_PRESET_DOWN): "fmtuner_preset_down",
+}
 
-FEEDBACK_AUTO_PHASE_MATCHING_AUTO = bytearray([0x2, 0x4, 0xab, 0x97, 0x48, 0x2])
-FEEDBACK_AUTO_PHASE_MATCHING_OFF  = bytearray([0x2, 0x4, 0xab, 0x97, 0x48, 0x0])
+def command_name(key):
+    return COMMAND_NAMES.get(key, "0x%04x" %(key))
+
+METRIC_COMMANDS_SENT = METRICS.counter("sonyav_commands_sent_total", "Commands written to the receiver", "type", command_name)
+METRIC_COMMANDS_FAILED = METRICS.counter("sonyav_commands_failed_total", "Commands which could not be written", "type", command_name)
+METRIC_COMMANDS_DROPPED = METRICS.counter("sonyav_commands_dropped_total", "Commands dropped because the send queue was full", "type", command_name)
+METRIC_COMMAND_LATENCY = METRICS.histogram("sonyav_command_send_seconds", "Time from queueing a command until it was written")
+METRIC_FEEDBACK_FRAMES = METRICS.counter("sonyav_feedback_frames_total", "Decoded feedback frames", "type", lambda event_type: event_type.__name__)
+METRIC_FEEDBACK_UNKNOWN = METRICS.counter("sonyav_feedback_unknown_total", "Feedback frames which could not be decoded")
+METRIC_FEEDBACK_BYTES = METRICS.counter("sonyav_feedback_bytes_total", "Bytes received on the feedback connections")
+METRIC_FEEDBACK_RECONNECTS = METRICS.counter("sonyav_feedback_reconnects_total", "Feedback connections lost or timed out and reconnected", "port", str)
+METRIC_FEEDBACK_TIMEOUTS = METRICS.counter("sonyav_feedback_timeouts_total", "Feedback connections given up by TCP keepalive or an unanswered probe", "port", str)
+METRIC_FEEDBACK_CONNECT_FAILURES = METRICS.counter("sonyav_feedback_connect_failures_total", "Failed attempts to connect the feedback connections", "port", str)
+METRIC_FEEDBACK_STATE = METRICS.gauge("sonyav_feedback_state", "State of the feedback connections: 0 connecting, 1 up, 2 degraded, 3 down", "port", str)
+METRIC_DISCOVERY = METRICS.histogram("sonyav_discovery_seconds", "Duration of the network scans for receivers", DURATION_BUCKETS)
+METRIC_GUI_LATENCY = METRICS.histogram("sonyav_gui_dispatch_seconds", "Time from posting a user interface update until it ran")
+METRIC_NOTIFICATION_LATENCY = METRICS.histogram("sonyav_notification_dispatch_seconds", "Time from posting a notification until it was shown")
+METRIC_NOTIFICATION_DEPTH = METRICS.gauge("sonyav_notification_queue_depth", "Notifications collapsed into the pending ones")
 
 
 SOURCE_MENU_MAP = {
@@ -290,6 +340,72 @@ FM_TUNER_MENU_MAP = {
 }
 
 
+# Fields of the receiver state and their values until the device reported
+STATE_FIELDS = (
+    ("power", True),
+    ("hdmiout", True),
+    ("volume", LOW_VOLUME),
+    ("muted", False),
+    ("source", None),
+    ("sound_field", None),
+    ("pure_direct", False),
+    ("sound_optimizer", None),
+    ("timer", False),
+    ("timer_hours", 0),
+    ("timer_minutes", 0),
+    ("fmtuner", None),
+    ("fmtunerstereo", None),
+    ("fmtunerfreq", None),
+    ("auto_standby", True),
+    ("auto_phase_matching", True),
+) + tuple((zone_key(key, zone), None) for zone in ZONES if zone != ZONE_MAIN for key in ZONE_STATE_KEYS)
+
+STATE_INDEX = dict((key, index) for index, (key, default) in enumerate(STATE_FIELDS))
+
+# Immutable copy of the state at one version
+StateSnapshot = collections.namedtuple("StateSnapshot", ["version"] + [key for key, default in STATE_FIELDS])
+
+
+class StateStore():
+
+    # The state of one receiver as two arrays indexed by STATE_INDEX: the
+    # values and the version each of them was last changed at. Every change
+    # increments the version, so consumers can sync incrementally with
+    # changes(version) instead of comparing the whole state.
+
+    __slots__ = ("version", "values", "versions", "lock")
+
+    def __init__(self):
+        self.version = 0
+        self.values = [default for key, default in STATE_FIELDS]
+        self.versions = [0] * len(STATE_FIELDS)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values[STATE_INDEX[key]]
+
+    def set(self, key, value):
+        # Returns the new version, or None if the value did not change
+        index = STATE_INDEX[key]
+        with self.lock:
+            if self.values[index] == value:
+                return None
+            self.version += 1
+            self.values[index] = value
+            self.versions[index] = self.version
+            return self.version
+
+    def snapshot(self):
+        with self.lock:
+            return StateSnapshot(self.version, *self.values)
+
+    def changes(self, since):
+        # Returns the current version and the fields changed after version
+        # since, pass the returned version to the next call
+        with self.lock:
+            return self.version, dict((key, self.values[index]) for index, (key, default) in enumerate(STATE_FIELDS) if self.versions[index] > since)
+
+
 class StateService():
     
     sony_av_indicator = None
@@ -297,25 +413,6 @@ class StateService():
 
     logger = logging.getLogger("state")
 
-    states = {
-        "power": True,
-        "hdmiout": True,
-        "volume": LOW_VOLUME,
-        "muted": False,
-        "source": None,
-        "sound_field": None,
-        "pure_direct": False,
-        "sound_optimizer": None,
-        "timer": False,
-        "timer_hours": 0,
-        "timer_minutes": 0,
-        "fmtuner": None,
-        "fmtunerstereo": None,
-        "fmtunerfreq": None,
-        "auto_standby": True,
-        "auto_phase_matching": True,
-    }
-
     notifications = {
         "power": True,
         "hdmiout": True,
@@ -333,18 +430,36 @@ class StateService():
 
     def __init__(self, sony_av_indicator):
         self.sony_av_indicator = sony_av_indicator
+        self.store = StateStore()
+        self.listeners = []
 
-    def __getattr__(self, key):
-        try:
-            return self.states[key]
-        except KeyError as err:
-            raise AttributeError(key)
+    def add_listener(self, listener):
+        # The listener is called with the state key after every change, on
+        # the thread which changed the state
+        self.listeners.append(listener)
 
-    def __setattr_(self, key, value):
-        try:
-            self.states[key] = value
-        except KeyError as err:
-            raise AttributeError(key)
+    def notify_listeners(self, key):
+        for listener in self.listeners:
+            listener(key)
+
+    def snapshot(self):
+        return self.store.snapshot()
+
+    def changes(self, since):
+        return self.store.changes(since)
+
+    def __getattr__(self, key):
+        # Only called for the state fields, everything else is an attribute
+        if key in STATE_INDEX:
+            return self.store.get(key)
+        raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key in STATE_INDEX:
+            if self.store.set(key, value) != None:
+                self.notify_listeners(key)
+        else:
+            object.__setattr__(self, key, value)
 
     def update_power(self, power, state_only = False):
         if self.initialized:
@@ -356,9 +471,9 @@ class StateService():
                 self.logger.debug("Power state: %s" % power)
             if self.notifications["power"] and changed and not state_only:
                 if power:
-                    self.sony_av_indicator.show_notification("<b>Power ON</b>", "", None)
+                    self.sony_av_indicator.show_notification("<b>Power ON</b>", "", None, "power")
                 else:
-                    self.sony_av_indicator.show_notification("<b>Power OFF</b>", "", None)
+                    self.sony_av_indicator.show_notification("<b>Power OFF</b>", "", None, "power")
 
     def update_hdmiout(self, hdmiout, state_only = False):
         if self.initialized:
@@ -368,16 +483,15 @@ class StateService():
                 self.logger.debug("HDMI Out: %s" % hdmiout)
             if self.notifications["hdmiout"] and changed and not state_only:
                 if hdmiout:
-                    self.sony_av_indicator.show_notification("<b>HDMI Out ON</b>", "", None)
+                    self.sony_av_indicator.show_notification("<b>HDMI Out ON</b>", "", None, "hdmiout")
                 else:
-                    self.sony_av_indicator.show_notification("<b>HDMI Out OFF</b>", "", None)
+                    self.sony_av_indicator.show_notification("<b>HDMI Out OFF</b>", "", None, "hdmiout")
 
     def update_volume(self, vol):
         if self.initialized:
             if vol > self.volume:
                 self.muted = False
             self.volume = vol
-            self.sony_av_indicator.set_volume_icon(vol)
             self.logger.debug("Volume %d" % vol)
             if self.notifications["volume"]:
                 # TODO: Show volume slider notification
@@ -387,7 +501,6 @@ class StateService():
         if self.initialized:
             changed = (muted != self.muted)
             self.muted = muted
-            self.sony_av_indicator.set_volume_icon(self.volume)
             if changed:
                 if self.muted:
                     self.logger.debug("Muted")
@@ -395,9 +508,9 @@ class StateService():
                     self.logger.debug("Unmuted")
             if self.notifications["muted"] and changed:
                 if self.muted:
-                    self.sony_av_indicator.show_notification("<b>Muted</b>", "", self.sony_av_indicator.get_volume_icon_path("audio-volume-muted-panel"))
+                    self.sony_av_indicator.show_notification("<b>Muted</b>", "", self.sony_av_indicator.get_volume_icon_path("audio-volume-muted-panel"), "muted")
                 else:
-                    self.sony_av_indicator.show_notification("<b>Unmuted</b>", "", self.sony_av_indicator.get_volume_icon_path(self.sony_av_indicator.get_volume_icon(self.volume)))
+                    self.sony_av_indicator.show_notification("<b>Unmuted</b>", "", self.sony_av_indicator.get_volume_icon_path(self.sony_av_indicator.get_volume_icon(self.volume)), "muted")
 
     def update_source(self, source, state_only = False):
         changed = (source != self.source)
@@ -408,7 +521,7 @@ class StateService():
         if changed:
             self.logger.debug("Source: %s" % source)
         if self.notifications["source"] and changed and not state_only:
-            self.sony_av_indicator.show_notification("<b>Source</b>", SOURCE_MENU_MAP[source], None)
+            self.sony_av_indicator.show_notification("<b>Source</b>", SOURCE_MENU_MAP[source], None, "source")
 
     def update_sound_field(self, sound_field, state_only = False):
         changed = (sound_field != self.sound_field)
@@ -416,7 +529,7 @@ class StateService():
         if changed:
             self.logger.debug("Sound field: %s" % sound_field)
         if self.notifications["sound_field"] and changed and not state_only:
-            self.sony_av_indicator.show_notification("<b>Sound Field</b>", SOUND_FIELD_MENU_MAP[sound_field], None)
+            self.sony_av_indicator.show_notification("<b>Sound Field</b>", SOUND_FIELD_MENU_MAP[sound_field], None, "sound_field")
 
     def update_pure_direct(self, pure_direct):
         if self.initialized:
@@ -424,16 +537,16 @@ class StateService():
             self.logger.debug("Pure Direct: %s" % pure_direct)
             if self.notifications["pure_direct"]:
                 if self.pure_direct:
-                    self.sony_av_indicator.show_notification("<b>Pure Direct ON</b>", "", None)
+                    self.sony_av_indicator.show_notification("<b>Pure Direct ON</b>", "", None, "pure_direct")
                 else:
-                    self.sony_av_indicator.show_notification("<b>Pure Direct OFF</b>", "", None)
+                    self.sony_av_indicator.show_notification("<b>Pure Direct OFF</b>", "", None, "pure_direct")
     
     def update_sound_optimizer(self, sound_optimizer):
         if self.initialized:
             self.sound_optimizer = sound_optimizer
             self.logger.debug("Sound Optimizer: %s" % sound_optimizer)
             if self.notifications["sound_optimizer"]:
-                self.sony_av_indicator.show_notification("<b>Sound Optimizer</b>", SOUND_OPTIMIZER_MENU_MAP[sound_optimizer], None)
+                self.sony_av_indicator.show_notification("<b>Sound Optimizer</b>", SOUND_OPTIMIZER_MENU_MAP[sound_optimizer], None, "sound_optimizer")
 
     def update_timer(self, hours, minutes, seconds, set_timer, was_updated):
         self.timer = set_timer
@@ -442,11 +555,11 @@ class StateService():
         self.logger.debug("Timer: %d:%d:%d Set: %s Updated: %s" %(hours, minutes, seconds, set_timer, was_updated))
         if self.notifications["timer"]:
             if not set_timer:
-                self.sony_av_indicator.show_notification("<b>Timer OFF</b>", "", None)
+                self.sony_av_indicator.show_notification("<b>Timer OFF</b>", "", None, "timer")
             elif not was_updated:
-                self.sony_av_indicator.show_notification("<b>Timer SET</b>", "Device will shutdown in %s:%s h"%(hours, minutes), None)
+                self.sony_av_indicator.show_notification("<b>Timer SET</b>", "Device will shutdown in %s:%s h"%(hours, minutes), None, "timer")
             elif hours == 0 and minutes < 15 and seconds == 0:
-                self.sony_av_indicator.show_notification("<b>Timer</b>", "Device will shutdown in %s:%s h"%(hours, minutes), None)
+                self.sony_av_indicator.show_notification("<b>Timer</b>", "Device will shutdown in %s:%s h"%(hours, minutes), None, "timer")
 
     def update_fmtuner(self, fmtuner, stereo, freq):
         if self.initialized:
@@ -456,9 +569,9 @@ class StateService():
             self.logger.debug("FM Tuner: %d (%3.2f MHz) Stereo: %s", fmtuner, freq, stereo)
             if self.notifications["fmtuner"]:
                 if fmtuner != 255:
-                    self.sony_av_indicator.show_notification("<b>FM Tuner %d</b>" %(fmtuner), "%s (%3.2f MHz)" %(FM_TUNER_MENU_MAP[str(fmtuner)], freq), None)
+                    self.sony_av_indicator.show_notification("<b>FM Tuner %d</b>" %(fmtuner), "%s (%3.2f MHz)" %(FM_TUNER_MENU_MAP[str(fmtuner)], freq), None, "fmtuner")
                 else:
-                    self.sony_av_indicator.show_notification("<b>FM Tuner</b>", "%3.2f MHz" %(freq), None)
+                    self.sony_av_indicator.show_notification("<b>FM Tuner</b>", "%3.2f MHz" %(freq), None, "fmtuner")
 
     def update_auto_standby(self, auto_standby):
         if self.initialized:
@@ -466,9 +579,22 @@ class StateService():
             self.logger.debug("Auto Standby: %s" % auto_standby)
             if self.notifications["auto_standby"]:
                 if auto_standby:
-                    self.sony_av_indicator.show_notification("<b>Auto Standby</b>", "ON", None)
+                    self.sony_av_indicator.show_notification("<b>Auto Standby</b>", "ON", None, "auto_standby")
                 else:
-                    self.sony_av_indicator.show_notification("<b>Auto Standby</b>", "OFF", None)
+                    self.sony_av_indicator.show_notification("<b>Auto Standby</b>", "OFF", None, "auto_standby")
+
+    def zone_state(self, zone, key):
+        return getattr(self, zone_key(key, zone))
+
+    def update_zone(self, zone, key, value):
+        # The main zone keeps its notifications, the others are only logged
+        if zone == ZONE_MAIN:
+            getattr(self, "update_" + key)(value)
+        elif self.initialized:
+            key = zone_key(key, zone)
+            if value != getattr(self, key):
+                setattr(self, key, value)
+                self.logger.debug("%s: %s" %(key, value))
 
     def update_auto_phase_matching(self, auto_phase_matching):
         if self.initialized:
@@ -476,9 +602,366 @@ class StateService():
             self.logger.debug("Auto Phase Matching: %s", auto_phase_matching)
             if self.notifications["auto_phase_matching"]:
                 if auto_phase_matching:
-                    self.sony_av_indicator.show_notification("<b>Auto Phase Matching</b>", "AUTO", None)
+                    self.sony_av_indicator.show_notification("<b>Auto Phase Matching</b>", "AUTO", None, "auto_phase_matching")
+                else:
+                    self.sony_av_indicator.show_notification("<b>Auto Phase Matching</b>", "OFF", None, "auto_phase_matching")
+
+
+class EventLoop(threading.Thread):
+
+    loop = None
+
+    logger = logging.getLogger("loop")
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.loop = asyncio.new_event_loop()
+
+    def call(self, callback, *args):
+        # Thread-safe: runs the callback on the event loop
+        return self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        # Thread-safe: runs the callback on the event loop after delay seconds
+        self.call(self.loop.call_later, delay, callback, *args)
+
+    def submit(self, coro):
+        # Thread-safe: schedules the coroutine and returns a concurrent future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_until_complete(self, coro, timeout = None):
+        return self.submit(coro).result(timeout)
+
+    def kill(self):
+        self.call(self.loop.stop)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        # Background tasks like the cache validation never finish by themselves
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions = True))
+        self.loop.close()
+        self.logger.debug("Event loop stopped")
+
+
+class CommandConnection():
+
+    event_loop = None
+    device_service = None
+    port = None
+    reader = None
+    writer = None
+    keepalive = True
+    ended = False
+
+    connect_timeout = 3.0
+
+    def __init__(self, device_service, port, keepalive = True):
+        self.event_loop = device_service.event_loop
+        self.device_service = device_service
+        self.port = port
+        self.keepalive = keepalive
+        self.logger = logging.getLogger("conn:%s"%(port))
+
+    def kill(self):
+        self.ended = True
+        self.event_loop.call(self.disconnect)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.device_service.ip, self.port), self.connect_timeout)
+        _socket = self.writer.get_extra_info("socket")
+        _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            set_keepalive(_socket)
+        self.event_loop.loop.create_task(self.drain(self.reader))
+        self.logger.debug("Connected to %s:%d" %(self.device_service.ip, self.port))
+
+    def disconnect(self):
+        if self.writer != None:
+            self.writer.close()
+            self.reader = None
+            self.writer = None
+
+    async def drain(self, reader):
+        # The receiver also pushes feedback on this connection. Nobody needs
+        # it here, so throw it away before the receive buffer fills up and
+        # notice a connection closed by the peer before writing to it.
+        try:
+            while await reader.read(BUFFER_SIZE):
+                pass
+        except OSError:
+            pass
+        if reader is self.reader:
+            self.logger.debug("Connection closed by peer")
+            self.disconnect()
+
+    async def write(self, cmd):
+        # One retry on a fresh connection heals sockets which died while idle
+        for attempt in range(2):
+            if self.ended:
+                return False
+            try:
+                if self.writer == None:
+                    await self.connect()
+                self.writer.write(cmd)
+                await self.writer.drain()
+                return True
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logger.warning("Failed to send command: %s" %(e))
+                self.disconnect()
+        return False
+
+
+class EchoTracker():
+
+    pending = None
+    reported = None
+    dispatching = False
+    echoes = 0
+    suppressed = 0
+
+    # Feedback arriving later than echo_timeout is not related to a command
+    echo_timeout = 2.0
+
+    def __init__(self):
+        # (kind, value) -> deadline of the commands awaiting their feedback
+        self.pending = {}
+        # kind -> (value, time) of the last state reported by the receiver
+        self.reported = {}
+
+    def sent(self, cmd, now):
+        state = command_state(cmd)
+        if state != None:
+            # The last report of this kind is outdated from now on
+            self.reported.pop(state[0], None)
+            self.pending[state] = now + self.echo_timeout
+
+    def received(self, event, now):
+        # Returns True if the event is the echo of a command we sent
+        echo = False
+        for state in feedback_states(event):
+            self.reported[state[0]] = (state[1], now)
+            deadline = self.pending.pop(state, None)
+            if deadline != None and deadline >= now:
+                echo = True
+        if echo:
+            self.echoes += 1
+        return echo
+
+    def is_echo(self, cmd, now):
+        # A command restating what the receiver has just reported, sent while
+        # the report is dispatched, was triggered by the feedback itself and
+        # must not go back out
+        state = command_state(cmd)
+        if state == None:
+            return False
+        reported = self.reported.get(state[0])
+        if reported == None or reported[0] != state[1] or now - reported[1] >= self.echo_timeout:
+            return False
+        self.suppressed += 1
+        return True
+
+
+class CommandScheduler():
+
+    event_loop = None
+    device_service = None
+    echo_tracker = None
+    connections = None
+    queues = None
+    queued = None
+    task = None
+    last_sent = 0.0
+    ended = False
+
+    queue_size = 16
+    # Minimum time between two frames, the receiver drops frames sent too fast
+    frame_interval = 0.05
+
+    logger = logging.getLogger("sched")
+
+    def __init__(self, device_service, echo_tracker):
+        self.event_loop = device_service.event_loop
+        self.device_service = device_service
+        self.echo_tracker = echo_tracker
+        self.connections = {}
+        self.queues = [collections.deque() for priority in range(COMMAND_PRIORITY_LOW + 1)]
+        self.queued = {}
+
+    def get_connection(self, port):
+        connection = self.connections.get(port)
+        if connection == None:
+            connection = CommandConnection(self.device_service, port)
+            self.connections[port] = connection
+        return connection
+
+    def submit(self, cmd, port = TCP_PORT_1, probe = False):
+        # Thread-safe: hands the command over to the event loop. Probes toggle
+        # a state forth and back to make the receiver report it, so they
+        # neither supersede each other nor count as echoes. A command sent
+        # by a handler of the feedback being dispatched may be its echo, the
+        # commands of the user always go out.
+        if not probe and self.triggered() and self.echo_tracker.is_echo(cmd, self.event_loop.loop.time()):
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Not sending echo of the feedback: %s" %(binascii.hexlify(cmd)))
+            return
+        self.event_loop.call(self.enqueue, bytes(cmd), port, probe)
+
+    def submit_batch(self, cmds, port = TCP_PORT_1):
+        # Thread-safe: the commands are queued at once and go out one after
+        # another on the same connection, paced by frame_interval
+        self.event_loop.call(self.enqueue_batch, [bytes(cmd) for cmd in cmds], port)
+
+    def triggered(self):
+        return self.echo_tracker.dispatching and threading.current_thread() is self.event_loop
+
+    def enqueue_batch(self, cmds, port):
+        for cmd in cmds:
+            self.enqueue(cmd, port)
+
+    def enqueue(self, cmd, port, probe = False):
+        if self.ended:
+            return
+        now = self.event_loop.loop.time()
+        # The zones of the same kind of command do not supersede each other
+        key = (port, command_key(cmd), command_zone(cmd))
+        if not probe and key[1] == command_key(CMD_POWER_OFF) and cmd[5] == CMD_POWER_OFF[5]:
+            self.discard_powering(port, key[2])
+        entry = self.queued.get(key)
+        if not probe and entry != None:
+            # Only the latest state matters, the command keeps its place
+            self.echo_tracker.sent(cmd, now)
+            entry[0] = cmd
+            return
+        if sum(len(queue) for queue in self.queues) >= self.queue_size and not self.make_room(key):
+            self.drop(key)
+            return
+        if not probe:
+            self.echo_tracker.sent(cmd, now)
+        entry = [cmd, port, key, now]
+        self.queues[COMMAND_PRIORITIES.get(key[1], COMMAND_PRIORITY_NORMAL)].append(entry)
+        if key[1] in COMMAND_SUPERSEDING:
+            self.queued[key] = entry
+        if self.task == None:
+            self.task = self.event_loop.loop.create_task(self.run())
+
+    def discard_powering(self, port, zone):
+        # The commands without a zone address the main zone
+        for queue in self.queues:
+            for entry in list(queue):
+                if entry[1] == port and entry[2][1] in COMMAND_POWERING and (entry[2][2] == zone or (entry[2][2] == None and zone == ZONE_MAIN)):
+                    queue.remove(entry)
+                    if self.queued.get(entry[2]) is entry:
+                        del self.queued[entry[2]]
+                    self.logger.debug("Power off: discarding queued %s command" %(command_name(entry[2][1])))
+
+    def make_room(self, key):
+        # A command setting a state takes the place of the oldest relative
+        # command (like preset up), so only relative commands get lost
+        if key[1] not in COMMAND_SUPERSEDING:
+            return False
+        for queue in reversed(self.queues):
+            for entry in queue:
+                if entry[2][1] not in COMMAND_SUPERSEDING:
+                    queue.remove(entry)
+                    self.drop(entry[2])
+                    return True
+        return False
+
+    def drop(self, key):
+        METRIC_COMMANDS_DROPPED.inc(key[1])
+        self.logger.warning("Send queue full: dropping %s command" %(command_name(key[1])))
+
+    def dequeue(self):
+        for queue in self.queues:
+            if queue:
+                entry = queue.popleft()
+                if self.queued.get(entry[2]) is entry:
+                    del self.queued[entry[2]]
+                return entry
+        return None
+
+    def close(self):
+        self.ended = True
+        for connection in self.connections.values():
+            connection.kill()
+        self.connections = {}
+
+    async def run(self):
+        loop = self.event_loop.loop
+        try:
+            while not self.ended:
+                entry = self.dequeue()
+                if entry == None:
+                    break
+                delay = self.last_sent + self.frame_interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                cmd, port, key, queued = entry
+                if await self.get_connection(port).write(cmd):
+                    TRACE.record(TRACE_OUT, port, cmd)
+                    METRIC_COMMANDS_SENT.inc(key[1])
                 else:
-                    self.sony_av_indicator.show_notification("<b>Auto Phase Matching</b>", "OFF", None)
+                    METRIC_COMMANDS_FAILED.inc(key[1])
+                self.last_sent = loop.time()
+                METRIC_COMMAND_LATENCY.observe(self.last_sent - queued)
+        finally:
+            self.task = None
+
+
+class VolumeController():
+
+    event_loop = None
+    command_service = None
+    target = None
+    sent = None
+    last_sent = 0.0
+    pending = None
+    frames_sent = 0
+
+    # At most max_rate volume frames per second go to the receiver
+    max_rate = 10.0
+    # Feedback within settle_time after a send may still be on its way
+    settle_time = 1.0
+
+    def __init__(self, command_service):
+        self.command_service = command_service
+        self.event_loop = command_service.device_service.event_loop
+
+    def set_target(self, vol):
+        # Thread-safe: only the latest target is sent
+        self.event_loop.call(self.update_target, vol)
+
+    def update_target(self, vol):
+        self.target = vol
+        if self.pending == None:
+            delay = self.last_sent + 1.0 / self.max_rate - self.event_loop.loop.time()
+            if delay > 0:
+                self.pending = self.event_loop.loop.call_later(delay, self.flush)
+            else:
+                self.flush()
+
+    def flush(self):
+        self.pending = None
+        if self.target != None and self.target != self.sent:
+            self.sent = self.target
+            self.last_sent = self.event_loop.loop.time()
+            self.frames_sent += 1
+            self.command_service.send_volume(self.target)
+
+    def feedback(self, vol):
+        # Returns True if the reported volume is the current one. Reports of
+        # intermediate volumes while the wheel is still spinning are stale.
+        settled = self.pending == None and self.event_loop.loop.time() - self.last_sent >= self.settle_time
+        if vol == self.target or settled:
+            self.target = vol
+            self.sent = vol
+            return True
+        return False
 
 
 class CommandService():
@@ -486,48 +969,32 @@ class CommandService():
     device_service = None
     state_service = None
     initialized = False
-    block_sending = False
+    echo_tracker = None
+    scheduler = None
+    volume_controller = None
 
     scroll_step_volume = 2
 
     logger = logging.getLogger("cmd")
-    data_logger = logging.getLogger("send")
 
     def __init__(self, device_service, state_service):
         self.device_service = device_service
         self.state_service = state_service
+        self.echo_tracker = EchoTracker()
+        self.scheduler = CommandScheduler(device_service, self.echo_tracker)
+        self.volume_controller = VolumeController(self)
 
-    def connect(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((_device_service.ip, TCP_PORT_1))
-        return s
-
-    def disconnect(self, s):
-        s.close()
-
-    def send_command(self, cmd):
-        if not self.block_sending:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.device_service.ip, TCP_PORT_1))
-            s.send(cmd)
-            s.close()
-            self.data_logger.debug("%s", ", ".join([hex(byte) for byte in cmd]))
-        else:
-            # Wait on this thread or get a segmentation fault!
-            time.sleep (50.0 / 1000.0);
-            # self.data_logger.debug("%s", ", ".join([hex(byte) for byte in cmd]))
-
-    def send_command_2(self, cmd):
-        if not self.block_sending:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.device_service.ip, TCP_PORT_2))
-            s.send(cmd)
-            s.close()
-            self.data_logger.debug("%s", ", ".join([hex(byte) for byte in cmd]))
-        else:
-            # Wait on this thread or get a segmentation fault!
-            time.sleep (50.0 / 1000.0);
-            # self.data_logger.debug("%s", ", ".join([hex(byte) for byte in cmd]))
+    def close(self):
+        self.scheduler.close()
+
+    def send_command(self, cmd, probe = False):
+        self.scheduler.submit(cmd, self.device_service.port, probe)
+
+    def send_command_2(self, cmd, probe = False):
+        self.scheduler.submit(cmd, self.device_service.port_2, probe)
+
+    def send_batch(self, cmds):
+        self.scheduler.submit_batch(cmds, self.device_service.port)
 
     def send_command_w(self, widget, cmd):
         self.send_command(cmd)
@@ -563,10 +1030,12 @@ class CommandService():
                 self.state_service.update_hdmiout(True)
 
     def set_volume(self, widget, vol):
-        cmd = bytearray([0x02, 0x06, 0xA0, 0x52, 0x00, 0x03, 0x00, min(vol, LIMIT_VOLUME), 0x00])
-        self.send_command(cmd)
+        self.volume_controller.set_target(min(vol, LIMIT_VOLUME))
         self.state_service.update_volume(vol)
 
+    def send_volume(self, vol):
+        self.send_command(CMD_VOLUME[min(vol, LIMIT_VOLUME)])
+
     def volume_up(self):
         target_volume = self.state_service.volume + self.scroll_step_volume
         if target_volume <= MAX_VOLUME:
@@ -648,503 +1117,866 @@ class CommandService():
                 self.send_command(CMD_SOURCE_MAP["fmTuner"])
             self.send_command(CMD_FMTUNER_PRESET_DOWN)
 
+    # Zones: the commands for several zones are sent as one batch
 
-class ScanPort(threading.Thread):
+    def send_zones(self, cmd, zones, key, value):
+        if self.initialized:
+            self.send_batch([with_zone(cmd, zone) for zone in zones])
+            for zone in zones:
+                self.state_service.update_zone(zone, key, value)
 
-    ip = None
-    result = -1
+    def power_zones(self, zones, power):
+        self.send_zones(CMD_POWER_ON if power else CMD_POWER_OFF, zones, "power", power)
 
-    def __init__(self, ip):
-        threading.Thread.__init__(self)
-        self.ip = ip
+    def mute_zones(self, zones, muted):
+        self.send_zones(CMD_MUTE if muted else CMD_UNMUTE, zones, "muted", muted)
 
-    def run(self):
-        _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        _socket.settimeout(3)
-        self.result = _socket.connect_ex((self.ip, TCP_PORT_1))
-        _socket.close()
+    def select_source_zones(self, zones, source):
+        self.send_zones(CMD_SOURCE_MAP[source], zones, "source", source)
 
+    def set_zone_volume(self, zone, vol):
+        if zone == ZONE_MAIN:
+            self.set_volume(None, vol)
+        else:
+            self.send_zones(CMD_VOLUME[min(vol, LIMIT_VOLUME)], [zone], "volume", vol)
 
-class GtkUpdater(threading.Thread):
-    
-    ended = False
 
-    def __init__(self):
-        threading.Thread.__init__(self)
-    
-    def run(self):
-        while not self.ended:
-            gtk.main_iteration_do(False)
+class SweepOrdering():
 
-    def kill(self):
-        self.ended = True
+    def order(self, device_service):
+        return device_service.candidates()
+
+
+class NeighborOrdering(SweepOrdering):
+
+    arp_table_path = ARP_TABLE_PATH
+
+    logger = logging.getLogger("dev")
+
+    def neighbors(self):
+        # Returns (ip, mac) of every resolved entry of the neighbor table
+        neighbors = []
+        try:
+            with open(self.arp_table_path) as arp_table:
+                next(arp_table)
+                for line in arp_table:
+                    fields = line.split()
+                    if len(fields) >= 4 and int(fields[2], 16) & ATF_COM:
+                        neighbors.append((fields[0], fields[3].lower()))
+        except (OSError, ValueError, StopIteration) as e:
+            self.logger.debug("Failed to read the neighbor table: %s" %(e))
+        return neighbors
+
+    def order(self, device_service):
+        # Probes known hosts first, those with a Sony MAC address before all
+        # others, and only then sweeps the rest of the networks
+        networks = [network.network for network in device_service.networks]
+        own_ips = set([str(network.ip) for network in device_service.networks])
+        neighbors = [(ip, mac) for ip, mac in self.neighbors() if ip not in own_ips and any([ipaddress.IPv4Address(ip) in network for network in networks])]
+        neighbors.sort(key = lambda neighbor: neighbor[1][:8] not in SONY_OUIS)
+        tried = set()
+        for ip, mac in neighbors:
+            if ip not in tried:
+                tried.add(ip)
+                yield ip
+        for ip in device_service.candidates():
+            if ip not in tried:
+                yield ip
 
 
 class DeviceService():
 
     initialized = False
+    event_loop = None
     my_ip = None
     my_network = None
+    networks = None
 
     ip = None
+    port = TCP_PORT_1
+    port_2 = TCP_PORT_2
+    model = None
+
+    candidate_ordering = NeighborOrdering()
+
+    cache_path = CACHE_PATH
+    route_table_path = ROUTE_TABLE_PATH
+    cache_validate_interval = 300.0
+    model_timeout = 2.0
+
+    scan_timeout = 3.0
+    scan_concurrency = 64
+    sweep_prefixlen = SWEEP_PREFIXLEN
+    scan_wanted = 1
+    scan_duration = None
+    scan_rate = None
+    rediscovery = None
 
     logger = logging.getLogger("dev")
 
-    def __init__(self):
-        self.my_ip = [l for l in ([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")][:1], [[(s.connect(('8.8.8.8', 53)), s.getsockname()[0], s.close()) for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) if l][0][0]
-        self.my_network = self.my_ip.rsplit(".", 1)[0]
-        self.logger.debug("Network: %s IP: %s" %(self.my_network, self.my_ip))
-
-    def find_device(self):
-        self.logger.debug("Searching for devices in %s.*" %(self.my_network))
-        threads = []
-        for last_octet in range(1, 254):
-            device_ip = "%s.%s" %(self.my_network, last_octet)
-            thread = ScanPort(device_ip)
-            thread.start()
-            threads.append(thread)
-
-        gtk_updater = GtkUpdater()
-        gtk_updater.start()
-
-        for last_octet in range(1, 254):
-            threads[last_octet - 1].join()
-            if threads[last_octet - 1].result == 0:
-                self.ip = threads[last_octet - 1].ip
-                self.logger.info("Detected device on %s:%d" %(self.ip, TCP_PORT_1))
-
-        gtk_updater.kill()
-
-        if self.ip == None:
+    def __init__(self, event_loop, networks = None):
+        self.event_loop = event_loop
+        self.networks = networks if networks != None else self.find_networks()
+        if self.networks:
+            self.my_ip = str(self.networks[0].ip)
+            self.my_network = str(self.networks[0].network)
+        for network in self.networks:
+            self.logger.debug("Network: %s IP: %s" %(network.network, network.ip))
+
+    def find_networks(self):
+        # Asks the kernel for the address and netmask of every interface
+        # which is up and running, so no packets leave the machine and no /24
+        # is assumed. Bridges without a cable or container, like docker0,
+        # are not running, and no receiver sits behind a point-to-point link.
+        networks = []
+        default_interfaces = self.default_interfaces()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as _socket:
+                for index, name in socket.if_nameindex():
+                    request = struct.pack("256s", name.encode("utf-8")[:15])
+                    flags = struct.unpack("H", fcntl.ioctl(_socket.fileno(), SIOCGIFFLAGS, request)[16:18])[0]
+                    if not flags & IFF_UP or not flags & IFF_RUNNING or flags & (IFF_LOOPBACK | IFF_POINTOPOINT):
+                        continue
+                    try:
+                        address = socket.inet_ntoa(fcntl.ioctl(_socket.fileno(), SIOCGIFADDR, request)[20:24])
+                        netmask = socket.inet_ntoa(fcntl.ioctl(_socket.fileno(), SIOCGIFNETMASK, request)[20:24])
+                    except OSError:
+                        # Interface without an IPv4 address
+                        continue
+                    network = ipaddress.IPv4Interface("%s/%s" %(address, netmask))
+                    if network not in [known for known, known_name in networks]:
+                        networks.append((network, name))
+        except OSError as e:
+            self.logger.warning("Failed to enumerate network interfaces: %s" %(e))
+        networks.sort(key = lambda network: network[1] not in default_interfaces)
+        networks = [network for network, name in networks]
+        if not networks:
+            try:
+                for address in socket.gethostbyname_ex(socket.gethostname())[2]:
+                    if not address.startswith("127."):
+                        self.logger.warning("Assuming %s/24" %(address))
+                        networks.append(ipaddress.IPv4Interface("%s/24" %(address)))
+            except OSError as e:
+                self.logger.error("Failed to resolve the local address: %s" %(e))
+        return networks
+
+    def default_interfaces(self):
+        names = set()
+        try:
+            with open(self.route_table_path) as route_table:
+                next(route_table)
+                for line in route_table:
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[1] == "00000000":
+                        names.add(fields[0])
+        except (OSError, StopIteration) as e:
+            self.logger.debug("Failed to read the routing table: %s" %(e))
+        return names
+
+    def device_id(self):
+        return device_id(self.ip, self.port)
+
+    def candidates(self):
+        # Interleaves the hosts of all networks, so every network is probed
+        # right from the start no matter how large the others are
+        own_ips = set(network.ip for network in self.networks)
+        hosts = [self.hosts(network) for network in self.networks]
+        for ip in itertools.chain.from_iterable(itertools.zip_longest(*hosts)):
+            if ip != None and ip not in own_ips:
+                yield str(ip)
+
+    def hosts(self, network):
+        # The receiver most likely sits next to us, so a large network is
+        # swept from the sweep_prefixlen around the own address outwards
+        if network.network.prefixlen >= self.sweep_prefixlen:
+            return network.network.hosts()
+        near = ipaddress.IPv4Interface("%s/%d" %(network.ip, self.sweep_prefixlen)).network
+        edges = (network.network.network_address, network.network.broadcast_address)
+        return itertools.chain((ip for ip in near if ip not in edges), (ip for ip in network.network.hosts() if ip not in near))
+
+    async def scan_port(self, ip, port = TCP_PORT_1):
+        _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _socket.setblocking(False)
+        try:
+            await asyncio.wait_for(self.event_loop.loop.sock_connect(_socket, (ip, port)), self.scan_timeout)
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            _socket.close()
+
+    async def scan(self, ips, port = TCP_PORT_1, wanted = None):
+        # Probes the hosts in the given order with at most scan_concurrency
+        # connects in flight and returns as soon as wanted devices answered
+        # (all responding devices if wanted is 0)
+        if wanted == None:
+            wanted = self.scan_wanted
+        loop = self.event_loop.loop
+        started = loop.time()
+        candidates = iter(ips)
+        found = []
+        probed = 0
+        running = self.scan_concurrency
+        done = loop.create_future()
+
+        async def probe():
+            nonlocal probed, running
+            try:
+                for ip in candidates:
+                    probed += 1
+                    if await self.scan_port(ip, port):
+                        found.append(ip)
+                        self.logger.info("Detected device on %s:%d" %(ip, port))
+                        if wanted and len(found) >= wanted:
+                            break
+            finally:
+                running -= 1
+                if (running == 0 or (wanted and len(found) >= wanted)) and not done.done():
+                    done.set_result(None)
+
+        workers = [loop.create_task(probe()) for i in range(self.scan_concurrency)]
+        try:
+            await done
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions = True)
+
+        self.scan_duration = loop.time() - started
+        METRIC_DISCOVERY.observe(self.scan_duration)
+        self.scan_rate = probed / self.scan_duration if self.scan_duration > 0 else 0.0
+        self.logger.info("Probed %d hosts in %.2f s (%.0f hosts/s)" %(probed, self.scan_duration, self.scan_rate))
+        return found
+
+    async def discover(self, ordering = None):
+        if ordering == None:
+            ordering = self.candidate_ordering
+        self.logger.debug("Searching for devices in %s" %(", ".join([str(network.network) for network in self.networks])))
+        found = await self.scan(ordering.order(self), self.port)
+        if found:
+            if found[0] != self.ip:
+                self.model = None
+            self.ip = found[0]
+            self.save_cache()
+        else:
             self.logger.error("No device found in the local network!")
+        return self.ip
+
+    async def rediscover(self):
+        # Joins a discovery which is already running, so the feedback
+        # watchers losing the device at the same time scan only once
+        if self.rediscovery == None or self.rediscovery.done():
+            self.rediscovery = self.event_loop.loop.create_task(self.discover())
+        return await asyncio.shield(self.rediscovery)
+
+    async def locate(self):
+        # Tries the last known device with a single connect before scanning
+        cache = self.load_cache()
+        if cache != None and await self.scan_port(cache["ip"], cache["port"]):
+            self.ip = cache["ip"]
+            self.port = cache["port"]
+            self.model = cache.get("model")
+            self.logger.info("Found cached device on %s:%d" %(self.ip, self.port))
+        else:
+            await self.discover()
+        return self.ip
+
+    async def validate_cache(self):
+        # Runs in the background: the receiver may get another address
+        loop = self.event_loop.loop
+        while True:
+            if self.ip != None and self.model == None:
+                self.model = await loop.run_in_executor(None, self.fetch_model)
+                if self.model != None:
+                    self.logger.info("Device model: %s" %(self.model))
+                    self.save_cache()
+            await asyncio.sleep(self.cache_validate_interval)
+            if self.ip == None or not await self.scan_port(self.ip, self.port):
+                self.logger.info("Device %s is not responding: searching..." %(self.ip))
+                await self.rediscover()
+
+    def start_cache_validation(self):
+        self.event_loop.submit(self.validate_cache())
+
+    def fetch_model(self):
+        data = json.dumps({"method": "getInterfaceInformation", "id": 1, "params": [], "version": "1.0"}).encode("utf-8")
+        request = urllib.request.Request("http://%s:%d/sony/system" %(self.ip, SONY_API_PORT), data, {"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout = self.model_timeout) as response:
+                return json.loads(response.read().decode("utf-8"))["result"][0]["modelName"]
+        except Exception as e:
+            self.logger.debug("Failed to fetch the device model: %s" %(e))
+            return None
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+            if isinstance(cache.get("ip"), str) and isinstance(cache.get("port"), int):
+                return cache
+        except (OSError, ValueError, AttributeError) as e:
+            self.logger.debug("No usable device cache: %s" %(e))
+        return None
+
+    def save_cache(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+            with open(self.cache_path + ".tmp", "w") as cache_file:
+                json.dump({"ip": self.ip, "port": self.port, "model": self.model}, cache_file)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError as e:
+            self.logger.warning("Failed to write the device cache: %s" %(e))
+
+    def find_device(self, ordering = None):
+        return self.event_loop.run_until_complete(self.discover(ordering))
+
+
+class FeedbackProtocol(asyncio.BufferedProtocol):
+
+    watcher = None
+    transport = None
+    closed = None
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.closed = watcher.event_loop.loop.create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        # Received data goes straight into the preallocated buffer
+        return self.watcher.receive_buffer
 
+    def buffer_updated(self, nbytes):
+        self.watcher.data_received(nbytes)
 
-class FeedbackWatcher(threading.Thread):
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
 
+
+class Backoff():
+
+    # Exponential delays between attempts, each one drawn from the upper
+    # half of its range so reconnecting clients do not move in lockstep
+
+    initial = 0.5
+    maximum = 10.0
+    attempts = 0
+
+    def __init__(self, initial = None, maximum = None):
+        if initial != None:
+            self.initial = initial
+        if maximum != None:
+            self.maximum = maximum
+
+    def next(self):
+        delay = min(self.initial * 2 ** min(self.attempts, 16), self.maximum)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class FeedbackWatcher():
+
+    event_loop = None
     device_service = None
     state_service = None
     command_service = None
     ended = False
-    socket = None
+    stopped = None
+    transport = None
+    protocol = None
+    future = None
+    retry = None
     port = None
+    decoder = None
+    capture = None
+    backoff = None
+    state = CONNECTION_CONNECTING
+    last_received = 0
+    probe_sent = None
+
+    connect_timeout = 3.0
+    # The receiver only sends feedback on changes. TCP keepalive finds out
+    # whether it is still there, and every check_interval seconds the watcher
+    # asks the kernel whether keepalive probes are going unanswered. After
+    # check_interval seconds without feedback it also restates the reported
+    # mute state, which the receiver answers without changing anything, and
+    # reconnects if the answer is not there by the next check.
+    check_interval = 3.0
+    # Searches the networks once per outage, after this many failed connects
+    # in a row and next to the further attempts, as the receiver may have got
+    # another address (None to stick to the address). A search which did not
+    # find it is repeated on a backoff of its own.
+    rediscover_after = 3
+    rediscover_delay = 30.0
+    rediscover_max_delay = 1800.0
 
     logger = logging.getLogger("feed")
     data_logger = logging.getLogger("recv")
 
     def __init__(self, sony_av_indicator, device_service, state_service, command_service, port):
-        threading.Thread.__init__(self)
+        self.event_loop = device_service.event_loop
         self.sony_av_indicator = sony_av_indicator
         self.device_service = device_service
         self.state_service = state_service
         self.command_service = command_service
         self.port = port
+        self.decoder = FrameDecoder()
+        self.backoff = Backoff()
+        self.handlers = dict((key, getattr(self, name)) for key, name in FEEDBACK_HANDLERS.items())
+        self.receive_buffer = bytearray(BUFFER_SIZE)
+        self.receive_view = memoryview(self.receive_buffer)
         self.data_logger = logging.getLogger("recv:%s"%(port))
 
+    def start(self):
+        self.future = self.event_loop.submit(self.run())
+
     def kill(self):
         self.ended = True
-        self.socket.shutdown(socket.SHUT_WR)
-
-    def check_volume(self, data):
-        if FEEDBACK_VOLUME == data[:-1]:
-            vol = data[-1]
-            if vol < LIMIT_VOLUME:
-                self.state_service.update_volume(vol)
-            else:
-                self.command_service.block_sending = False
-                self.command_service.set_volume(None, LIMIT_VOLUME)
-                self.command_service.block_sending = True
-            return True
-        return False
-
-    def check_source(self, data):
-        source_switched = False
-        for source, source_feedback in FEEDBACK_SOURCE_MAP.items():
-            if source_feedback == data[:-2]:
-                self.sony_av_indicator.update_source(source)
-                # The command also contains the power and muted states
-                if FEEDBACK_POWER_OFF == data[-2]:
-                    self.state_service.update_power(False, True)
-                elif FEEDBACK_MUTE_OFF == data[-2]:
-                    self.state_service.update_power(True, True)
-                    self.state_service.update_muted(False)
-                elif FEEDBACK_MUTE_ON == data[-2]:
-                    self.state_service.update_power(True, True)
-                    self.state_service.update_muted(True)
-                source_switched = True
-        return source_switched
-
-    def check_sound_field(self, data):
-        sound_field_switched = False
-        for sound_field, sound_field_feedback in FEEDBACK_SOUND_FIELD_MAP.items():
-            if sound_field_feedback == data:
-                self.sony_av_indicator.update_sound_field(sound_field)
-                sound_field_switched = True
-        return sound_field_switched
-
-    def check_pure_direct(self, data):
-        if FEEDBACK_PURE_DIRECT_ON == data:
-            self.state_service.update_pure_direct(True)
-            return True
-        elif FEEDBACK_PURE_DIRECT_OFF == data:
-            self.state_service.update_pure_direct(False)
-            return True
-        return False
-
-    def check_sound_optimizer(self, data):
-        if FEEDBACK_SOUND_OPTIMIZER_PREFIX == data[:-1]:
-            if FEEDBACK_SOUND_OPTIMIZER_OFF == data[-1]:
-                self.state_service.update_sound_optimizer("off")
-            elif FEEDBACK_SOUND_OPTIMIZER_NORMAL == data[-1]:
-                self.state_service.update_sound_optimizer("normal")
-            elif FEEDBACK_SOUND_OPTIMIZER_LOW == data[-1]:
-                self.state_service.update_sound_optimizer("low")
-            return True
-        return False
-
-    def check_timer(self, data):
-        if FEEDBACK_TIMER_PREFIX == data[:-3]:
-            if FEEDBACK_TIMER_SET == data[-1]:
-                self.state_service.update_timer(data[-3], data[-2], data[-1], True, False)
-                return True
-            elif FEEDBACK_TIMER_UPDATE == data[-1]:
-                self.state_service.update_timer(data[-3], data[-2], data[-1], True, True)
-                return True
-            elif FEEDBACK_TIMER_OFF == data[-1]:
-                self.state_service.update_timer(data[-3], data[-2], data[-1], False, False)
-                return True
-            else:
-                return True
-        return False
+        self.event_loop.call(self.stop)
 
-    def check_fmtuner(self, data):
-        if FEEDBACK_FMTUNER_PREFIX == data[0:5]:
-            fmtuner = data[5]
-            stereo = True
-            if data[6] == FEEDBACK_FMTUNER_MONO:
-                stereo = False
-            freq = round(((data[7] * 255 + data[8]) / 99.5) - 0.1, 1)
-            self.state_service.update_fmtuner(fmtuner, stereo, freq)
-            self.state_service.update_source("fmTuner")
-            return True
-        return False
+    def stop(self):
+        # Also wakes up a pending reconnect
+        if self.stopped != None and not self.stopped.done():
+            self.stopped.set_result(None)
+        self.disconnect()
 
-    def check_auto_standby(self, data):
-        if FEEDBACK_AUTO_STANDBY_OFF == data:
-            self.state_service.update_auto_standby(False)
-            return True
-        elif FEEDBACK_AUTO_STANDBY_ON == data:
-            self.state_service.update_auto_standby(True)
-            return True
-        return False
+    def join(self, timeout = None):
+        if self.future != None:
+            try:
+                self.future.result(timeout)
+            except Exception:
+                pass
 
-    def check_auto_phase_matching(self, data):
-        if FEEDBACK_AUTO_PHASE_MATCHING_OFF == data:
-            self.state_service.update_auto_phase_matching(False)
-            return True
-        elif FEEDBACK_AUTO_PHASE_MATCHING_AUTO == data:
-            self.state_service.update_auto_phase_matching(True)
-            return True
-        return False
+    def on_volume(self, event):
+        if event.zone != ZONE_MAIN:
+            self.state_service.update_zone(event.zone, "volume", event.volume)
+        elif event.volume < LIMIT_VOLUME:
+            if self.command_service.volume_controller.feedback(event.volume):
+                self.state_service.update_volume(event.volume)
+        else:
+            self.command_service.set_volume(None, LIMIT_VOLUME)
+
+    def on_source(self, event):
+        if event.zone != ZONE_MAIN:
+            self.on_zone_source(event)
+            return
+        self.sony_av_indicator.update_source(event.source)
+        if event.power == False:
+            self.state_service.update_power(False, True)
+        elif event.power == True:
+            self.state_service.update_power(True, True)
+            self.state_service.update_muted(event.muted)
+
+    def on_zone_source(self, event):
+        self.state_service.update_zone(event.zone, "source", event.source)
+        if event.power != None:
+            self.state_service.update_zone(event.zone, "power", event.power)
+        if event.muted != None:
+            self.state_service.update_zone(event.zone, "muted", event.muted)
+
+    def on_sound_field(self, event):
+        self.sony_av_indicator.update_sound_field(event.sound_field)
+
+    def on_pure_direct(self, event):
+        self.state_service.update_pure_direct(event.pure_direct)
+
+    def on_sound_optimizer(self, event):
+        if event.sound_optimizer != None:
+            self.state_service.update_sound_optimizer(event.sound_optimizer)
+
+    def on_timer(self, event):
+        if event.seconds == FEEDBACK_TIMER_SET[0]:
+            self.state_service.update_timer(event.hours, event.minutes, event.seconds, True, False)
+        elif event.seconds == FEEDBACK_TIMER_UPDATE[0]:
+            self.state_service.update_timer(event.hours, event.minutes, event.seconds, True, True)
+        elif event.seconds == FEEDBACK_TIMER_OFF[0]:
+            self.state_service.update_timer(event.hours, event.minutes, event.seconds, False, False)
+
+    def on_fmtuner(self, event):
+        self.state_service.update_fmtuner(event.preset, event.stereo, event.freq)
+        self.state_service.update_source("fmTuner")
+
+    def on_auto_standby(self, event):
+        self.state_service.update_auto_standby(event.auto_standby)
+
+    def on_auto_phase_matching(self, event):
+        self.state_service.update_auto_phase_matching(event.auto_phase_matching)
 
     def probe_volume(self):
-        time.sleep(0.1)
-        self.command_service.send_command(CMD_VOLUME_DOWN)
-        time.sleep(0.1)
-        self.command_service.send_command(CMD_VOLUME_UP)
+        self.probe(CMD_VOLUME_DOWN, CMD_VOLUME_UP)
 
     def probe_input(self):
-        time.sleep(0.1)
-        self.command_service.send_command(CMD_MUTE)
-        time.sleep(0.1)
-        self.command_service.send_command(CMD_UNMUTE)
+        self.probe(CMD_MUTE, CMD_UNMUTE)
+
+    def probe(self, *cmds):
+        for cmd in cmds:
+            self.command_service.send_command(cmd, True)
 
     def debug_data(self, data, prepend_text=""):
-        self.data_logger.debug("%s%s" %(prepend_text, binascii.hexlify(data)))
-
-    def connect(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.socket.connect((self.device_service.ip, TCP_PORT_1))
-        #self.logger.info("Connected to %s:%d" % (self.device_service.ip, TCP_PORT_1))
-        self.socket.connect((self.device_service.ip, self.port))
-        self.socket.settimeout(60.0)
+        if self.data_logger.isEnabledFor(logging.DEBUG):
+            self.data_logger.debug("%s%s" %(prepend_text, binascii.hexlify(data)))
+
+    def set_state(self, state):
+        if state != self.state:
+            self.logger.debug("%s:%d is %s" %(self.device_service.ip, self.port, CONNECTION_STATES[state]))
+            self.state = state
+        METRIC_FEEDBACK_STATE.set(state, self.port)
+
+    async def pause(self, delay):
+        # Sleeps for delay seconds, until killed or until retry_now()
+        self.retry = self.event_loop.loop.create_future()
+        await asyncio.wait([self.stopped, self.retry], timeout = delay)
+        self.retry = None
+
+    def retry_now(self):
+        if self.retry != None and not self.retry.done():
+            self.retry.set_result(None)
+
+    def link_state(self):
+        # Reads the unanswered keepalive probes (tcpi_probes of struct
+        # tcp_info) from the kernel, nothing is sent for it
+        _socket = self.transport.get_extra_info("socket") if self.transport != None else None
+        if _socket == None or not hasattr(socket, "TCP_INFO"):
+            return CONNECTION_UP
+        try:
+            info = _socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 8)
+        except OSError:
+            return CONNECTION_UP
+        return CONNECTION_DEGRADED if info[3] > 0 else CONNECTION_UP
+
+    def check(self):
+        # Returns False if the receiver did not answer the last probe
+        now = self.event_loop.loop.time()
+        if self.probe_sent != None:
+            if self.last_received < self.probe_sent:
+                return False
+            self.probe_sent = None
+        if now - self.last_received >= self.check_interval:
+            self.probe_liveness(now)
+        self.set_state(self.link_state())
+        return True
+
+    def probe_liveness(self, now):
+        # Only the state last reported by the receiver is restated. Nothing
+        # is sent while it is off, as it may not answer then.
+        reported = self.command_service.echo_tracker.reported
+        power = reported.get("power")
+        muted = reported.get("muted")
+        if power == None or not power[0] or muted == None:
+            return
+        self.probe_sent = now
+        self.command_service.scheduler.submit(CMD_MUTE if muted[0] else CMD_UNMUTE, self.port, True)
+
+    async def connect(self):
+        loop = self.event_loop.loop
+        self.transport, self.protocol = await asyncio.wait_for(loop.create_connection(lambda: FeedbackProtocol(self), self.device_service.ip, self.port), self.connect_timeout)
+        _socket = self.transport.get_extra_info("socket")
+        if _socket != None:
+            set_keepalive(_socket)
+        self.last_received = loop.time()
+        self.probe_sent = None
+        self.decoder.reset()
         self.logger.info("Connected to %s:%d" % (self.device_service.ip, self.port))
-        
-    def reconnect(self):
-        self.socket.close()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.device_service.ip, TCP_PORT_1))
-        self.socket.settimeout(60.0)
-        self.command_service.block_sending = False
-        self.logger.info("Reconnected")
 
-    def run(self):
-        self.connect()
+    def disconnect(self):
+        if self.transport != None:
+            self.transport.close()
+            self.transport = None
+
+    async def reconnect(self):
+        self.disconnect()
+        self.backoff.reset()
+        failures = 0
+        rediscovery = None
+        try:
+            while not self.ended:
+                self.set_state(CONNECTION_CONNECTING)
+                try:
+                    await self.connect()
+                    self.set_state(CONNECTION_UP)
+                    return
+                except (OSError, asyncio.TimeoutError) as e:
+                    METRIC_FEEDBACK_CONNECT_FAILURES.inc(self.port)
+                    failures += 1
+                    delay = self.backoff.next()
+                    self.set_state(CONNECTION_DOWN)
+                    self.logger.warning("Failed to connect to %s:%d: %s, retrying in %.1f s" %(self.device_service.ip, self.port, e, delay))
+                if rediscovery == None and self.rediscover_after != None and failures >= self.rediscover_after:
+                    rediscovery = self.event_loop.loop.create_task(self.rediscover())
+                await self.pause(delay)
+        finally:
+            if rediscovery != None:
+                rediscovery.cancel()
+
+    async def rediscover(self):
+        # Runs until cancelled by the end of the outage or the receiver
+        # turned up on another address
+        backoff = Backoff(self.rediscover_delay, self.rediscover_max_delay)
+        while not self.ended:
+            ip = self.device_service.ip
+            if await self.device_service.rediscover() != ip:
+                self.logger.info("Device moved from %s to %s" %(ip, self.device_service.ip))
+                self.backoff.reset()
+                self.retry_now()
+                return
+            await asyncio.sleep(backoff.next())
+
+    def process_frame(self, data):
+        # The frame is only valid during this call, the trace keeps a copy
+        TRACE.record(TRACE_IN, self.port, bytes(data))
+        event = decode_feedback(data)
+        if event == None:
+            METRIC_FEEDBACK_UNKNOWN.inc()
+            if not self.ended:
+                self.debug_data(data, "[unknown data packet]\n")
+            return
+        METRIC_FEEDBACK_FRAMES.inc(type(event))
+        echo_tracker = self.command_service.echo_tracker
+        if echo_tracker.received(event, self.last_received):
+            self.logger.debug("Echo of a sent command")
+        echo_tracker.dispatching = True
+        try:
+            self.handlers[type(event)](event)
+        finally:
+            echo_tracker.dispatching = False
+
+    def data_received(self, size):
+        if self.capture != None:
+            self.capture.record(self.port, bytes(self.receive_view[:size]))
+        self.feed(self.receive_view[:size])
+
+    def feed(self, data):
+        # Also called by CaptureReplay, without a connection
+        self.last_received = self.event_loop.loop.time()
+        METRIC_FEEDBACK_BYTES.inc(None, len(data))
+        try:
+            for frame in self.decoder.feed(data):
+                self.process_frame(frame)
+        except Exception as e:
+            if self.transport == None:
+                raise
+            self.logger.exception("Failed to process data: reconnecting...")
+            self.transport.abort()
+
+    async def run(self):
+        loop = self.event_loop.loop
+        self.stopped = loop.create_future()
+        if self.ended:
+            self.stopped.set_result(None)
+        await self.reconnect()
         while not self.ended:
+            # Sleeps until the connection is lost, which includes keepalive
+            # giving up on the receiver, checking the link in between
             try:
-                time.sleep(0.1)
-                data = self.socket.recv(BUFFER_SIZE)
-                # Prevent feedback loops by block sending commands
-                self.command_service.block_sending = True
-                if not self.ended:
-                    self.debug_data(data)
-                if not self.check_timer(data) and \
-                   not self.check_source(data) and \
-                   not self.check_sound_field(data) and \
-                   not self.check_pure_direct(data) and \
-                   not self.check_sound_optimizer(data) and \
-                   not self.check_fmtuner(data) and \
-                   not self.check_volume(data) and \
-                   not self.check_auto_standby(data) and \
-                   not self.check_auto_phase_matching(data) and \
-                   not self.ended:
-                    self.debug_data(data, "[unknown data packet]\n")
-            except socket.timeout as e:
-                self.logger.debug("Timeout: reconnecting...")
-                self.reconnect()
-            except Exception as e:
-                self.logger.exception("Failed to process data: reconnecting...")
-                self.reconnect()
-            finally:
-                # Unblock sending commands after processing
-                self.command_service.block_sending = False
-        self.socket.close()
+                exc = await asyncio.wait_for(asyncio.shield(self.protocol.closed), self.check_interval)
+            except asyncio.TimeoutError:
+                if self.check():
+                    continue
+                exc = TimeoutError("Probe not answered")
+            if self.ended:
+                break
+            if isinstance(exc, TimeoutError):
+                METRIC_FEEDBACK_TIMEOUTS.inc(self.port)
+                self.logger.warning("%s:%d is not responding: reconnecting..." %(self.device_service.ip, self.port))
+            else:
+                self.logger.debug("Connection closed by peer: reconnecting...")
+            self.set_state(CONNECTION_DOWN)
+            METRIC_FEEDBACK_RECONNECTS.inc(self.port)
+            await self.reconnect()
+        self.disconnect()
+        self.set_state(CONNECTION_DOWN)
         self.logger.info("Connection closed")
 
 
-class MprisServer(threading.Thread, dbus.service.Object):
+class Receiver():
+
+    # One more receiver besides the one of the indicator: its own commands,
+    # feedback watchers and state, driven by the event loop of the registry.
+    # Stands in for the indicator towards the services and logs the
+    # notifications.
 
-    sony_av_indicator = None
     device_service = None
     state_service = None
     command_service = None
-    properties = None
-    bus = None
-    ended = False
-
-    def __init__(self, sony_av_indicator, device_service, state_service, command_service):
-        threading.Thread.__init__(self)
-        self.sony_av_indicator = sony_av_indicator
-        self.device_service = device_service
-        self.state_service = state_service
-        self.command_service = command_service
-        self.properties = {
-            ROOT_INTERFACE: self._get_root_iface_properties(),
-            PLAYER_INTERFACE: self._get_player_iface_properties()
-        }
-        self.main_loop = dbus.mainloop.glib.DBusGMainLoop(set_as_default = True)
-        # self.main_loop = GObject.MainLoop()
-        self.bus = dbus.SessionBus(mainloop = self.main_loop)
-        self.bus_name = self._connect_to_dbus()
-        dbus.service.Object.__init__(self, self.bus_name, OBJECT_PATH)
-
-    def _get_root_iface_properties(self):
-        return {
-            'CanQuit': (True, None),
-            'Fullscreen': (False, None),
-            'CanSetFullscreen': (False, None),
-            'CanRaise': (False, None),
-            # NOTE Change if adding optional track list support
-            'HasTrackList': (False, None),
-            'Identity': (IDENTITY, None),
-            'DesktopEntry': (DESKTOP, None),
-            'SupportedUriSchemes': (dbus.Array([], 's', 1), None),
-            # NOTE Return MIME types supported by local backend if support for
-            # reporting supported MIME types is added
-            'SupportedMimeTypes': (dbus.Array([], 's', 1), None),
-        }
-
-    def _get_player_iface_properties(self):
-        return {
-            'PlaybackStatus': (self.get_playback_status, None),
-            'LoopStatus': (self.get_loop_status, None),
-            'Rate': (1.0, None),
-            'Shuffle': (None, None),
-            'Metadata': (self.get_metadata, None),
-            'Volume': (self.get_volume, self.set_volume),
-            'Position': (None, None),
-            'MinimumRate': (1.0, None),
-            'MaximumRate': (1.0, None),
-            'CanGoNext': (self.can_go_next, None),
-            'CanGoPrevious': (self.can_go_previous, None),
-            'CanPlay': (self.can_play, None),
-            'CanPause': (self.can_pause, None),
-            'CanSeek': (self.can_seek, None),
-            'CanControl': (self.can_control, None),
-        }
-
-    def _connect_to_dbus(self):
-        # bus_type = self.config['mpris']['bus_type']
-        self.bus = dbus.SessionBus()
-        bus_name = dbus.service.BusName(BUS_NAME, self.bus)
-        return bus_name
-
-    def get_playback_status(self):
-        return 'Playing'
-
-    def get_loop_status(self):
-        return 'None'
-
-    def can_go_next(self):
-        return True
-
-    def can_go_previous(self):
-        return True
-
-    def can_play(self):
-        return True
-
-    def can_pause(self):
-        return True
+    feedback_watchers = None
+    device_id = None
+
+    def __init__(self, registry, ip, port = TCP_PORT_1, port_2 = TCP_PORT_2):
+        self.device_service = DeviceService(registry.event_loop, registry.discovery.networks)
+        self.device_service.ip = ip
+        self.device_service.port = port
+        self.device_service.port_2 = port_2
+        self.device_id = self.device_service.device_id()
+        self.state_service = StateService(self)
+        self.command_service = CommandService(self.device_service, self.state_service)
+        self.feedback_watchers = [FeedbackWatcher(self, self.device_service, self.state_service, self.command_service, port) for port in (port, port_2)]
+        for feedback_watcher in self.feedback_watchers:
+            # The address identifies the receiver in the registry
+            feedback_watcher.rediscover_after = None
+        self.logger = logging.getLogger("rcv:%s" %(self.device_id))
 
-    def can_seek(self):
-        return True
+    def start(self):
+        self.device_service.initialized = True
+        self.state_service.initialized = True
+        self.command_service.initialized = True
+        for feedback_watcher in self.feedback_watchers:
+            feedback_watcher.start()
+        self.feedback_watchers[0].probe_volume()
+        self.feedback_watchers[0].probe_input()
+
+    def close(self):
+        for feedback_watcher in self.feedback_watchers:
+            feedback_watcher.kill()
+        self.command_service.close()
 
-    def can_control(self):
-        return True
+    def get_volume_icon(self, vol):
+        return None
 
-    def get_metadata(self):
-        metadata = {
-            'mpris:trackid': self.state_service.source,
-            'mpris:length': 60000
-        }
-        return dbus.Dictionary(metadata, signature = 'sv')
-
-    def get_volume(self):
-        volume = self.state_service.volume
-        if volume is None:
-            return 0
-        return volume / 100.0
-
-    def set_volume(self, value):
-        volume = int(value * 100)
-        if volume < 0:
-            volume = 0
-        elif volume > MAX_VOLUME:
-            volume = MAX_VOLUME
-        self.command_service.set_volume(None, volume)
-
-    @dbus.service.method(PLAYER_INTERFACE)
-    def Pause(self):
-        pass
+    def get_volume_icon_path(self, icon_name):
+        return None
 
-    @dbus.service.method(PLAYER_INTERFACE)
-    def PlayPause(self):
-        pass
+    def show_notification(self, title, text, icon, category = None):
+        self.logger.info("%s %s" %(title.replace("<b>", "").replace("</b>", ""), text))
 
-    @dbus.service.method(PLAYER_INTERFACE)
-    def Play(self):
-        pass
-
-    @dbus.service.method(PLAYER_INTERFACE)
-    def Stop(self):
+    def update_label(self, text = None):
         pass
 
-    @dbus.service.method(PLAYER_INTERFACE)
-    def Next(self):
-        self.command_service.source_up()
+    def update_source(self, source, propagate = True):
+        self.state_service.update_source(source)
 
-    @dbus.service.method(PLAYER_INTERFACE)
-    def Previous(self):
-        self.command_service.source_down()
+    def update_sound_field(self, sound_field):
+        self.state_service.update_sound_field(sound_field)
+
+
+class ReceiverRegistry():
+
+    # All receivers of the process by device ID. They share the event loop,
+    # so one thread does the I/O for any number of receivers, and discovery
+    # sweeps the networks once for all of them.
+
+    event_loop = None
+    discovery = None
+    receivers = None
+    owned = None
+    lock = None
+
+    logger = logging.getLogger("reg")
+
+    def __init__(self, event_loop, discovery = None):
+        self.event_loop = event_loop
+        self.discovery = discovery if discovery != None else DeviceService(event_loop)
+        self.receivers = {}
+        self.owned = set()
+        self.lock = threading.Lock()
+
+    def register(self, device_id, receiver):
+        # Any object with a command_service and a state_service, which is
+        # closed by its owner
+        self.receivers[device_id] = receiver
+
+    def add(self, ip, port = TCP_PORT_1, port_2 = TCP_PORT_2):
+        # Thread-safe: connects to the receiver unless it is known already
+        with self.lock:
+            receiver = self.receivers.get(device_id(ip, port))
+            if receiver != None:
+                return receiver
+            receiver = Receiver(self, ip, port, port_2)
+            self.receivers[receiver.device_id] = receiver
+            self.owned.add(receiver.device_id)
+        receiver.start()
+        self.logger.info("Added receiver %s" %(receiver.device_id))
+        return receiver
+
+    def remove(self, device_id):
+        with self.lock:
+            receiver = self.receivers.pop(device_id, None)
+            owned = device_id in self.owned
+            self.owned.discard(device_id)
+        if owned:
+            receiver.close()
+
+    def get(self, device_id):
+        return self.receivers.get(device_id)
+
+    def device_ids(self):
+        return list(self.receivers.keys())
+
+    def send(self, device_id, cmd, probe = False):
+        # Routes the command to the scheduler of the receiver
+        receiver = self.receivers.get(device_id)
+        if receiver == None:
+            self.logger.warning("Unknown receiver %s: dropping command" %(device_id))
+            return False
+        receiver.command_service.send_command(cmd, probe)
+        return True
 
-    # --- Properties interface
+    async def discover(self, ordering = None):
+        # Adds every responding receiver, returns the device IDs found
+        if ordering == None:
+            ordering = self.discovery.candidate_ordering
+        found = await self.discovery.scan(ordering.order(self.discovery), TCP_PORT_1, 0)
+        for ip in found:
+            self.add(ip)
+        return [device_id(ip) for ip in found]
 
-    @dbus.service.method(dbus_interface=PROPERTIES_INTERFACE, in_signature='ss', out_signature='v')
-    def Get(self, interface, prop):
-        print('%s.Get(%s, %s) called' %(dbus.PROPERTIES_IFACE, repr(interface), repr(prop)))
-        (getter, _) = self.properties[interface][prop]
-        if callable(getter):
-            return getter()
-        else:
-            return getter
-
-    @dbus.service.method(dbus_interface=PROPERTIES_INTERFACE, in_signature='s', out_signature='a{sv}')
-    def GetAll(self, interface):
-        print('%s.GetAll(%s) called' %(PROPERTIES_INTERFACE, repr(interface)))
-        getters = {}
-        for key, (getter, _) in self.properties[interface].items():
-            getters[key] = getter() if callable(getter) else getter
-        return getters
-
-    @dbus.service.method(dbus_interface=PROPERTIES_INTERFACE, in_signature='ssv', out_signature='')
-    def Set(self, interface, prop, value):
-        print( '%s.Set(%s, %s, %s) called' %(PROPERTIES_INTERFACE, repr(interface), repr(prop), repr(value)))
-        _, setter = self.properties[interface][prop]
-        if setter is not None:
-            setter(value)
-            self.PropertiesChanged(interface, {prop: self.Get(interface, prop)}, [])
-
-    @dbus.service.signal(dbus_interface=PROPERTIES_INTERFACE, signature='sa{sv}as')
-    def PropertiesChanged(self, interface, changed_properties, invalidated_properties):
-        print('%s.PropertiesChanged(%s, %s, %s) signaled' %(PROPERTIES_INTERFACE, interface, changed_properties, invalidated_properties))
-
-    # --- Root interface methods
-
-    @dbus.service.method(dbus_interface=ROOT_INTERFACE)
-    def Raise(self):
-        print('%s.Raise called' %(ROOT_INTERFACE))
-        # Do nothing, as we do not have a GUI
-
-    @dbus.service.method(dbus_interface=ROOT_INTERFACE)
-    def Quit(self):
-        print('%s.Quit called' %(ROOT_INTERFACE))
-        self.sony_av_indicator.quit(None)
+    def find_devices(self, ordering = None):
+        return self.event_loop.run_until_complete(self.discover(ordering))
 
-    def kill(self):
-        self.ended = True
-
-    def run(self):
-        while not self.ended:
-            try:
-                time.sleep(0.1)
-            except Exception as e:
-                pass
+    def close(self):
+        for device_id in list(self.owned):
+            self.remove(device_id)
 
 
-class SonyAvIndicator():
+class SonyAvDaemon():
 
-    indicator = None
+    event_loop = None
     device_service = None
+    state_service = None
+    command_service = None
     mpris_server = None
     feedback_watcher_1 = None
     feedback_watcher_2 = None
-    command_service = None
-    notification = notify.Notification.new("")
-    notifications_initialized = False
+    receivers = None
+    capture = None
+    metrics_server = None
+    main_loop = None
     initialized = False
 
-    source_menu_items = {}
-    sound_field_menu_items = {}
+    logger = logging.getLogger("main")
 
-    source_group = []
-    sound_field_group = []
+    def __init__(self, mpris = True, all_receivers = False, capture_path = None, metrics_port = None):
 
-    show_source_name = True
-
-    def __init__(self):
-        
-        self.device_service = DeviceService()
+        self.event_loop = EventLoop()
+        self.event_loop.start()
+        self.device_service = DeviceService(self.event_loop)
         self.state_service = StateService(self)
+        self.state_service.add_listener(self.state_changed)
         self.command_service = CommandService(self.device_service, self.state_service)
-        self.mpris_server = MprisServer(self, self.device_service, self.state_service, self.command_service)
-        self.feedback_watcher_1 = FeedbackWatcher(self, self.device_service, self.state_service, self.command_service, TCP_PORT_1)
-        self.feedback_watcher_2 = FeedbackWatcher(self, self.device_service, self.state_service, self.command_service, TCP_PORT_2)
-
-        self.indicator = appindicator.Indicator.new(APPINDICATOR_ID, self.get_volume_icon_path(self.get_volume_icon(LOW_VOLUME)), appindicator.IndicatorCategory.SYSTEM_SERVICES)
-        self.indicator.set_status(appindicator.IndicatorStatus.ACTIVE)
-        self.indicator.set_menu(self.build_menu())
-        self.indicator.connect("scroll-event", self.scroll)
-
-        notify.init(APPINDICATOR_ID)
-        self.notification = notify.Notification.new("")
-        self.notifications_initialized = True
+        if mpris:
+            self.mpris_server = self.create_mpris_server()
+        self.feedback_watcher_1 = FeedbackWatcher(self, self.device_service, self.state_service, self.command_service, self.device_service.port)
+        self.feedback_watcher_2 = FeedbackWatcher(self, self.device_service, self.state_service, self.command_service, self.device_service.port_2)
+        if capture_path != None:
+            self.capture = CaptureWriter(capture_path, self.event_loop.loop)
+            self.feedback_watcher_1.capture = self.capture
+            self.feedback_watcher_2.capture = self.capture
+        if metrics_port != None:
+            self.metrics_server = MetricsServer(metrics_port)
+            self.event_loop.submit(self.metrics_server.start())
+
+        self.init_gui()
 
         signal.signal(signal.SIGINT, signal.SIG_DFL)
+        self.install_trace_signal()
 
         self.initialize_device()
 
-        if self.mpris_server != None:
-            self.mpris_server.start()
         if self.feedback_watcher_1 != None:
             self.feedback_watcher_1.start()
         if self.feedback_watcher_2 != None:
@@ -1155,6 +1987,43 @@ class SonyAvIndicator():
         self.feedback_watcher_1.probe_volume()
         self.feedback_watcher_1.probe_input()
 
+        self.receivers = ReceiverRegistry(self.event_loop, self.device_service)
+        self.receivers.register(self.device_service.device_id(), self)
+        if all_receivers:
+            self.event_loop.submit(self.receivers.discover())
+
+    def create_mpris_server(self):
+        try:
+            mpris = import_mpris()
+        except ImportError as e:
+            self.logger.warning("MPRIS disabled, no dbus-python: %s" %(e))
+            return None
+        try:
+            return mpris.MprisServer(self, self.device_service, self.state_service, self.command_service)
+        except mpris.dbus.exceptions.DBusException as e:
+            self.logger.warning("MPRIS disabled, no session bus: %s" %(e))
+            return None
+        except ImportError as e:
+            self.logger.warning("MPRIS disabled, no GLib: %s" %(e))
+            return None
+
+    def init_gui(self):
+        pass
+
+    def install_trace_signal(self):
+        # SIGUSR1 logs the trace. A running GLib main loop only notices
+        # signals through its own signal source.
+        if glib != None or self.mpris_server != None:
+            from gi.repository import GLib
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.dump_trace)
+        else:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_trace())
+
+    def dump_trace(self):
+        self.logger.info("Last frames sent and received:\n%s" %(TRACE.dump()))
+        # Keeps the GLib signal source
+        return True
+
     def quit(self, source):
         self.update_label("Disconnecting...")
         self.set_initialized(False)
@@ -1164,20 +2033,30 @@ class SonyAvIndicator():
         if self.feedback_watcher_2 != None:
             self.feedback_watcher_2.kill()
             self.feedback_watcher_2.join(8)
-        if self.mpris_server != None:
-            self.mpris_server.kill()
-            self.mpris_server.join(8)
-        gtk.main_quit()
+        if self.receivers != None:
+            self.receivers.close()
+        if self.metrics_server != None:
+            self.event_loop.call(self.metrics_server.close)
+        self.command_service.close()
+        self.event_loop.kill()
+        self.event_loop.join(2)
+        if self.capture != None:
+            self.capture.close()
+        self.quit_main_loop()
+
+    def quit_main_loop(self):
+        if self.main_loop != None:
+            self.main_loop.quit()
 
     def initialize_device(self):
         self.update_label("Searching")
-        self.device_service.find_device()
+        self.wait_for(self.event_loop.submit(self.device_service.locate()))
         self.update_label("Connected")
         self.device_service.initialized = True
+        self.device_service.start_cache_validation()
 
-    def poll_state(self):
-        self.command_service.mute(None)
-        self.command_service.unmute(None)
+    def wait_for(self, future):
+        return future.result()
 
     def set_initialized(self, initialized):
         self.initialized = initialized
@@ -1185,6 +2064,8 @@ class SonyAvIndicator():
         self.state_service.initialized = initialized
         self.command_service.initialized = initialized
 
+    # Without a GUI the state is only logged. The indicator overrides these.
+
     def get_volume_icon(self, vol):
         if self.state_service.muted:
             icon_name = "audio-volume-muted-panel"
@@ -1202,14 +2083,269 @@ class SonyAvIndicator():
         return os.path.abspath("%s/%s.svg" %(ICON_PATH, icon_name))
     
     def set_volume_icon(self, vol):
+        pass
+
+    def state_changed(self, key):
+        if key == "volume" or key == "muted":
+            self.set_volume_icon(self.state_service.volume)
+
+    def show_notification(self, title, text, icon, category = None):
+        self.logger.info("%s %s" %(title.replace("<b>", "").replace("</b>", ""), text))
+
+    def update_label(self, text = None):
+        if text != None:
+            self.logger.info(text)
+
+    def update_source(self, source, propagate = True):
+        self.state_service.update_source(source)
+
+    def update_sound_field(self, sound_field):
+        self.state_service.update_sound_field(sound_field)
+
+    def main(self):
+        if self.mpris_server == None:
+            self.event_loop.join()
+            return
+        # dbus-python dispatches the MPRIS calls on the GLib main loop
+        from gi.repository import GLib
+        self.main_loop = GLib.MainLoop()
+        self.main_loop.run()
+
+
+class GuiDispatcher():
+
+    # GTK must only be used on the thread running the GTK main loop. The
+    # updates are posted from any thread by key, only the latest of a key is
+    # kept, and they run together at most once per frame_interval.
+
+    pending = None
+    flush_pending = False
+    first_posted = 0.0
+    last_flush = 0.0
+    lock = None
+
+    frame_interval = 1.0 / 30
+
+    logger = logging.getLogger("gui")
+
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def post(self, key, callback, *args):
+        # Thread-safe
+        with self.lock:
+            self.pending.pop(key, None)
+            self.pending[key] = (callback, args)
+            if self.flush_pending:
+                return
+            self.flush_pending = True
+            self.first_posted = time.monotonic()
+            delay = self.last_flush + self.frame_interval - self.first_posted
+        if delay > 0:
+            glib.timeout_add(int(delay * 1000) + 1, self.flush)
+        else:
+            glib.idle_add(self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = collections.OrderedDict()
+            self.flush_pending = False
+            self.last_flush = time.monotonic()
+        METRIC_GUI_LATENCY.observe(self.last_flush - self.first_posted)
+        for key, (callback, args) in pending.items():
+            # A failing update must not hold back the others of the frame
+            try:
+                callback(*args)
+            except Exception:
+                self.logger.exception("Failed to update %s" %(key,))
+        # Runs once
+        return False
+
+
+class NotificationDispatcher(threading.Thread):
+
+    # Shows the notifications on its own thread, a slow notification daemon
+    # only delays the bubbles. A notification waits collapse_time for the
+    # next one of its group, which replaces it: mute, unmute, mute in a row or
+    # power on and the source end up as one bubble with the final state.
+    # Other groups keep their own bubble. Categories are not shown more often
+    # than their min_interval.
+
+    show = None
+    pending = None
+    condition = None
+    ended = False
+
+    # Notifications collapsed into the pending ones
+    depth = 0
+
+    collapse_time = 0.25
+    # A pending notification is shown after max_delay at the latest
+    max_delay = 1.0
+    min_interval = {
+        "muted": 0.5,
+        "source": 0.5,
+        "sound_field": 0.5,
+        "fmtuner": 1.0,
+        "timer": 5.0,
+    }
+    # Categories collapsing into another one, every other category is a
+    # group of its own
+    groups = {
+        "source": "power",
+    }
+
+    logger = logging.getLogger("notify")
+
+    def __init__(self, show):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.show = show
+        self.condition = threading.Condition()
+        # group -> (first_posted, posted, posts, category, title, text, icon)
+        self.pending = {}
+        # category -> time it was shown last
+        self.last_shown = {}
+
+    def post(self, category, title, text, icon):
+        # Thread-safe and never blocks for long
+        now = time.monotonic()
+        group = self.groups.get(category, category)
+        with self.condition:
+            pending = self.pending.get(group)
+            if pending != None:
+                first_posted, posts = pending[0], pending[2] + 1
+            else:
+                first_posted, posts = now, 1
+            self.pending[group] = (first_posted, now, posts, category, title, text, icon)
+            self.depth += 1
+            METRIC_NOTIFICATION_DEPTH.set(self.depth)
+            self.condition.notify()
+
+    def due(self, pending):
+        first_posted, posted, posts, category, title, text, icon = pending
+        due = min(posted + self.collapse_time, first_posted + self.max_delay)
+        last_shown = self.last_shown.get(category)
+        if last_shown != None:
+            due = max(due, last_shown + self.min_interval.get(category, 0.0))
+        return due
+
+    def next_due(self):
+        # Returns the group to show next and when it is due
+        return min(((self.due(pending), group) for group, pending in self.pending.items()), key = lambda due: due[0])
+
+    def kill(self):
+        with self.condition:
+            self.ended = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.ended:
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    due, group = self.next_due()
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if self.ended:
+                    return
+                first_posted, posted, posts, category, title, text, icon = self.pending.pop(group)
+                self.depth -= posts
+                METRIC_NOTIFICATION_DEPTH.set(self.depth)
+                self.last_shown[category] = time.monotonic()
+            try:
+                self.show(title, text, icon, group)
+            except Exception as e:
+                self.logger.warning("Failed to show the notification: %s" %(e))
+            METRIC_NOTIFICATION_LATENCY.observe(time.monotonic() - first_posted)
+
+
+class SonyAvIndicator(SonyAvDaemon):
+
+    indicator = None
+    notifications = None
+    notifications_initialized = False
+    gui_dispatcher = None
+    notification_dispatcher = None
+
+    source_menu_items = {}
+    sound_field_menu_items = {}
+
+    source_group = []
+    sound_field_group = []
+
+    show_source_name = True
+
+    def __init__(self, capture_path = None, metrics_port = None):
+        import_gui()
+        self.gui_dispatcher = GuiDispatcher()
+        SonyAvDaemon.__init__(self, capture_path = capture_path, metrics_port = metrics_port)
+
+    def init_gui(self):
+        self.indicator = appindicator.Indicator.new(APPINDICATOR_ID, self.get_volume_icon_path(self.get_volume_icon(LOW_VOLUME)), appindicator.IndicatorCategory.SYSTEM_SERVICES)
+        self.indicator.set_status(appindicator.IndicatorStatus.ACTIVE)
+        self.indicator.set_menu(self.build_menu())
+        self.indicator.connect("scroll-event", self.scroll)
+
+        notify.init(APPINDICATOR_ID)
+        # group -> bubble, the groups replace only their own bubble
+        self.notifications = {}
+        self.notification_dispatcher = NotificationDispatcher(self.show_notification_now)
+        self.notification_dispatcher.start()
+        self.notifications_initialized = True
+
+    def quit_main_loop(self):
+        if self.notification_dispatcher != None:
+            self.notification_dispatcher.kill()
+        gtk.main_quit()
+
+    def wait_for(self, future):
+        # Keeps the user interface responsive while the event loop is busy.
+        # The done callback runs on the event loop thread and only wakes up
+        # the GTK main loop, which is the only thread touching GTK.
+        future.add_done_callback(lambda f: glib.idle_add(lambda: False))
+        while not future.done():
+            gtk.main_iteration_do(True)
+        return future.result()
+
+    def poll_state(self):
+        self.command_service.mute(None)
+        self.command_service.unmute(None)
+
+    # The services call these on any thread, GTK is only touched by the
+    # gui_dispatcher on the main thread and notifications are shown by the
+    # notification_dispatcher
+
+    def set_volume_icon(self, vol):
+        self.gui_dispatcher.post("icon", self.set_icon, vol)
+
+    def set_icon(self, vol):
         self.indicator.set_icon(self.get_volume_icon_path(self.get_volume_icon(vol)))
 
-    def show_notification(self, title, text, icon):
+    def show_notification(self, title, text, icon, category = None):
         if self.notifications_initialized:
-            self.notification.update(title, text, icon)
-            self.notification.show()
+            self.notification_dispatcher.post(category, title, text, icon)
+
+    def show_notification_now(self, title, text, icon, group = None):
+        # Runs on the notification dispatcher, the only user of notifications
+        notification = self.notifications.get(group)
+        if notification == None:
+            notification = notify.Notification.new("")
+            self.notifications[group] = notification
+        notification.update(title, text, icon)
+        notification.show()
 
     def update_label(self, text = None):
+        # The label is built from the state when it is shown
+        self.gui_dispatcher.post("label", self.set_label, text)
+
+    def set_label(self, text = None):
         if text != None:
             self.indicator.set_label(text, "")
         elif self.show_source_name:
@@ -1227,10 +2363,20 @@ class SonyAvIndicator():
             self.indicator.set_label(label, "")
 
     def update_source(self, source, propagate = True):
-        self.source_menu_items[source].set_active(True)
+        # The state changes right away, so activating the menu item later
+        # finds it up to date and does not send the source back
+        self.state_service.update_source(source)
+        self.gui_dispatcher.post("source", self.set_menu_item_active, self.source_menu_items, source)
 
     def update_sound_field(self, sound_field):
-        self.sound_field_menu_items[sound_field].set_active(True)
+        self.state_service.update_sound_field(sound_field)
+        self.gui_dispatcher.post("sound_field", self.set_menu_item_active, self.sound_field_menu_items, sound_field)
+
+    def set_menu_item_active(self, menu_items, key):
+        # Some reported sources, like amTuner, have no menu item
+        menu_item = menu_items.get(key)
+        if menu_item != None:
+            menu_item.set_active(True)
 
     def scroll(self, indicator, steps, direction):
         if self.initialized:
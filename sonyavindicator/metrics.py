@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Counters, gauges and histograms of the whole process in the Prometheus
+# text format, served on a local HTTP port:
+#
+#   python3 -m sonyavindicator --headless --metrics-port 9753
+#   curl http://127.0.0.1:9753/metrics
+#
+# Recording is a dict or list update on the calling thread, labels stay raw
+# keys (e.g. command keys) until a scrape renders them.
+
+import asyncio
+import bisect
+import logging
+
+# Upper bounds in seconds for latencies from microseconds to seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# Upper bounds in seconds for network scans
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter():
+
+    __slots__ = ("name", "help", "label", "label_name", "values")
+
+    def __init__(self, name, help, label = None, label_name = None):
+        # label_name turns the raw key into the label value on scrapes
+        self.name = name
+        self.help = help
+        self.label = label
+        self.label_name = label_name
+        self.values = {}
+
+    def inc(self, key = None, amount = 1):
+        values = self.values
+        values[key] = values.get(key, 0) + amount
+
+    def render(self, kind = "counter"):
+        lines = ["# HELP %s %s" %(self.name, self.help), "# TYPE %s %s" %(self.name, kind)]
+        values = list(self.values.items())
+        if not values and self.label == None:
+            values = [(None, 0)]
+        for key, value in values:
+            if self.label == None:
+                lines.append("%s %s" %(self.name, format_value(value)))
+            else:
+                name = self.label_name(key) if self.label_name != None else key
+                lines.append("%s{%s=\"%s\"} %s" %(self.name, self.label, name, format_value(value)))
+        return lines
+
+
+class Gauge(Counter):
+
+    __slots__ = ()
+
+    def set(self, value, key = None):
+        self.values[key] = value
+
+    def render(self):
+        return Counter.render(self, "gauge")
+
+
+class Histogram():
+
+    __slots__ = ("name", "help", "buckets", "counts", "sum")
+
+    def __init__(self, name, help, buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # The last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self):
+        lines = ["# HELP %s %s" %(self.name, self.help), "# TYPE %s histogram" %(self.name)]
+        counts = list(self.counts)
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            lines.append("%s_bucket{le=\"%s\"} %d" %(self.name, format_value(bound), total))
+        total += counts[-1]
+        lines.append("%s_bucket{le=\"+Inf\"} %d" %(self.name, total))
+        lines.append("%s_sum %s" %(self.name, format_value(self.sum)))
+        lines.append("%s_count %d" %(self.name, total))
+        return lines
+
+
+class MetricsRegistry():
+
+    metrics = None
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label = None, label_name = None):
+        return self.add(Counter(name, help, label, label_name))
+
+    def gauge(self, name, help, label = None, label_name = None):
+        return self.add(Gauge(name, help, label, label_name))
+
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of the process
+METRICS = MetricsRegistry()
+
+
+class MetricsServer():
+
+    # Answers GET /metrics on the given asyncio loop, no extra thread
+
+    registry = None
+    host = "127.0.0.1"
+    port = None
+    server = None
+
+    read_timeout = 5.0
+
+    logger = logging.getLogger("metrics")
+
+    def __init__(self, port, registry = None, host = None):
+        self.port = port
+        self.registry = registry if registry != None else METRICS
+        if host != None:
+            self.host = host
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve, self.host, self.port, reuse_address = True)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.logger.info("Serving metrics on http://%s:%d/metrics" %(self.host, self.port))
+
+    def close(self):
+        if self.server != None:
+            self.server.close()
+            self.server = None
+
+    async def serve(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.read_timeout)
+            # The headers are not needed
+            while (await asyncio.wait_for(reader.readline(), self.read_timeout)).strip():
+                pass
+            fields = request.decode("latin-1").split()
+            if len(fields) >= 2 and fields[0] == "GET" and fields[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" %(status, len(body))).encode("latin-1") + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# The MPRIS interface on the session bus, loaded by the indicator and the
+# daemon only when it is enabled, so nothing else needs dbus-python
+
+import logging
+import threading
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+
+try:
+    from capture import TRACE
+    from metrics import METRICS
+    from indicator import MAX_VOLUME
+except ImportError:
+    from sonyavindicator.capture import TRACE
+    from sonyavindicator.metrics import METRICS
+    from sonyavindicator.indicator import MAX_VOLUME
+
+IDENTITY = 'sonyavindicator'
+
+DESKTOP = 'sonyavindicator'
+
+BUS_NAME = 'org.mpris.MediaPlayer2.' + IDENTITY
+OBJECT_PATH = '/org/mpris/MediaPlayer2'
+ROOT_INTERFACE = 'org.mpris.MediaPlayer2'
+PLAYER_INTERFACE = 'org.mpris.MediaPlayer2.Player'
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+PLAYLISTS_IFACE = 'org.mpris.MediaPlayer2.Playlists'
+METRICS_INTERFACE = 'org.sonyavindicator.Metrics'
+DEBUG_INTERFACE = 'org.sonyavindicator.Debug'
+
+# Maps the state keys to the MPRIS properties derived from them
+MPRIS_STATE_PROPERTIES = {
+    "volume": [(PLAYER_INTERFACE, "Volume")],
+    "source": [(PLAYER_INTERFACE, "Metadata")],
+}
+
+
+class MprisServer(dbus.service.Object):
+
+    sony_av_indicator = None
+    device_service = None
+    state_service = None
+    command_service = None
+    properties = None
+    cache = None
+    changed = None
+    flush_pending = False
+    bus = None
+
+    # PropertiesChanged is emitted at most every coalesce_interval ms
+    coalesce_interval = 50
+
+    logger = logging.getLogger("mpris")
+
+    def __init__(self, sony_av_indicator, device_service, state_service, command_service):
+        # dbus-python runs on the GLib main loop, signals are emitted there
+        from gi.repository import GLib
+        self.glib = GLib
+        self.sony_av_indicator = sony_av_indicator
+        self.device_service = device_service
+        self.state_service = state_service
+        self.command_service = command_service
+        self.properties = {
+            ROOT_INTERFACE: self._get_root_iface_properties(),
+            PLAYER_INTERFACE: self._get_player_iface_properties()
+        }
+        self.cache = dict((interface, {}) for interface in self.properties)
+        self.changed = set()
+        self.lock = threading.Lock()
+        self.state_service.add_listener(self.state_changed)
+        self.main_loop = dbus.mainloop.glib.DBusGMainLoop(set_as_default = True)
+        # self.main_loop = GObject.MainLoop()
+        self.bus = dbus.SessionBus(mainloop = self.main_loop)
+        self.bus_name = self._connect_to_dbus()
+        dbus.service.Object.__init__(self, self.bus_name, OBJECT_PATH)
+
+    def _get_root_iface_properties(self):
+        return {
+            'CanQuit': (True, None),
+            'Fullscreen': (False, None),
+            'CanSetFullscreen': (False, None),
+            'CanRaise': (False, None),
+            # NOTE Change if adding optional track list support
+            'HasTrackList': (False, None),
+            'Identity': (IDENTITY, None),
+            'DesktopEntry': (DESKTOP, None),
+            'SupportedUriSchemes': (dbus.Array([], 's', 1), None),
+            # NOTE Return MIME types supported by local backend if support for
+            # reporting supported MIME types is added
+            'SupportedMimeTypes': (dbus.Array([], 's', 1), None),
+        }
+
+    def _get_player_iface_properties(self):
+        return {
+            'PlaybackStatus': (self.get_playback_status, None),
+            'LoopStatus': (self.get_loop_status, None),
+            'Rate': (1.0, None),
+            'Shuffle': (None, None),
+            'Metadata': (self.get_metadata, None),
+            'Volume': (self.get_volume, self.set_volume),
+            'Position': (None, None),
+            'MinimumRate': (1.0, None),
+            'MaximumRate': (1.0, None),
+            'CanGoNext': (self.can_go_next, None),
+            'CanGoPrevious': (self.can_go_previous, None),
+            'CanPlay': (self.can_play, None),
+            'CanPause': (self.can_pause, None),
+            'CanSeek': (self.can_seek, None),
+            'CanControl': (self.can_control, None),
+        }
+
+    def _connect_to_dbus(self):
+        # bus_type = self.config['mpris']['bus_type']
+        self.bus = dbus.SessionBus()
+        bus_name = dbus.service.BusName(BUS_NAME, self.bus)
+        return bus_name
+
+    def get_playback_status(self):
+        return 'Playing'
+
+    def get_loop_status(self):
+        return 'None'
+
+    def can_go_next(self):
+        return True
+
+    def can_go_previous(self):
+        return True
+
+    def can_play(self):
+        return True
+
+    def can_pause(self):
+        return True
+
+    def can_seek(self):
+        return True
+
+    def can_control(self):
+        return True
+
+    def get_metadata(self):
+        metadata = {
+            'mpris:trackid': self.state_service.source,
+            'mpris:length': 60000
+        }
+        return dbus.Dictionary(metadata, signature = 'sv')
+
+    def get_volume(self):
+        volume = self.state_service.volume
+        if volume is None:
+            return 0
+        return volume / 100.0
+
+    def set_volume(self, value):
+        volume = int(value * 100)
+        if volume < 0:
+            volume = 0
+        elif volume > MAX_VOLUME:
+            volume = MAX_VOLUME
+        self.command_service.set_volume(None, volume)
+
+    @dbus.service.method(PLAYER_INTERFACE)
+    def Pause(self):
+        pass
+
+    @dbus.service.method(PLAYER_INTERFACE)
+    def PlayPause(self):
+        pass
+
+    @dbus.service.method(PLAYER_INTERFACE)
+    def Play(self):
+        pass
+
+    @dbus.service.method(PLAYER_INTERFACE)
+    def Stop(self):
+        pass
+
+    @dbus.service.method(PLAYER_INTERFACE)
+    def Next(self):
+        self.command_service.source_up()
+
+    @dbus.service.method(PLAYER_INTERFACE)
+    def Previous(self):
+        self.command_service.source_down()
+
+    @dbus.service.method(METRICS_INTERFACE, out_signature = 's')
+    def GetMetrics(self):
+        # The same text as the HTTP endpoint
+        return METRICS.render()
+
+    @dbus.service.method(DEBUG_INTERFACE, out_signature = 's')
+    def DumpTrace(self):
+        # The last frames sent and received, oldest first
+        return TRACE.dump()
+
+    # --- Property cache
+
+    def get_property(self, interface, prop):
+        with self.lock:
+            cache = self.cache[interface]
+            if prop not in cache:
+                (getter, _) = self.properties[interface][prop]
+                cache[prop] = getter() if callable(getter) else getter
+            return cache[prop]
+
+    def state_changed(self, key):
+        # Called on whatever thread changed the state. Invalidates the cached
+        # properties and emits one PropertiesChanged for all changes within
+        # coalesce_interval on the GLib main loop.
+        props = MPRIS_STATE_PROPERTIES.get(key)
+        if props == None:
+            return
+        with self.lock:
+            for interface, prop in props:
+                self.cache[interface].pop(prop, None)
+                self.changed.add((interface, prop))
+            if self.flush_pending:
+                return
+            self.flush_pending = True
+        self.glib.timeout_add(self.coalesce_interval, self.flush_changes)
+
+    def flush_changes(self):
+        with self.lock:
+            changed = self.changed
+            self.changed = set()
+            self.flush_pending = False
+        interfaces = {}
+        for interface, prop in changed:
+            interfaces.setdefault(interface, {})[prop] = self.get_property(interface, prop)
+        for interface, changed_properties in interfaces.items():
+            self.PropertiesChanged(interface, changed_properties, [])
+        # Runs once
+        return False
+
+    # --- Properties interface
+
+    @dbus.service.method(dbus_interface=PROPERTIES_INTERFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, prop):
+        return self.get_property(interface, prop)
+
+    @dbus.service.method(dbus_interface=PROPERTIES_INTERFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        return dict((prop, self.get_property(interface, prop)) for prop in self.properties[interface])
+
+    @dbus.service.method(dbus_interface=PROPERTIES_INTERFACE, in_signature='ssv', out_signature='')
+    def Set(self, interface, prop, value):
+        self.logger.debug("%s.Set(%s, %s)" %(interface, prop, value))
+        _, setter = self.properties[interface][prop]
+        if setter is not None:
+            # The state change emits PropertiesChanged
+            setter(value)
+
+    @dbus.service.signal(dbus_interface=PROPERTIES_INTERFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed_properties, invalidated_properties):
+        self.logger.debug("%s.PropertiesChanged(%s)" %(interface, ", ".join(changed_properties)))
+
+    # --- Root interface methods
+
+    @dbus.service.method(dbus_interface=ROOT_INTERFACE)
+    def Raise(self):
+        # Do nothing, as we do not have a GUI
+        pass
+
+    @dbus.service.method(dbus_interface=ROOT_INTERFACE)
+    def Quit(self):
+        self.sony_av_indicator.quit(None)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Simulates a Sony AV receiver (STR-DN860) on the local machine. It answers
+# the commands the indicator sends with the feedback of the real device and
+# optionally pushes unsolicited feedback, so the indicator can be tested and
+# benchmarked without hardware:
+#
+#   python3 -m sonyavindicator.simulator --port 33335 --port 33336 --rate 10
+#
+# and point the indicator to 127.0.0.1.
+
+import argparse
+import asyncio
+import collections
+import itertools
+import logging
+import random
+import socket
+import threading
+
+try:
+    from codec import *
+except ImportError:
+    from sonyavindicator.codec import *
+
+
+# How unsolicited feedback is written to the socket
+SEGMENTATION_FRAME = "frame"
+SEGMENTATION_SPLIT = "split"
+SEGMENTATION_COALESCE = "coalesce"
+SEGMENTATIONS = [SEGMENTATION_FRAME, SEGMENTATION_SPLIT, SEGMENTATION_COALESCE]
+
+# FM presets of the simulated tuner in MHz
+SIMULATOR_FM_PRESETS = [88.6, 91.0, 92.9, 95.8, 97.3, 99.9, 102.5, 104.6]
+
+
+def fmtuner_frame(preset, stereo, freq):
+    # Inverse of decode_fmtuner
+    value = int(round((freq + 0.1) * 99.5))
+    stereo_byte = FEEDBACK_FMTUNER_STEREO[0] if stereo else FEEDBACK_FMTUNER_MONO[0]
+    return FEEDBACK_FMTUNER_PREFIX + bytes([preset, stereo_byte, value // 255, value % 255])
+
+
+class ReceiverSimulator():
+
+    event_loop = None
+    host = "127.0.0.1"
+    ports = None
+    servers = None
+    writers = None
+    emitter = None
+    thread = None
+
+    power = True
+    muted = False
+    volume = 15
+    source = CMD_SOURCE_MAP["tv"][5]
+    sound_field = CMD_SOUND_FIELD_MAP["twoChannelStereo"][4]
+    fmtuner = 1
+    timer = None
+    # State of the other zones, zone -> dict
+    zones = None
+
+    # Unsolicited feedback frames per second, 0 disables them
+    rate = 0.0
+    read_size = 1024
+    segmentation = SEGMENTATION_FRAME
+    coalesce_count = 4
+
+    commands_received = 0
+    frames_sent = 0
+    unknown_commands = 0
+
+    logger = logging.getLogger("sim")
+
+    def __init__(self, ports = (TCP_PORT_1, TCP_PORT_2), host = None, rate = None, segmentation = None):
+        # Port 0 binds to a free port, the actual ports are in self.ports
+        self.ports = list(ports)
+        if host != None:
+            self.host = host
+        if rate != None:
+            self.rate = rate
+        if segmentation != None:
+            self.segmentation = segmentation
+        self.servers = []
+        self.writers = []
+        self.received = collections.Counter()
+        self.random = random.Random(0)
+        self.zones = dict((zone, {"power": False, "muted": False, "volume": 15, "source": self.source}) for zone in ZONES if zone != ZONE_MAIN)
+        self.handlers = {
+            command_key(CMD_SOURCE_MAP["bdDvd"]): self.on_source,
+            command_key(CMD_MUTE): self.on_mute,
+            command_key(CMD_POWER_ON): self.on_power,
+            command_key(CMD_VOLUME_MIN): self.on_volume,
+            command_key(CMD_VOLUME_UP): self.on_volume_step,
+            command_key(CMD_VOLUME_DOWN): self.on_volume_step,
+            command_key(CMD_SOUND_FIELD_MAP["twoChannelStereo"]): self.on_sound_field,
+            command_key(CMD_FMTUNER_PRESET_UP): self.on_fmtuner_preset,
+            command_key(CMD_FMTUNER_PRESET_DOWN): self.on_fmtuner_preset,
+            command_key(CMD_HDMIOUT_ON): self.on_hdmiout,
+        }
+
+    # --- Feedback frames of the current state
+
+    def source_frame(self):
+        if not self.power:
+            state = FEEDBACK_POWER_OFF[0]
+        elif self.muted:
+            state = FEEDBACK_MUTE_ON[0]
+        else:
+            state = FEEDBACK_MUTE_OFF[0]
+        return FEEDBACK_SOURCE_MAP["bdDvd"][:5] + bytes([self.source, 0x00, state, 0x00])
+
+    def volume_frame(self):
+        return FEEDBACK_VOLUME + bytes([self.volume])
+
+    def sound_field_frame(self):
+        return FEEDBACK_SOUND_FIELD_MAP["twoChannelStereo"][:4] + bytes([self.sound_field, 0x00])
+
+    def zone_source_frame(self, zone):
+        state = self.zones[zone]
+        if not state["power"]:
+            state_byte = FEEDBACK_POWER_OFF[0]
+        elif state["muted"]:
+            state_byte = FEEDBACK_MUTE_ON[0]
+        else:
+            state_byte = FEEDBACK_MUTE_OFF[0]
+        return FEEDBACK_SOURCE_MAP["bdDvd"][:4] + bytes([zone, state["source"], 0x00, state_byte, 0x00])
+
+    def zone_volume_frame(self, zone):
+        return FEEDBACK_VOLUME[:4] + bytes([zone]) + FEEDBACK_VOLUME[5:] + bytes([self.zones[zone]["volume"]])
+
+    def fmtuner_frame(self):
+        return fmtuner_frame(self.fmtuner, True, SIMULATOR_FM_PRESETS[(self.fmtuner - 1) % len(SIMULATOR_FM_PRESETS)])
+
+    def timer_frame(self):
+        if self.timer == None:
+            return FEEDBACK_TIMER_PREFIX + FEEDBACK_TIMER_OFF * 3
+        hours, minutes = divmod(self.timer, 60)
+        return FEEDBACK_TIMER_PREFIX + bytes([hours, minutes]) + FEEDBACK_TIMER_UPDATE
+
+    def state_frames(self):
+        frames = [self.source_frame(), self.volume_frame(), self.sound_field_frame(), self.timer_frame()]
+        # The tuner only reports while it is the source
+        if self.source == CMD_SOURCE_MAP["fmTuner"][5]:
+            frames.append(self.fmtuner_frame())
+        return frames
+
+    # --- Commands
+
+    def on_source(self, cmd):
+        self.source = cmd[5]
+        self.power = True
+        return [self.source_frame()]
+
+    def on_mute(self, cmd):
+        self.muted = cmd[5] == CMD_MUTE[5]
+        return [self.source_frame()]
+
+    def on_power(self, cmd):
+        self.power = cmd[5] == CMD_POWER_ON[5]
+        return [self.source_frame()]
+
+    def on_volume(self, cmd):
+        self.volume = min(cmd[7], CMD_VOLUME_MAX[7])
+        return [self.volume_frame()]
+
+    def on_volume_step(self, cmd):
+        if cmd[3] == CMD_VOLUME_UP[3]:
+            self.volume = min(self.volume + 1, CMD_VOLUME_MAX[7])
+        else:
+            self.volume = max(self.volume - 1, 0)
+        return [self.volume_frame()]
+
+    def on_sound_field(self, cmd):
+        self.sound_field = cmd[4]
+        return [self.sound_field_frame()]
+
+    def on_fmtuner_preset(self, cmd):
+        step = 1 if cmd[3] == CMD_FMTUNER_PRESET_UP[3] else -1
+        self.fmtuner = (self.fmtuner - 1 + step) % len(SIMULATOR_FM_PRESETS) + 1
+        self.source = CMD_SOURCE_MAP["fmTuner"][5]
+        return [self.fmtuner_frame(), self.source_frame()]
+
+    def on_hdmiout(self, cmd):
+        # The real device does not report HDMI out
+        return []
+
+    def on_zone(self, zone, cmd):
+        # The other zones only know power, mute, source and volume
+        state = self.zones[zone]
+        key = command_key(cmd)
+        if key == command_key(CMD_SOURCE_MAP["bdDvd"]):
+            state["source"] = cmd[5]
+            state["power"] = True
+        elif key == command_key(CMD_MUTE):
+            state["muted"] = cmd[5] == CMD_MUTE[5]
+        elif key == command_key(CMD_POWER_ON):
+            state["power"] = cmd[5] == CMD_POWER_ON[5]
+        elif key == command_key(CMD_VOLUME_MIN):
+            state["volume"] = min(cmd[7], CMD_VOLUME_MAX[7])
+            return [self.zone_volume_frame(zone)]
+        else:
+            return []
+        return [self.zone_source_frame(zone)]
+
+    def set_timer(self, minutes):
+        # Sets the sleep timer (None switches it off) and reports it
+        self.timer = minutes
+        self.broadcast([self.timer_frame()])
+
+    def handle(self, cmd):
+        self.commands_received += 1
+        self.received[command_key(cmd)] += 1
+        handler = self.handlers.get(command_key(cmd)) if len(cmd) > 3 else None
+        if handler == None:
+            self.unknown_commands += 1
+            self.logger.debug("Unknown command: %s" %(bytes(cmd).hex()))
+            return
+        zone = command_zone(cmd)
+        if zone in self.zones:
+            self.broadcast(self.on_zone(zone, bytes(cmd)))
+        else:
+            self.broadcast(handler(bytes(cmd)))
+
+    # --- Connections
+
+    def broadcast(self, frames, segmentation = SEGMENTATION_FRAME):
+        # Feedback goes to every connected client, like the real device
+        if not frames:
+            return
+        for writer in list(self.writers):
+            self.write(writer, frames, segmentation)
+
+    def write(self, writer, frames, segmentation):
+        if writer.is_closing():
+            return
+        if segmentation == SEGMENTATION_COALESCE:
+            writer.write(b"".join(bytes(frame) for frame in frames))
+        elif segmentation == SEGMENTATION_SPLIT:
+            self.event_loop.create_task(self.write_split(writer, frames))
+        else:
+            for frame in frames:
+                writer.write(bytes(frame))
+        self.frames_sent += len(frames)
+
+    async def write_split(self, writer, frames):
+        # Every frame is cut at a random position and the parts are written
+        # one after another, so they arrive in separate TCP segments
+        try:
+            for frame in frames:
+                cut = self.random.randint(1, len(frame) - 1)
+                for part in (frame[:cut], frame[cut:]):
+                    writer.write(bytes(part))
+                    await writer.drain()
+                    await asyncio.sleep(0)
+        except (OSError, RuntimeError):
+            pass
+
+    async def serve(self, reader, writer):
+        _socket = writer.get_extra_info("socket")
+        _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.writers.append(writer)
+        self.logger.debug("Client connected: %s" %(writer.get_extra_info("peername"),))
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                for cmd in decoder.feed(data):
+                    self.handle(cmd)
+        except OSError:
+            pass
+        finally:
+            self.writers.remove(writer)
+            writer.close()
+
+    async def emit(self):
+        # Pushes the current state round robin, coalesce_count frames at once
+        # if coalescing, so the rate in frames per second stays the same
+        counter = itertools.count()
+        count = self.coalesce_count if self.segmentation == SEGMENTATION_COALESCE else 1
+        while True:
+            await asyncio.sleep(count / self.rate)
+            frames = self.state_frames()
+            self.broadcast([frames[next(counter) % len(frames)] for i in range(count)], self.segmentation)
+
+    async def start(self):
+        self.event_loop = asyncio.get_event_loop()
+        for index, port in enumerate(self.ports):
+            server = await asyncio.start_server(self.serve, self.host, port, reuse_address = True)
+            self.servers.append(server)
+            self.ports[index] = server.sockets[0].getsockname()[1]
+        self.logger.info("Listening on %s port %s" %(self.host, ", ".join([str(port) for port in self.ports])))
+        if self.rate > 0:
+            self.emitter = self.event_loop.create_task(self.emit())
+
+    async def stop(self):
+        if self.emitter != None:
+            self.emitter.cancel()
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for writer in list(self.writers):
+            writer.close()
+        self.servers = []
+
+    def start_thread(self):
+        # Runs the simulator on its own event loop in a daemon thread and
+        # returns as soon as it is listening
+        started = threading.Event()
+        loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self.thread = threading.Thread(target = run, daemon = True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop_thread(self):
+        if self.thread != None:
+            self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+            self.thread.join(2)
+            self.thread = None
+
+    def call(self, callback, *args):
+        # Thread-safe: runs the callback on the simulator's event loop
+        self.event_loop.call_soon_threadsafe(callback, *args)
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(prog = "sonyavindicator.simulator", description = "Simulates a Sony AV receiver on the local machine")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", dest = "ports", type = int, action = "append", help = "port to listen on, may be repeated (default: %d and %d)" %(TCP_PORT_1, TCP_PORT_2))
+    parser.add_argument("--rate", type = float, default = 0.0, help = "unsolicited feedback frames per second")
+    parser.add_argument("--segmentation", choices = SEGMENTATIONS, default = SEGMENTATION_FRAME, help = "how unsolicited feedback is cut into TCP segments")
+    options = parser.parse_args(args)
+
+    simulator = ReceiverSimulator(options.ports or (TCP_PORT_1, TCP_PORT_2), options.host, options.rate, options.segmentation)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(simulator.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(simulator.stop())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()